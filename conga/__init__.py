@@ -8,6 +8,9 @@ from . import imhc_scoring
 from . import cd8_scoring
 from . import tcrdist
 from . import tcr_clumping
+from . import ann
+from . import rank_tests
+from . import tcrdist_lib
 
 
 
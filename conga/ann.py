@@ -0,0 +1,191 @@
+######################################################################################################################
+# approximate nearest neighbor search using a random projection forest plus neighbor-of-neighbor refinement
+#
+# each tree recursively splits the clones in half at the median of their projections onto a random direction
+#  (the direction joining two randomly chosen clones in the node) until the leaves are no bigger than leaf_size,
+#  which is fixed (it does not grow with the number of neighbors). A clone's initial candidates are the members of
+#  its leaf in every tree, merged, plus a block of pseudo-random clones so that there are always at least num_nbrs
+#  distinct candidates. The neighbor lists are then refined a few times NN-descent style: the new candidates for a
+#  clone are its current nbrs plus the current nbrs of its nearest nbrs.
+#
+# all the distance calculations are done on row batches of (clone, candidate) pairs, so the memory use is bounded
+#  by the size of the neighbor lists themselves; there's never an NxN distance matrix
+#
+import numpy as np
+
+# distance for clones in the same agroup/bgroup, the same large finite value used by preprocess.calc_nbrs
+MASKED_DIST = 1e3
+
+
+def build_rp_tree( X, leaf_size, rng ):
+    ''' returns a list of integer index arrays, one per leaf; together they partition range(X.shape[0])
+    '''
+    leaves = []
+    stack = [ np.arange(X.shape[0]) ]
+    while stack:
+        indices = stack.pop()
+        if indices.shape[0] <= leaf_size:
+            leaves.append(indices)
+            continue
+        i, j = rng.choice(indices.shape[0], 2, replace=False)
+        direction = X[indices[i]] - X[indices[j]]
+        if not np.any(direction): # duplicate points, fall back to a random direction
+            direction = rng.normal(size=X.shape[1])
+        projections = X[indices] @ direction
+        order = np.argsort(projections, kind='stable')
+        half = indices.shape[0]//2
+        stack.append(indices[order[:half]])
+        stack.append(indices[order[half:]])
+    return leaves
+
+
+def build_rp_forest( X, num_trees, leaf_size, random_state=0 ):
+    ''' returns a list of trees, each one a (leaf_members, clone_leaf) tuple where leaf_members is an integer
+    array of shape (num_leaves, leaf_size) padded with -1 and clone_leaf maps from clone index to leaf index
+    '''
+    rng = np.random.default_rng(random_state)
+    forest = []
+    for _ in range(num_trees):
+        leaves = build_rp_tree(X, leaf_size, rng)
+        leaf_members = np.full((len(leaves), leaf_size), -1, dtype=np.int64)
+        clone_leaf = np.zeros((X.shape[0],), dtype=np.int64)
+        for ii, leaf in enumerate(leaves):
+            leaf_members[ii,:leaf.shape[0]] = leaf
+            clone_leaf[leaf] = ii
+        forest.append((leaf_members, clone_leaf))
+    return forest
+
+
+def _candidate_dists( X, sqnorms, rows, cands, agroups, bgroups ):
+    ''' returns the euclidean distances from clones rows to candidates cands, shape (len(rows), num_cands)
+
+    cands is padded with -1 (and may contain repeats); those entries get distance np.inf.
+    candidates in the same agroup or bgroup as the row clone (including the clone itself) get MASKED_DIST
+    '''
+    cands = np.sort(cands, axis=1)
+    invalid = cands<0
+    invalid[:,1:] |= cands[:,1:] == cands[:,:-1]
+    safe_cands = np.where(invalid, 0, cands)
+
+    # only compute the distances for the distinct valid pairs
+    pair_rows, pair_cols = np.nonzero(~invalid)
+    pair_clones, pair_cands = rows[pair_rows], cands[pair_rows, pair_cols]
+    pair_dists = np.sqrt(np.maximum(0.0, sqnorms[pair_clones] + sqnorms[pair_cands] -
+                                    2*np.einsum('ij,ij->i', X[pair_clones], X[pair_cands])))
+    pair_dists[ (agroups[pair_clones] == agroups[pair_cands]) | (bgroups[pair_clones] == bgroups[pair_cands]) ] = \
+        MASKED_DIST
+    dists = np.full(cands.shape, np.inf)
+    dists[pair_rows, pair_cols] = pair_dists
+    return safe_cands, dists
+
+
+def _select_nearest( cands, dists, num_nbrs ):
+    ''' returns the num_nbrs nearest candidates in each row and their distances, sorted by increasing distance
+    '''
+    sample_range = np.arange(cands.shape[0])[:, np.newaxis]
+    inds = np.argpartition(dists, num_nbrs-1, axis=1)[:,:num_nbrs]
+    inds = inds[sample_range, np.argsort(dists[sample_range, inds], axis=1, kind='stable')]
+    return cands[sample_range, inds], dists[sample_range, inds]
+
+
+def _row_batches( num_clones, num_cands, num_dims, max_batch_elements ):
+    batch_size = max(1, max_batch_elements // max(1, num_cands*num_dims))
+    for start in range(0, num_clones, batch_size):
+        yield np.arange(start, min(num_clones, start+batch_size))
+
+
+def query_rp_forest_self_nbrs(
+        X,
+        forest,
+        num_nbrs,
+        agroups,
+        bgroups,
+        num_refine_iterations = 2,
+        max_refine_candidates = 2048,
+        max_batch_elements = 2**22,
+        random_state = 0,
+):
+    ''' returns nbrs, dists, each of shape (num_clones, num_nbrs), sorted by increasing distance
+
+    nbrs exclude self and any clones in same agroup or bgroup, unless there aren't enough other candidates, in
+    which case those clones come in at distance MASKED_DIST (like the exact calculation)
+
+    max_refine_candidates: in each refinement iteration we look at the nbr lists of the nearest
+      max(1, max_refine_candidates//num_nbrs) nbrs of each clone
+
+    max_batch_elements: rows are processed in batches with at most this many (row, candidate, dimension) elements
+    '''
+    num_clones, num_dims = X.shape
+    assert num_nbrs < num_clones
+    X = np.asarray(X, dtype=np.float64)
+    sqnorms = np.sum(X*X, axis=1)
+    agroups, bgroups = np.asarray(agroups), np.asarray(bgroups)
+
+    # num_nbrs distinct pseudo-random clones per row, to guarantee a full nbr list
+    rng = np.random.default_rng(random_state)
+    perm = rng.permutation(num_clones)
+    perm_position = np.argsort(perm)
+    fill_offsets = 1 + np.arange(num_nbrs)
+
+    nbrs = np.zeros((num_clones, num_nbrs), dtype=np.int64)
+    dists = np.zeros((num_clones, num_nbrs))
+
+    num_cands = len(forest)*forest[0][0].shape[1] + num_nbrs
+    for rows in _row_batches(num_clones, num_cands, num_dims, max_batch_elements):
+        cands = [ leaf_members[clone_leaf[rows]] for leaf_members, clone_leaf in forest ]
+        cands.append( perm[ (perm_position[rows][:,None] + fill_offsets[None,:]) % num_clones ] )
+        cands, cand_dists = _candidate_dists(X, sqnorms, rows, np.hstack(cands), agroups, bgroups)
+        nbrs[rows], dists[rows] = _select_nearest(cands, cand_dists, num_nbrs)
+
+    num_nbr_lists = min(num_nbrs, max(1, max_refine_candidates//num_nbrs))
+    num_cands = (num_nbr_lists+1)*num_nbrs
+    for it in range(num_refine_iterations):
+        # nbrs are updated in place, so later batches already see the improved lists of earlier ones
+        num_changed = 0
+        for rows in _row_batches(num_clones, num_cands, num_dims, max_batch_elements):
+            cands = np.hstack([ nbrs[rows], nbrs[nbrs[rows,:num_nbr_lists]].reshape(rows.shape[0], -1) ])
+            cands, cand_dists = _candidate_dists(X, sqnorms, rows, cands, agroups, bgroups)
+            new_nbrs, new_dists = _select_nearest(cands, cand_dists, num_nbrs)
+            num_changed += np.sum(new_dists < dists[rows])
+            nbrs[rows], dists[rows] = new_nbrs, new_dists
+        print(f'query_rp_forest_self_nbrs: refine iteration {it} num_changed= {num_changed}')
+        if num_changed == 0:
+            break
+
+    return nbrs, dists
+
+
+def find_approximate_nbrs(
+        X,
+        num_nbrs,
+        agroups,
+        bgroups,
+        num_trees = 8,
+        leaf_size = 64,
+        num_refine_iterations = 2,
+        random_state = 0,
+):
+    ''' returns nbrs, dists, each of shape (num_clones, num_nbrs), sorted by increasing distance
+
+    num_trees, num_refine_iterations: the accuracy/speed knobs
+    '''
+    num_clones = X.shape[0]
+    assert num_nbrs < num_clones
+
+    print(f'find_approximate_nbrs: num_clones= {num_clones} num_nbrs= {num_nbrs} num_trees= {num_trees} '
+          f'leaf_size= {leaf_size}')
+    forest = build_rp_forest( X, num_trees, leaf_size, random_state=random_state )
+
+    return query_rp_forest_self_nbrs( X, forest, num_nbrs, agroups, bgroups,
+                                      num_refine_iterations=num_refine_iterations, random_state=random_state )
+
+
+def calc_nbrs_recall( approx_nbrs, exact_nbrs ):
+    ''' returns the mean over rows of the fraction of the exact nbrs that are in the approximate nbrs
+    '''
+    assert approx_nbrs.shape == exact_nbrs.shape
+    num_rows, num_nbrs = exact_nbrs.shape
+    hits = 0
+    for ii in range(num_rows):
+        hits += np.intersect1d(approx_nbrs[ii], exact_nbrs[ii], assume_unique=True).shape[0]
+    return hits / (num_rows * num_nbrs)
@@ -1,6 +1,8 @@
 from os.path import exists
 from pathlib import Path
+import sys
 import numpy as np
+from scipy.sparse import csr_matrix
 from . import util
 
 # comparison of the correlations between CD4/CD8 expression levels and
@@ -25,6 +27,7 @@ from . import util
 
 amino_acids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', \
                'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
+aa_index_table = util.ascii_to_index_table(amino_acids)
 
 # read the model parameters
 all_models = {}
@@ -129,6 +132,69 @@ def encode_single_chain_tcr(vgene, jgene, cdr3, model_params):
     return x
 
 
+def encode_single_chain_tcrs(vgenes, jgenes, cdr3s, model_params):
+    ''' batched version of encode_single_chain_tcr
+
+    returns a sparse matrix of shape (len(cdr3s), NTOT+1) whose rows are the encode_single_chain_tcr vectors
+    '''
+    window_size = model_params['window_size']
+    min_lenbin = model_params['min_lenbin']
+    max_lenbin = model_params['max_lenbin']
+    vgene_indexer = model_params['vgene_indexer']
+    jgene_indexer = model_params['jgene_indexer']
+    NV = len(vgene_indexer)+1
+    NJ = len(jgene_indexer)+1
+    NL = max_lenbin-min_lenbin+1
+    NC = 20 * (2*window_size+1)
+    NTOT = NV + NJ + NL + NC
+
+    num_tcrs = len(cdr3s)
+    cdr3s, lengths = util.encode_strings_as_padded_array(cdr3s)
+    all_rows = np.arange(num_tcrs)
+    rows, cols = [], []
+
+    # 1-hot encode the V/J genes and length, and the bias term
+    vgene_index = {x:vgene_indexer.get(get_allele(x), NV-1) for x in set(vgenes)}
+    jgene_index = {x:jgene_indexer.get(get_allele(x), NJ-1) for x in set(jgenes)}
+    rows.extend([all_rows]*4)
+    cols.append( np.array([vgene_index[x] for x in vgenes], dtype=int) )
+    cols.append( NV + np.array([jgene_index[x] for x in jgenes], dtype=int) )
+    cols.append( NV + NJ + np.clip(lengths, min_lenbin, max_lenbin) - min_lenbin )
+    cols.append( np.full((num_tcrs,), NTOT) )
+
+    # 1-hot encode aas in the nterminal and cterminal cdr3 windows
+    # k-hot encode the middle of the tcr
+    nterm = np.minimum(window_size, lengths//2)
+    cterm = np.minimum(window_size, lengths-nterm)
+    aa_rows, aa_positions, aa_offsets = [], [], []
+    for i in range(window_size):
+        r = np.nonzero(i<nterm)[0]
+        aa_rows.append(r)
+        aa_positions.append(np.full(r.shape, i))
+        aa_offsets.append(np.full(r.shape, NV+NJ+NL+20*i))
+        r = np.nonzero(i<cterm)[0]
+        aa_rows.append(r)
+        aa_positions.append(lengths[r]-1-i)
+        aa_offsets.append(np.full(r.shape, NV+NJ+NL+20*window_size+20*i))
+    positions = np.arange(cdr3s.shape[1])[None,:]
+    r, pos = np.nonzero( (positions >= nterm[:,None]) & (positions < (lengths-cterm)[:,None]) )
+    aa_rows.append(r)
+    aa_positions.append(pos)
+    aa_offsets.append(np.full(r.shape, NV+NJ+NL+40*window_size))
+
+    aa_rows = np.concatenate(aa_rows)
+    aa_cols = aa_index_table[cdr3s[aa_rows, np.concatenate(aa_positions)]]
+    if np.any(aa_cols<0):
+        print('cd8_scoring.encode_single_chain_tcrs:: unrecognized amino acid in cdr3s')
+        sys.exit(1)
+    rows.append(aa_rows)
+    cols.append(np.concatenate(aa_offsets) + aa_cols)
+
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    # duplicate (row,col) pairs from the middle of the cdr3 are summed
+    return csr_matrix( (np.ones((rows.shape[0],)), (rows, cols)), shape=(num_tcrs, NTOT+1))
+
+
 def make_cd8_score_table_column(tcrs, use_sigmoid=False):
     ''' We fit a logistic regression model on single-chain bulk TCR data
     from sorted CD4/CD8 subsets. Here we just average the alpha-chain and beta-chain
@@ -138,18 +204,12 @@ def make_cd8_score_table_column(tcrs, use_sigmoid=False):
     score_totals = np.zeros((len(tcrs),))
     for iab, ab in enumerate('AB'):
         model = all_models[ab]
-        tcr_vectors = [ encode_single_chain_tcr(x[iab][0], x[iab][1], x[iab][2], model)
-                        for x in tcrs ]
-        tcr_vectors = np.vstack(tcr_vectors)
+        tcr_vectors = encode_single_chain_tcrs(
+            [x[iab][0] for x in tcrs], [x[iab][1] for x in tcrs], [x[iab][2] for x in tcrs], model)
         weights = model['weights']
         assert tcr_vectors.shape == (len(tcrs), weights.shape[0])
-        ab_scores = np.dot( tcr_vectors, weights)
+        ab_scores = tcr_vectors @ weights
         if use_sigmoid:
             ab_scores = 1.0/(1.0+np.exp(-1*ab_scores))
         score_totals += 0.5 * ab_scores
     return score_totals
-
-
-
-
-
@@ -1,7 +1,7 @@
 import numpy as np
 from scipy import stats
 from sklearn.metrics import pairwise_distances
-from scipy.stats import hypergeom, mannwhitneyu, linregress, norm
+from scipy.stats import hypergeom, linregress, norm
 #from scipy.sparse import issparse, csr_matrix
 import scipy.sparse as sps
 from collections import Counter, OrderedDict
@@ -9,11 +9,57 @@ import scanpy as sc
 from . import preprocess as pp
 from . import tcr_scoring
 from . import util
+from . import rank_tests
 from .tcrdist.all_genes import all_genes
 import sys
 import pandas as pd
 from sys import exit
-import time #debugging
+
+def nbrs_to_csr_matrix( nbrs, num_clones, include_self=False ):
+    ''' Returns a (num_clones,num_clones) sps.csr_matrix adjacency matrix with 1.0 at [ii,jj] if jj in nbrs[ii]
+
+    nbrs can be a 2D array or a list of (possibly different length) arrays/lists, eg if use_sym_nbrs
+    '''
+    if isinstance(nbrs, np.ndarray) and nbrs.ndim == 2:
+        num_nbrs = np.full((num_clones,), nbrs.shape[1])
+        indices = nbrs.ravel()
+    else:
+        num_nbrs = np.array([len(x) for x in nbrs], dtype=int)
+        indices = np.concatenate([np.asarray(x, dtype=int) for x in nbrs]) if num_clones else np.zeros((0,), dtype=int)
+    rows = np.repeat(np.arange(num_clones), num_nbrs)
+    if include_self:
+        rows = np.concatenate([rows, np.arange(num_clones)])
+        indices = np.concatenate([indices, np.arange(num_clones)])
+    A = sps.csr_matrix( (np.ones(rows.shape[0]), (rows, indices)), shape=(num_clones, num_clones))
+    A.sum_duplicates()
+    A.data[:] = 1.0 # eg self already in nbrs
+    return A
+
+
+def num_distinct_group_members_per_row( A, groups ):
+    ''' For each row of the sparse matrix A, the number of distinct values of groups over the nonzero columns
+    '''
+    A = sps.csr_matrix(A)
+    A.eliminate_zeros()
+    num_rows = A.shape[0]
+    rows = np.repeat(np.arange(num_rows), np.diff(A.indptr))
+    _, group_codes = np.unique(groups, return_inverse=True)
+    group_codes = group_codes.ravel()
+    num_groups = group_codes.max()+1 if group_codes.shape[0] else 1
+    row_groups = np.unique( rows * num_groups + group_codes[A.indices] ) # distinct (row,group) pairs
+    return np.bincount( row_groups // num_groups, minlength=num_rows)
+
+
+def same_group_counts( agroups, bgroups ):
+    ''' For each clone, the number of clones (including itself) with the same agroup or the same bgroup
+    '''
+    agroups, bgroups = np.asarray(agroups), np.asarray(bgroups)
+    _, ainv, acounts = np.unique(agroups, return_inverse=True, return_counts=True)
+    _, binv, bcounts = np.unique(bgroups, return_inverse=True, return_counts=True)
+    ainv, binv = ainv.ravel(), binv.ravel()
+    _, abinv, abcounts = np.unique( ainv * (binv.max()+1) + binv, return_inverse=True, return_counts=True)
+    return acounts[ainv] + bcounts[binv] - abcounts[abinv.ravel()]
+
 
 def find_neighbor_neighbor_interactions(
         adata,
@@ -32,72 +78,71 @@ def find_neighbor_neighbor_interactions(
 
     AND a numpy array of the adjusted_pvals
 
+    The gex and tcr nbr graphs are handled as sparse adjacency matrices, so the overlaps are the row sums
+    of their elementwise product, and the hypergeometric pvalues are computed for all clones at once
+
     '''
     pp.add_mait_info_to_adata_obs(adata) # for annotation of overlaps
-    is_mait = adata.obs['is_mait']
+    is_mait = np.array(adata.obs['is_mait'], dtype=float)
 
     num_clones = len(nbrs_gex)
 
     pval_rescale = num_clones if scale_pvals_by_num_clones else 1.0
 
-    results = []
-    adjusted_pvalues = [pval_rescale]*num_clones # initialize to big value
-
-    for ii in range(num_clones):
-        is_ii_group = (agroups==agroups[ii]) | (bgroups==bgroups[ii])
-        assert is_ii_group[ii]
-        actual_num_clones = num_clones - np.sum( is_ii_group ) - counts_correction
-
-        ii_nbrs_gex = nbrs_gex[ii] # might be slice of array, or list entry if use_sym_nbrs
-        ii_nbrs_tcr = nbrs_tcr[ii]
-        ii_nbrs_gex_set = frozenset( ii_nbrs_gex)
-        assert ii not in ii_nbrs_gex_set
+    A_gex = nbrs_to_csr_matrix(nbrs_gex, num_clones)
+    A_tcr = nbrs_to_csr_matrix(nbrs_tcr, num_clones)
+    assert not np.any(A_gex.diagonal())
 
-        num_neighbors_gex = len(ii_nbrs_gex)
-        num_neighbors_tcr = len(ii_nbrs_tcr)
+    # the clones in the same agroup or bgroup as ii (including ii) are excluded from the background
+    actual_num_clones = num_clones - same_group_counts(agroups, bgroups) - counts_correction
 
-        overlap = sum( 1 for x in ii_nbrs_tcr if x in ii_nbrs_gex_set )
-        expected_overlap = float( num_neighbors_gex*num_neighbors_tcr )/actual_num_clones
-        if overlap and overlap > expected_overlap:
-            nbr_pval = pval_rescale * hypergeom.sf( overlap-1, actual_num_clones, num_neighbors_gex, num_neighbors_tcr)
-        else:
-            nbr_pval = pval_rescale
+    num_neighbors_gex = np.diff(A_gex.indptr)
+    num_neighbors_tcr = np.diff(A_tcr.indptr)
 
-        if verbose:
-            print('nbr_overlap:', ii, overlap, nbr_pval)
+    A_double = A_gex.multiply(A_tcr).tocsr() # the double nbrs: nbrs in both graphs
+    A_double.eliminate_zeros()
+    overlap = np.diff(A_double.indptr)
+    expected_overlap = num_neighbors_gex * num_neighbors_tcr / actual_num_clones
 
-        adjusted_pvalues[ii] = nbr_pval
+    adjusted_pvalues = np.full((num_clones,), pval_rescale, dtype=float) # initialize to big value
+    mask = (overlap>0) & (overlap > expected_overlap)
+    adjusted_pvalues[mask] = pval_rescale * hypergeom.sf(
+        overlap[mask]-1, actual_num_clones[mask], num_neighbors_gex[mask], num_neighbors_tcr[mask])
 
-        if nbr_pval > pval_threshold:
-            continue ## NOTE
+    if verbose:
+        for ii in range(num_clones):
+            print('nbr_overlap:', ii, overlap[ii], adjusted_pvalues[ii])
 
-        double_nbrs = [ x for x in ii_nbrs_tcr if x in ii_nbrs_gex_set ]
-        assert overlap == len(double_nbrs)
+    overlap_corrected = overlap.copy()
+    if correct_overlaps_for_groups:
+        # count each agroup/bgroup only once among the double nbrs
+        overlap_corrected = np.minimum( num_distinct_group_members_per_row(A_double, agroups),
+                                        num_distinct_group_members_per_row(A_double, bgroups) )
+        delta = overlap - overlap_corrected
+        mask = (adjusted_pvalues <= pval_threshold) & (delta>0)
+        adjusted_pvalues[mask] = pval_rescale * hypergeom.sf(
+            overlap_corrected[mask]-1, actual_num_clones[mask], num_neighbors_gex[mask]-delta[mask],
+            num_neighbors_tcr[mask]-delta[mask])
 
-        if verbose:
-            print('nbr_overlap_nbrs:', ii, overlap, nbr_pval, double_nbrs)
+    hits = np.nonzero(adjusted_pvalues <= pval_threshold)[0]
 
-        overlap_corrected = overlap
-        if correct_overlaps_for_groups:
-            overlap_corrected = min( len(set(agroups[double_nbrs])), len(set(bgroups[double_nbrs])) )
+    if verbose:
+        for ii in hits:
+            print('nbr_overlap_nbrs:', ii, overlap[ii], adjusted_pvalues[ii],
+                  list(A_double.indices[A_double.indptr[ii]:A_double.indptr[ii+1]]))
 
-            if overlap_corrected < overlap:
-                delta = overlap-overlap_corrected
-                nbr_pval = pval_rescale * hypergeom.sf( overlap_corrected-1, actual_num_clones, num_neighbors_gex-delta,
-                                                        num_neighbors_tcr-delta)
-                adjusted_pvalues[ii] = nbr_pval # update
-                if nbr_pval > pval_threshold:
-                    continue ## NOTE
+    if hits.shape[0] == 0:
+        return pd.DataFrame([]), adjusted_pvalues
 
-        results.append( dict( conga_score=nbr_pval,
-                              num_neighbors_gex=num_neighbors_gex,
-                              num_neighbors_tcr=num_neighbors_tcr,
-                              overlap=overlap,
-                              overlap_corrected=overlap_corrected,
-                              mait_fraction=np.sum(is_mait[double_nbrs])/overlap,
-                              clone_index=ii ))#double_nbrs ] )
+    results = pd.DataFrame( dict( conga_score=adjusted_pvalues[hits],
+                                  num_neighbors_gex=num_neighbors_gex[hits],
+                                  num_neighbors_tcr=num_neighbors_tcr[hits],
+                                  overlap=overlap[hits],
+                                  overlap_corrected=overlap_corrected[hits],
+                                  mait_fraction=(A_double[hits] @ is_mait)/overlap[hits],
+                                  clone_index=hits ))
 
-    return pd.DataFrame(results), np.array(adjusted_pvalues)
+    return results, adjusted_pvalues
 
 
 def find_neighbor_cluster_interactions(
@@ -386,6 +431,37 @@ def get_split_mean_var( X, X_sq, mask, mean, mean_sq ):
 
 
 
+def nbrhood_split_mean_var_batches( A, X, X_sq, mean, mean_sq, batch_size ):
+    ''' Like get_split_mean_var, but for many nbrhoods at once
+
+    A is the (num_nbrhoods, num_clones) sparse 0/1 nbrhood indicator matrix (no explicit zeros), X is
+    (num_clones, num_features) sparse or dense. The fg sums are the sparse products A @ X and A @ X_sq, and the
+    bg stats come from the global means. Yields (start, stop, num_fg, mean_fg, var_fg, mean_bg, var_bg) for batches of batch_size
+    nbrhoods; the stats are dense (stop-start, num_features) arrays and num_fg has shape (stop-start, 1)
+    '''
+    A = sps.csr_matrix(A)
+    num_clones = A.shape[1]
+    assert X.shape[0] == num_clones
+    num_fg_all = A.getnnz(axis=1)
+
+    for start in range(0, A.shape[0], batch_size):
+        stop = min(A.shape[0], start+batch_size)
+        A_batch = A[start:stop]
+        num_fg = num_fg_all[start:stop][:,np.newaxis]
+        sums, sums_sq = A_batch @ X, A_batch @ X_sq
+        if sps.issparse(sums):
+            sums, sums_sq = sums.toarray(), sums_sq.toarray()
+        mean_fg = np.asarray(sums, dtype=float) / num_fg
+        mean_sq_fg = np.asarray(sums_sq, dtype=float) / num_fg
+        wt_fg = num_fg / num_clones
+        wt_bg = 1. - wt_fg
+        mean_bg = (mean[np.newaxis,:] - wt_fg*mean_fg)/wt_bg
+        mean_sq_bg = (mean_sq[np.newaxis,:] - wt_fg*mean_sq_fg)/wt_bg
+        var_fg = (mean_sq_fg - mean_fg**2)
+        var_bg = (mean_sq_bg - mean_bg**2)
+        yield start, stop, num_fg, mean_fg, var_fg, mean_bg, var_bg
+
+
 def gex_nbrhood_rank_tcr_scores(
         adata,
         nbrs_gex,
@@ -418,6 +494,10 @@ def gex_nbrhood_rank_tcr_scores(
     num_nonempty_nbrhoods = sum(1 for x in nbrs_gex if len(x)>0)
     pval_rescale = num_nonempty_nbrhoods * len(tcr_score_names)
 
+    # the MWU pvals for all the nbrhoods and scores at once (unadjusted)
+    A = nbrs_to_csr_matrix(nbrs_gex, num_clones, include_self=True)
+    all_mwu_pvals = rank_tests.nbrhood_mwu_pvalues(A, score_table, alternative='two-sided')
+
     nbrhood_mask = np.full( (num_clones,), False)
 
     results = []
@@ -452,9 +532,7 @@ def gex_nbrhood_rank_tcr_scores(
             if pval>ttest_pval_threshold_for_mwu_calc:
                 continue
 
-            _,mwu_pval = mannwhitneyu( score_table[:,ind][nbrhood_mask], score_table[:,ind][~nbrhood_mask],
-                                       alternative='two-sided')
-            mwu_pval_adj = mwu_pval * pval_rescale
+            mwu_pval_adj = all_mwu_pvals[ii,ind] * pval_rescale
 
             if min(pval, mwu_pval_adj) <= pval_threshold:
                 if nbrhood_clusters_gex is None: # lazy
@@ -508,12 +586,16 @@ def tcr_nbrhood_rank_genes_fast(
         prefix_tag='nbr',
         min_num_fg=3,
         clone_display_names=None,
-        ttest_pval_threshold_for_mwu_calc=None
+        ttest_pval_threshold_for_mwu_calc=None,
+        batch_size=None, # number of nbrhoods per t-test batch; None means choose based on the number of genes
 ):
     ''' Modeled on scanpy rank_genes_groups
     All pvals are crude bonferroni corrected for:
     * number of non-empty nbrhoods in nbrs_tcr and number of genes in adata.raw.X with at least 3 nonzero cells
       (see pval_rescale below)
+
+    The nbrhood means and variances are computed for batches of nbrhoods at once by sparse matrix products
+    (see nbrhood_split_mean_var_batches) and the t-test screening is vectorized over each batch
     '''
 
     ## unpack from adata
@@ -543,7 +625,7 @@ def tcr_nbrhood_rank_genes_fast(
     assert sps.issparse(X)
     assert X.shape[1] == len(genes)
 
-    X_csc = adata.raw.X.tocsc()
+    X_csc = adata.raw.X.tocsc(copy=True) # copy since eliminate_zeros below works in place
 
     X_sq = X.multiply(X)
 
@@ -577,119 +659,145 @@ def tcr_nbrhood_rank_genes_fast(
 
     # len(genes) is probably too hard since lots of the genes are all zeros
     min_nonzero_cells = 3
-    gene_nonzero_counts = Counter( X.nonzero()[1] )
-    bad_gene_mask = np.array([ gene_nonzero_counts[x] < min_nonzero_cells for x in range(len(genes)) ]+
-                             [False]*len(genes2))
+    X_csc.eliminate_zeros()
+    gene_nonzero_counts = np.diff(X_csc.indptr)
+    bad_gene_mask = np.hstack([ gene_nonzero_counts < min_nonzero_cells, np.full((len(genes2),), False) ])
     n_genes_eff = np.sum(~bad_gene_mask)
     pval_rescale = num_nonempty_nbrhoods * n_genes_eff
 
     results = []
 
     genes.extend(genes2) # since we are hstacking the vars, etc
-    reference_indices = np.arange(len(genes), dtype=int)
+    num_genes = len(genes)
 
-    for ii in range(num_clones):
-        if len(nbrs_tcr[ii])==0:
-            continue
-        nbrhood_mask = np.full( (num_clones,), False)
-        nbrhood_mask[ nbrs_tcr[ii] ] = True
-        nbrhood_mask[ ii ] = True
+    # nbrhood indicator matrix, one row per nbrhood (nbrs plus the clone itself)
+    A = nbrs_to_csr_matrix(nbrs_tcr, num_clones, include_self=True)
+    nbrhood_sizes = np.array([len(x) for x in nbrs_tcr])
+    clone_indices = np.nonzero( (nbrhood_sizes>0) & (np.diff(A.indptr) >= min_num_fg) )[0]
+    A = A[clone_indices]
 
-        mean_fg, var_fg, mean_bg, var_bg = get_split_mean_var(X, X_sq, nbrhood_mask, mean, mean_sq)
-        mean2_fg, var2_fg, mean2_bg, var2_bg = get_split_mean_var(X2, X2_sq, nbrhood_mask, mean2, mean2_sq)
+    X_all = sps.hstack([X, sps.csr_matrix(X2)]).tocsr()
+    X_all_sq = X_all.multiply(X_all).tocsr()
+    mean_all = np.hstack([mean, mean2])
+    mean_sq_all = np.hstack([mean_sq, mean2_sq])
 
-        num_fg = np.sum(nbrhood_mask)
-        if num_fg < min_num_fg:
-            continue
-        mean_fg = np.hstack([mean_fg, mean2_fg])
-        mean_bg = np.hstack([mean_bg, mean2_bg]) # note that we dont do the variances...
-        scores, pvals = stats.ttest_ind_from_stats(
-            mean1=mean_fg, std1=np.sqrt(np.maximum(np.hstack([var_fg, var2_fg]), 1e-12)), nobs1=num_fg,
-            mean2=mean_bg, std2=np.sqrt(np.maximum(np.hstack([var_bg, var2_fg]), 1e-12)), nobs2=num_clones-num_fg,
-            equal_var=False  # Welch's
-        )
-
-        # scanpy code:
-        scores[np.isnan(scores)] = 0.
-        pvals [np.isnan(pvals)] = 1.
-        pvals [bad_gene_mask] = 1.
-        logfoldchanges = np.log2((np.expm1(mean_fg) + 1e-9) / (np.expm1(mean_bg) + 1e-9))
+    if batch_size is None: # keep the dense (nbrhoods,genes) arrays to ~16M entries
+        batch_size = max(1, 2**24 // num_genes)
 
-        pvals_adj = pvals * pval_rescale
+    # rank the genes once for the MWU tests
+    feature_ranks = rank_tests.rank_features(X_all)
 
-        scores_sort = np.abs(scores) if rankby_abs else scores
-        partition = np.argpartition(scores_sort, -top_n)[-top_n:]
-        partial_indices = np.argsort(scores_sort[partition])[::-1]
-        global_indices = reference_indices[partition][partial_indices]
+    for start, stop, num_fg_batch, mean_fg_batch, var_fg_batch, mean_bg_batch, var_bg_batch in \
+        nbrhood_split_mean_var_batches( A, X_all, X_all_sq, mean_all, mean_sq_all, batch_size ):
 
-        nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None
+        # note that we dont do the variances for the extra fake genes, the bg variance is the fg variance
+        var_bg_batch[:,num_real_genes:] = var_fg_batch[:,num_real_genes:]
 
-        for igene, ind in enumerate(global_indices):
-            gene = genes[ind]
-            if util.is_vdj_gene(gene, organism, include_constant_regions=True):
-                continue
-            pval_adj = pvals_adj[ind]
-            log2fold= logfoldchanges[ind]
+        scores_batch, pvals_batch = stats.ttest_ind_from_stats(
+            mean1=mean_fg_batch, std1=np.sqrt(np.maximum(var_fg_batch, 1e-12)), nobs1=num_fg_batch,
+            mean2=mean_bg_batch, std2=np.sqrt(np.maximum(var_bg_batch, 1e-12)), nobs2=num_clones-num_fg_batch,
+            equal_var=False  # Welch's
+        )
 
-            if pval_adj > ttest_pval_threshold_for_mwu_calc:
-                continue
+        # scanpy code:
+        scores_batch[np.isnan(scores_batch)] = 0.
+        pvals_batch [np.isnan(pvals_batch)] = 1.
+        pvals_batch [:,bad_gene_mask] = 1.
+        logfoldchanges_batch = np.log2((np.expm1(mean_fg_batch) + 1e-9) / (np.expm1(mean_bg_batch) + 1e-9))
+
+        pvals_adj_batch = pvals_batch * pval_rescale
+
+        scores_sort = np.abs(scores_batch) if rankby_abs else scores_batch
+        partition = np.argpartition(scores_sort, -top_n, axis=1)[:,-top_n:]
+        partial_indices = np.argsort(np.take_along_axis(scores_sort, partition, axis=1), axis=1)[:,::-1]
+        global_indices_batch = np.take_along_axis(partition, partial_indices, axis=1)
+
+        # MWU pvals for all the candidate (nbrhood,gene) pairs in this batch at once
+        is_candidate = ( np.take_along_axis(pvals_adj_batch, global_indices_batch, axis=1) <=
+                         ttest_pval_threshold_for_mwu_calc )
+        candidate_rows, candidate_cols = np.nonzero(is_candidate)
+        candidate_genes = global_indices_batch[candidate_rows, candidate_cols]
+        candidate_mwu_pvals = rank_tests.nbrhood_mwu_pvalues_for_pairs(
+            A, start+candidate_rows, candidate_genes, feature_ranks, alternative='greater')
+        mwu_pvals_batch = dict(zip(zip(candidate_rows, candidate_genes), candidate_mwu_pvals))
+
+        for ibatch in range(stop-start):
+            if not np.any(is_candidate[ibatch]):
+                continue # nothing to look at
+
+            ii = clone_indices[start+ibatch]
+            num_fg = num_fg_batch[ibatch,0]
+            mean_fg, mean_bg = mean_fg_batch[ibatch], mean_bg_batch[ibatch]
+            pvals_adj, logfoldchanges = pvals_adj_batch[ibatch], logfoldchanges_batch[ibatch]
+
+            nbrhood_mask = np.full( (num_clones,), False)
+            nbrhood_mask[ A.indices[A.indptr[start+ibatch]:A.indptr[start+ibatch+1]] ] = True
+
+            nbrhood_clusters_gex, nbrhood_clusters_tcr = None,None
+
+            for igene, ind in enumerate(global_indices_batch[ibatch]):
+                gene = genes[ind]
+                if util.is_vdj_gene(gene, organism, include_constant_regions=True):
+                    continue
+                pval_adj = pvals_adj[ind]
+                log2fold= logfoldchanges[ind]
 
-            is_real_gene = ind < num_real_genes
-            # here we are looking for genes (or clone_sizes/inverted nndists) that are LARGER in the forground (fg)
-            if is_real_gene:
-                col = X_csc[:,ind][nbrhood_mask]
-                noncol = X_csc[:,ind][~nbrhood_mask]
-                _, mwu_pval = mannwhitneyu( col.todense(), noncol.todense(), alternative='greater' )
-            else:
-                col = X2[:,ind-num_real_genes][nbrhood_mask]
-                noncol = X2[:,ind-num_real_genes][~nbrhood_mask]
-                _, mwu_pval = mannwhitneyu(col, noncol, alternative='greater')
-            mwu_pval_adj = mwu_pval * pval_rescale
-
-            if min(mwu_pval_adj, pval_adj) < pval_threshold:
-                if nbrhood_clusters_gex is None: # lazy
-                    nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
-                    nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
-                    nbrhood_is_mait = is_mait[nbrhood_mask]
+                if pval_adj > ttest_pval_threshold_for_mwu_calc:
+                    continue
 
+                is_real_gene = ind < num_real_genes
+                # here we are looking for genes (or clone_sizes/inverted nndists) that are LARGER in the forground (fg)
+                mwu_pval_adj = mwu_pvals_batch[(ibatch,ind)] * pval_rescale
 
-                # better annotation of the enriched tcrs...
-                num_top = num_fg//4
-                if is_real_gene: # col is sparse...
-                    if len(col.data)>num_top: # more than a quarter non-zero
-                        top_indices = col.indices[ np.argpartition(col.data, -num_top)[-num_top:] ]
-                        #bot_indices = col.indices[ np.argpartition(col.data, num_top-1)[:num_top] ]
-                        #assert np.mean(col[top_indices]) > np.mean(col[bot_indices])
+                if min(mwu_pval_adj, pval_adj) < pval_threshold:
+                    if is_real_gene:
+                        col = X_csc[:,ind][nbrhood_mask]
                     else:
-                        top_indices = col.indices
-                else:
-                    top_indices = np.argpartition(col, -num_top)[-num_top:]
-
-                #top_indices = np.nonzero(nbrhood_mask)[0][col_top_inds]
-
-                gex_cluster = Counter( nbrhood_clusters_gex[ top_indices ]).most_common(1)[0][0]
-                tcr_cluster = Counter( nbrhood_clusters_tcr[ top_indices ]).most_common(1)[0][0]
-                mait_fraction = np.sum(nbrhood_is_mait[ top_indices ] )/len(top_indices)
-
-
-                if verbose and mwu_pval_adj<=pval_threshold:
-                    print('tcr_{}_gene: {:9.2e} {:9.2e} {:7.3f} clp {:2d} {:2d} {:8s} {:.4f} {:.4f} {:4d} {} mf: {:.3f} {} {}'\
-                          .format( prefix_tag, pval_adj, mwu_pval_adj, log2fold, gex_cluster, tcr_cluster, gene,
-                                   mean_fg[ind], mean_bg[ind], num_fg, clone_display_names[ii], mait_fraction,
-                                   ii, igene ))
-                results.append( dict(ttest_pvalue_adj=pval_adj,
-                                     mwu_pvalue_adj=mwu_pval_adj,
-                                     log2enr=log2fold,
-                                     gex_cluster=gex_cluster,
-                                     tcr_cluster=tcr_cluster,
-                                     feature=gene,
-                                     mean_fg=mean_fg[ind],
-                                     mean_bg=mean_bg[ind],
-                                     num_fg=num_fg,
-                                     clone_index=ii,
-                                     mait_fraction=mait_fraction ) )
+                        col = X2[:,ind-num_real_genes][nbrhood_mask]
+
+                    if nbrhood_clusters_gex is None: # lazy
+                        nbrhood_clusters_gex = clusters_gex[nbrhood_mask]
+                        nbrhood_clusters_tcr = clusters_tcr[nbrhood_mask]
+                        nbrhood_is_mait = is_mait[nbrhood_mask]
+
+
+                    # better annotation of the enriched tcrs...
+                    num_top = num_fg//4
+                    if is_real_gene: # col is sparse...
+                        if len(col.data)>num_top: # more than a quarter non-zero
+                            top_indices = col.indices[ np.argpartition(col.data, -num_top)[-num_top:] ]
+                            #bot_indices = col.indices[ np.argpartition(col.data, num_top-1)[:num_top] ]
+                            #assert np.mean(col[top_indices]) > np.mean(col[bot_indices])
+                        else:
+                            top_indices = col.indices
+                    else:
+                        top_indices = np.argpartition(col, -num_top)[-num_top:]
+
+                    #top_indices = np.nonzero(nbrhood_mask)[0][col_top_inds]
+
+                    gex_cluster = Counter( nbrhood_clusters_gex[ top_indices ]).most_common(1)[0][0]
+                    tcr_cluster = Counter( nbrhood_clusters_tcr[ top_indices ]).most_common(1)[0][0]
+                    mait_fraction = np.sum(nbrhood_is_mait[ top_indices ] )/len(top_indices)
+
+
+                    if verbose and mwu_pval_adj<=pval_threshold:
+                        print('tcr_{}_gene: {:9.2e} {:9.2e} {:7.3f} clp {:2d} {:2d} {:8s} {:.4f} {:.4f} {:4d} {} mf: {:.3f} {} {}'\
+                              .format( prefix_tag, pval_adj, mwu_pval_adj, log2fold, gex_cluster, tcr_cluster, gene,
+                                       mean_fg[ind], mean_bg[ind], num_fg, clone_display_names[ii], mait_fraction,
+                                       ii, igene ))
+                    results.append( dict(ttest_pvalue_adj=pval_adj,
+                                         mwu_pvalue_adj=mwu_pval_adj,
+                                         log2enr=log2fold,
+                                         gex_cluster=gex_cluster,
+                                         tcr_cluster=tcr_cluster,
+                                         feature=gene,
+                                         mean_fg=mean_fg[ind],
+                                         mean_bg=mean_bg[ind],
+                                         num_fg=num_fg,
+                                         clone_index=ii,
+                                         mait_fraction=mait_fraction ) )
 
-        sys.stdout.flush()
+            sys.stdout.flush()
 
     return pd.DataFrame(results)
 
@@ -858,6 +966,9 @@ def find_hotspot_features(
 
     pvalues are crude bonferroni corrected
 
+    The nbr graph is handled as a sparse weight matrix W, so the H statistics for all the features come from a
+    couple of sparse products rather than a loop over clones
+
     """
     print('START computing H matrix', type(X)) # we want this to be a sps.csr_matrix since we are working with rows...
     assert type(X) is sps.csr_matrix # right now anyhow; not a strict requirement
@@ -873,41 +984,24 @@ def find_hotspot_features(
     X_mean_sq = X_mean**2
     X_var = X_sq_mean - X_mean_sq
 
-    H = sps.csr_matrix( np.zeros((num_features,)) )
-    indegrees = np.zeros((num_clones,))
+    # the nbr graph as a sparse weight matrix: W[ii,jj] = 1 if jj in nbrs[ii]
+    W = nbrs_to_csr_matrix(nbrs, num_clones)
+    indegrees = np.asarray(W.sum(axis=0)).ravel()
 
-    last_time = time.time()
-    for ii in range(num_clones):
-        if ii%500==0:
-            elapsed_time = time.time() - last_time
-            if ii:
-                rate = 10*elapsed_time
-            else:
-                rate = 0
-            print(f'computing H matrix {ii:6d} {num_clones:6d} {rate:12.6f}')
-            sys.stdout.flush()
-            last_time = time.time()
-        X_ii = X[ii,:]
-        ii_nbrs = nbrs[ii]
-        if len(ii_nbrs)==0:
-            continue
-        indegrees[ii_nbrs] += 1
-        H += X_ii.multiply( X[ii_nbrs,:].sum(axis=0) )
+    # H[f] = sum_ii X[ii,f] * sum_{jj in nbrs[ii]} X[jj,f], ie the diagonal of X.T @ W @ X
+    # W @ X can be much denser than X (eg if X is itself a nbrhood indicator matrix), so accumulate it
+    #  over blocks of rows, with each block's product limited to about max_block_size entries
+    max_block_size = 2**22
+    block_size = max(1, max_block_size // max(1, num_features))
+    H = np.zeros((num_features,))
+    for start in range(0, num_clones, block_size):
+        stop = min(num_clones, start+block_size)
+        H += np.asarray( X[start:stop].multiply( W[start:stop] @ X ).sum(axis=0) ).ravel()
 
-    # multiply the indegree matrix by the raw X matrix by the means
-    indegrees_mat = sps.csr_matrix( indegrees[:, np.newaxis] )
-    assert indegrees_mat.shape == (num_clones,1)
+    # minus sum_jj indegree[jj] * X[jj,f] * mean[f]
+    Y = (indegrees @ X) * X_mean
 
-    X_mean_mat = sps.csr_matrix( X_mean )
-    assert X_mean_mat.shape == (1, num_features)
-
-    Y = X.multiply( indegrees_mat ).multiply( X_mean_mat ).sum(axis=0)
-
-    assert H.shape == Y.shape
-
-    # Y is a numpy.matrix
-    #
-    H = (H-Y).A1
+    H = H-Y
     mask1 = (H==0)
     mask2 = (X_var==0)
     mask3 = mask2 & (~mask1) # H nonzero but stddev 0
@@ -919,27 +1013,24 @@ def find_hotspot_features(
 
     inds = np.argsort(H)[::-1] # decreasing
 
-    # the simple estimate for the variance of H is the total number of neighbors
-    # compute the variance
-    nbrs_sets = []
-    for ii in range(num_clones):
-        nbrs_sets.append( frozenset(nbrs[ii]) )
-
-    H_var = 0
+    # the simple estimate for the variance of H is the total number of neighbors, where reciprocal
+    #  nbr pairs count twice (once for each direction)
     print('compute H_var')
-    for ii in range(num_clones):
-        for jj in nbrs[ii]:
-            if ii in nbrs_sets[jj]:
-                H_var += 2
-            else:
-                H_var += 1
+    H_var = W.sum() + W.multiply(W.T).sum()
 
     H /= np.sqrt(H_var)
 
+    # two-pass std for each feature, for the sanity check below
+    X_csc = X.tocsc()
+    X_csc_cols = np.repeat(np.arange(num_features), np.diff(X_csc.indptr))
+    true_var = ( np.bincount(X_csc_cols, weights=(X_csc.data - X_mean[X_csc_cols])**2, minlength=num_features) +
+                 (num_clones - np.diff(X_csc.indptr)) * X_mean_sq ) / num_clones
+    true_stds = np.sqrt(np.maximum(0., true_var))
+
     results = []
     for ind in inds:
         feature = features[ind]
-        true_std = np.std(X[:,ind].toarray()[:,0])
+        true_std = true_stds[ind]
         if true_std<1e-6:
             print('WHOAH var prob? {} {} =?= {}'.format(feature, X_var[ind], true_std**2))
             continue
@@ -1070,15 +1161,6 @@ def find_hotspot_nbrhoods(
     clusters_tcr = np.array(adata.obs['clusters_tcr'])
     nbrs_gex_clusters = setup_fake_nbrs_from_clusters_for_graph_vs_features_analysis( clusters_gex )
     nbrs_tcr_clusters = setup_fake_nbrs_from_clusters_for_graph_vs_features_analysis( clusters_tcr )
-    # create csr_matrix
-    # >>> row = np.array([0, 0, 1, 2, 2, 2])
-    # >>> col = np.array([0, 2, 2, 0, 1, 2])
-    # >>> data = np.array([1, 2, 3, 4, 5, 6])
-    # >>> csr_matrix((data, (row, col)), shape=(3, 3)).toarray()
-    # array([[1, 0, 2],
-    #        [0, 0, 3],
-    #        [4, 5, 6]])
-
     num_clones = adata.shape[0]
 
     dfl = []
@@ -1089,16 +1171,7 @@ def find_hotspot_nbrhoods(
         if graph_tag == 'clust' and not also_use_cluster_graphs:
             continue
 
-        rows = [] # list of (1,num_clones) csr_matrix'es
-        for ii in range(num_clones):
-            ii_nbrs = feature_nbrs[ii]
-            num_nbrs = len(ii_nbrs)
-            data = np.full((num_nbrs,),1.0)
-            row_ind = np.full((num_nbrs,),0).astype(int)
-            new_row = sps.csr_matrix((data, (row_ind, ii_nbrs)), shape=(1,num_clones))
-            new_row[0,ii] = 1.
-            rows.append(new_row)
-        X = sps.vstack(rows)
+        X = nbrs_to_csr_matrix(feature_nbrs, num_clones, include_self=True)
         assert X.shape == (num_clones, num_clones)
         # find_hotspot_features expects X to look like the GEX matrix, ie
         #  shape=(num_clones,num_features) ie the features are the columns
@@ -1220,6 +1293,10 @@ def find_batch_biases(
 
                 zscores = (bfreqs_nbr_avged - bfreqs_mean[np.newaxis,:])/bfreqs_std[np.newaxis,:]
 
+                # MWU pvals for all the nbrhoods and batch choices at once (unadjusted)
+                A = nbrs_to_csr_matrix(nbrs, num_clones, include_self=True)
+                all_mwu_pvals = rank_tests.nbrhood_mwu_pvalues(A, bfreqs, alternative='greater')
+
                 for ib in range(num_choices):
                     if bfreqs_std[ib] < 1e-6:
                         continue # no variation at this choice
@@ -1232,9 +1309,7 @@ def find_batch_biases(
                         nbrs_mask[nbrs[ii]] = True
                         nbrs_mask[ii] = True
                         non_nbr_scores = bfreqs[:,ib][~nbrs_mask]
-                        _,mwu_pval1 = mannwhitneyu( nbr_scores, non_nbr_scores, alternative='greater')
-                        #_,mwu_pval2 = mannwhitneyu( nbr_scores, non_nbr_scores, alternative='less')
-                        mwu_pval1 *= num_clones
+                        mwu_pval1 = all_mwu_pvals[ii,ib] * num_clones
                         if mwu_pval1 < pval_threshold:
                             is_significant[ii] = True
                             nbrhood_results.append( OrderedDict(
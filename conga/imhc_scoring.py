@@ -1,12 +1,15 @@
 from os.path import exists
 from pathlib import Path
+import sys
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix, hstack
 from . import util
 
 
 amino_acids = ['A', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'K', 'L', \
                'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'V', 'W', 'Y']
+aa_index_table = util.ascii_to_index_table(amino_acids)
 
 imhc_model_file = Path.joinpath( Path(util.path_to_data),'logreg_hobit_donor1_v4.tsv_0_model.tsv')
 assert exists(imhc_model_file)
@@ -52,30 +55,82 @@ def get_feature(tcr, ftag, aa_props_df):
         return sum( get_cdr3_aa_prop_length_fraction(x, aa_props_df[ftag] ) for x in cdr3s)
     return None
 
+def _trimmed_cdr3_aa_counts(cdr3s):
+    ''' returns (counts, lengths) for the cdr3s trimmed to [4:-4] as in get_feature
+
+    counts is a sparse matrix of shape (len(cdr3s), 20) with the amino acid counts, lengths are the trimmed lengths
+    '''
+    cdr3s, lengths = util.encode_strings_as_padded_array(cdr3s)
+    trim_start, trim_stop = 4, 4
+    positions = np.arange(cdr3s.shape[1])[None,:]
+    rows, pos = np.nonzero( (positions >= trim_start) & (positions < (lengths-trim_stop)[:,None]) )
+    aas = aa_index_table[cdr3s[rows, pos]]
+    if np.any(aas<0):
+        print('imhc_scoring:: unrecognized amino acid in cdr3s')
+        sys.exit(1)
+    counts = csr_matrix( (np.ones((rows.shape[0],)), (rows, aas)), shape=(cdr3s.shape[0], 20))
+    return counts, np.maximum(0, lengths-trim_start-trim_stop)
+
+def make_imhc_feature_table(tcrs, aa_props_df):
+    ''' batched version of get_feature for all the features in imhc_model_df
+
+    returns an array of shape (len(tcrs), imhc_model_df.shape[0])
+    '''
+    # the features are linear in the alpha and beta aa counts (possibly normalized by length), so they can all
+    # be computed with sparse-dense products against the (2*20, num_features) weights matrices
+    features = list(imhc_model_df.index)
+    counts_a, lengths_a = _trimmed_cdr3_aa_counts([x[0][2] for x in tcrs])
+    counts_b, lengths_b = _trimmed_cdr3_aa_counts([x[1][2] for x in tcrs])
+    counts = hstack([counts_a, counts_b], format='csr')
+    # for the aa-property features, which average over each cdr3 separately
+    normed_counts = hstack([ counts_a.multiply(1.0/np.maximum(1, lengths_a)[:,None]),
+                             counts_b.multiply(1.0/np.maximum(1, lengths_b)[:,None]) ], format='csr')
+
+    counts_weights = np.zeros((40, len(features)))
+    normed_counts_weights = np.zeros((40, len(features)))
+    cdr3lens = np.zeros((len(tcrs), len(features)))
+    frac_mask = np.zeros((len(features),), dtype=bool)
+    for ii, feature in enumerate(features):
+        ftag, chains = '_'.join(feature.split('_')[:-1]), feature.split('_')[-1]
+        assert chains in ['A', 'B', 'AB']
+        chain_offsets = [ 20*i for i,ab in enumerate('AB') if ab in chains ]
+        cdr3lens[:,ii] = ( ('A' in chains) * lengths_a + ('B' in chains) * lengths_b )
+        if ftag == 'len':
+            continue
+        elif ftag[0] in amino_acids and ftag[1:] == 'frac':
+            frac_mask[ii] = True
+            for offset in chain_offsets:
+                counts_weights[offset+amino_acids.index(ftag[0]), ii] = 1.0
+        elif ftag == 'arofrac':
+            frac_mask[ii] = True
+            for offset in chain_offsets:
+                for aa in 'FYWH':
+                    counts_weights[offset+amino_acids.index(aa), ii] = 1.0
+        else:
+            props = aa_props_df[ftag]
+            for offset in chain_offsets:
+                normed_counts_weights[offset:offset+20, ii] = [props[aa] for aa in amino_acids]
+
+    len_mask = np.array([ x.startswith('len_') for x in features ])
+    frac_norm = 1.0 / np.maximum(1, cdr3lens)
+    table = ( np.asarray(counts @ counts_weights) * np.where(frac_mask, frac_norm, 0.0) +
+              np.asarray(normed_counts @ normed_counts_weights) +
+              np.where(len_mask, cdr3lens, 0.0) )
+    assert table.shape == (len(tcrs), len(features))
+    return table
+
 def make_imhc_score_table_column(tcrs, aa_props_df):
-    scores = np.zeros((len(tcrs),))
-    for row in imhc_model_df.itertuples():
-        col = np.array( [ get_feature(x, row.Index, aa_props_df) for x in tcrs] )
-        col = row.coef * (col - row.mean)/np.sqrt(row.var)
-        scores += col
-        intercept = row.intercept # all the same
-    scores += intercept
-    return scores
+    table = make_imhc_feature_table(tcrs, aa_props_df)
+    means, variances, coefs = [ np.array(imhc_model_df[x]) for x in ['mean', 'var', 'coef'] ]
+    intercept = imhc_model_df['intercept'].iloc[-1] # all the same
+    return ( (table - means)/np.sqrt(variances) ) @ coefs + intercept
 
 def get_imhc_raw_score_terms_and_coefs(tcrs, aa_props_df):
     ''' Just for diagnostics/visualization
     '''
-    cols = []
-    features = []
-    coefs = []
-    for row in imhc_model_df.itertuples():
-        col = np.array( [ get_feature(x, row.Index, aa_props_df) for x in tcrs] )
-        cols.append(  (col - row.mean)/np.sqrt(row.var) )
-        coefs.append(row.coef)
-        features.append(row.Index)
-
-    return np.array(cols).transpose(), features, coefs
-
-
-
+    table = make_imhc_feature_table(tcrs, aa_props_df)
+    means, variances = np.array(imhc_model_df['mean']), np.array(imhc_model_df['var'])
+    features = list(imhc_model_df.index)
+    coefs = list(imhc_model_df['coef'])
 
+    return (table - means)/np.sqrt(variances), features, coefs
@@ -10,6 +10,7 @@ import pandas as pd
 import math
 from sklearn.decomposition import PCA
 from . import svg_basic
+from .convert_svg_to_png import convert_svg_to_png
 from . import util
 from . import preprocess
 from . import pmhc_scoring
@@ -21,6 +22,9 @@ from .tcrdist.util import assign_colors_to_conga_tcrs
 from .tcrdist.all_genes import all_genes
 from .tcrdist.make_tcr_trees import make_tcr_tree_svg_commands
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os.path import exists
 from collections import Counter, OrderedDict
 import matplotlib.image as mpimg
@@ -217,6 +221,34 @@ def _parse_bicluster_rank_genes( adata, uns_tag = 'rank_genes_good_biclusters' )
 
 
 
+def _rasterize_svg_file( svgfile, keep_png=False ):
+    ''' returns the image array for svgfile
+
+    the png is made in a temporary directory, unless keep_png is True, in which case it goes next to the svgfile
+    '''
+    if keep_png:
+        pngfile = svgfile[:-3]+'png'
+        convert_svg_to_png(svgfile, pngfile)
+        return mpimg.imread(pngfile)
+    with tempfile.TemporaryDirectory(prefix='conga_logo_') as tmpdir:
+        pngfile = os.path.join(tmpdir, 'logo.png')
+        convert_svg_to_png(svgfile, pngfile)
+        return mpimg.imread(pngfile)
+
+def rasterize_svg_files( svgfiles, num_processes=1, keep_pngs=False ):
+    ''' returns a list of image arrays, one for each svgfile
+
+    the svg-to-png conversions shell out to convert/inkscape/rsvg, so running them from a pool of
+    num_processes threads keeps that many converter processes going at once
+    '''
+    rasterize = partial(_rasterize_svg_file, keep_png=keep_pngs)
+    if num_processes > 1 and len(svgfiles) > 1:
+        with ThreadPoolExecutor(max_workers=num_processes) as executor:
+            return list(executor.map(rasterize, svgfiles))
+    else:
+        return [ rasterize(x) for x in svgfiles ]
+
+
 def make_logo_plots(
         adata,
         nbrs_gex,
@@ -252,6 +284,7 @@ def make_logo_plots(
         make_gex_header_nbrZ=True,
         gex_header_tcr_score_names = ['imhc', 'cdr3len', 'cd8', 'nndists_tcr'], # was alphadist
         include_full_tcr_cluster_names_in_logo_lines=False,
+        logo_processes = 1, # number of processes for rasterizing the logo svgs, see rasterize_svg_files
 
 ):
     ''' need:
@@ -912,7 +945,48 @@ def make_logo_plots(
     else:
         leaves = []
 
-    tmpfiles = []
+    # make all the logo svgs up front, then rasterize them in parallel
+    logo_svgfiles = {} # (clp, tag) -> svgfile
+    for iclp in leaves:
+        clp = clps[iclp]
+        nodes = cluspair2nodes[clp]
+        if all_ranks is not None:
+            clp_rank_genes = all_ranks[clp]
+            for r in range(3):
+                svgfile = '{}.tmp_{}_{}_{}.svg'.format(logo_pngfile, clp[0], clp[1], r)
+                start_rank, stop_rank = 3*r, 3*r+3
+                if len(clp_rank_genes) > start_rank and clp_rank_genes[start_rank][2] < 0.99:
+                    # if none of the pvals are better than 1 then we get an all white image--> black box (?)
+                    make_single_rank_genes_logo( clp_rank_genes[start_rank:stop_rank], svgfile,
+                                                 logo_width=800, logo_max_height=1000, top_pval_for_max_height=1e-6,
+                                                 create_png=False)
+                    logo_svgfiles[clp, r] = svgfile
+
+        for ab in 'AB':
+            pngfile = '{}_tmp_{}_{}_{}.png'.format(logo_pngfile, clp[0], clp[1], ab)
+            make_tcr_logo_for_tcrs( [ tcrs[x] for x in nodes ], ab, organism, pngfile,
+                                    tcrdist_calculator=tcrdist_calculator, create_png=False )
+            logo_svgfiles[clp, ab] = pngfile[:-3]+'svg'
+
+        if good_bicluster_tcr_scores is not None:
+            clp_rank_scores = good_bicluster_tcr_scores[clp]
+            if DONT_SHOW_LOW_MAIT_SCORES:
+                clp_rank_scores = [ x for x in clp_rank_scores if x[0] != 'mait' or x[1]>0 ]
+            if not include_alphadist_in_tcr_feature_logos:
+                clp_rank_scores = [ x for x in clp_rank_scores if x[0] != 'alphadist' ]
+            svgfile = '{}.tmpsc_{}_{}.svg'.format(logo_pngfile, clp[0], clp[1])
+            if len(clp_rank_scores):
+                make_single_rank_genes_logo( clp_rank_scores[:3], svgfile,
+                                             logo_width=900, logo_max_height=1000, top_pval_for_max_height=1e-6,
+                                             signcolors=True, create_png=False)
+                logo_svgfiles[clp, 'scores'] = svgfile
+
+    print('rasterizing', len(logo_svgfiles), 'logos with', logo_processes, 'processes')
+    logo_images = dict(zip(logo_svgfiles.keys(),
+                           rasterize_svg_files(list(logo_svgfiles.values()), num_processes=logo_processes,
+                                               keep_pngs=nocleanup)))
+    tmpfiles = [ x[:-3]+'png' for x in logo_svgfiles.values() ]
+
     for irow, iclp in enumerate(leaves):
         first_row = ( irow == 0)
         last_row = ( irow == len(leaves)-1 )
@@ -1012,20 +1086,12 @@ def make_logo_plots(
 
         # make the rank genes logo
         if all_ranks is not None:
-            clp_rank_genes = all_ranks[clp]
             for r in range(3):
-                pngfile = '{}.tmp_{}_{}_{}.png'.format(logo_pngfile, clp[0], clp[1], r)
-                start_rank, stop_rank = 3*r, 3*r+3
                 left = (margin+dendro_width+title_logo_width+batch_bars_width+r*0.333*rg_logo_width)/fig_width
                 width = 0.333*rg_logo_width/fig_width
                 plt.axes( [left,bottom,width,height] )
-                if len(clp_rank_genes) > start_rank and clp_rank_genes[start_rank][2] < 0.99:
-                    # if none of the pvals are better than 1 then we get an all white image--> black box (?)
-                    make_single_rank_genes_logo( clp_rank_genes[start_rank:stop_rank], pngfile[:-3]+'svg',
-                                                 logo_width=800, logo_max_height=1000, top_pval_for_max_height=1e-6)
-
-                    image = mpimg.imread(pngfile)
-                    tmpfiles.append(pngfile)
+                if (clp, r) in logo_images:
+                    image = logo_images[clp, r]
                     plt.imshow(image, cmap='Greys_r')
                     xmn,xmx = plt.xlim()
                     ymn,ymx = plt.ylim()
@@ -1049,14 +1115,7 @@ def make_logo_plots(
 
             plt.axes( [left,bottom,width,height] )
 
-            pngfile = '{}_tmp_{}_{}_{}.png'.format(logo_pngfile, clp[0], clp[1], ab)
-            tmpfiles.append(pngfile)
-            # if 1: # old way
-            #     old_make_tcr_logo( [ tcrs[x] for x in nodes ], ab, organism, pngfile )
-            # else: # new way
-            make_tcr_logo_for_tcrs( [ tcrs[x] for x in nodes ], ab, organism, pngfile,
-                                    tcrdist_calculator=tcrdist_calculator )
-            image = mpimg.imread(pngfile)
+            image = logo_images[clp, ab]
             plt.imshow(image)
             plt.axis('off')
             if last_row:
@@ -1067,24 +1126,12 @@ def make_logo_plots(
 
         # make the tcr_scores logo
         if good_bicluster_tcr_scores is not None:
-            clp_rank_scores = good_bicluster_tcr_scores[clp]
-            if DONT_SHOW_LOW_MAIT_SCORES:
-                clp_rank_scores = [ x for x in clp_rank_scores if x[0] != 'mait' or x[1]>0 ]
-            if not include_alphadist_in_tcr_feature_logos:
-                clp_rank_scores = [ x for x in clp_rank_scores if x[0] != 'alphadist' ]
-            pngfile = '{}.tmpsc_{}_{}.png'.format(logo_pngfile, clp[0], clp[1])
             left = (margin+dendro_width+title_logo_width+batch_bars_width+rg_logo_width+tcr_logo_width)/fig_width
             width = score_logo_width/fig_width
             plt.axes( [left,bottom,width,height] )
-            if len(clp_rank_scores):
+            if (clp, 'scores') in logo_images:
                 # if none of the pvals are better than 1 then we get an all white image--> black box (?)
-                make_single_rank_genes_logo( clp_rank_scores[:3], pngfile[:-3]+'svg',
-                                             logo_width=900, logo_max_height=1000, top_pval_for_max_height=1e-6,
-                                             signcolors=True)
-
-                #image = mpimg.imread(pngfile)
-                image = plt.imread(pngfile)
-                tmpfiles.append(pngfile)
+                image = logo_images[clp, 'scores']
                 plt.imshow(image)
                 xmn,xmx = plt.xlim()
                 ymn,ymx = plt.ylim()
@@ -2867,7 +2914,7 @@ def make_tcrdist_trees( adata, output_prefix, group_by = None):
 
         if not precomputed:
             print('computing tcrdist distances:', clust, csize)
-            cdists = np.array([ tcrdist(x,y) for x in ctcrs for y in ctcrs]).reshape(csize,csize)
+            cdists = tcrdist.distance_matrix(ctcrs)
         else:
             assert False # tmp hack
 
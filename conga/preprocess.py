@@ -16,11 +16,14 @@ from scipy.sparse import issparse, csr_matrix
 from anndata import AnnData
 import sys
 import os
+import weakref
 from sys import exit
 from . import tcr_scoring
 from . import util
 from . import pmhc_scoring
 from . import plotting
+from . import ann
+from . import tcrdist_lib
 from .tcrdist.tcr_distances import TcrDistCalculator
 from .util import tcrdist_cpp_available
 
@@ -129,14 +132,61 @@ def store_tcrs_in_adata(adata, tcrs):
     return
 
 
+# memoized tcrs and tcr arrays, see retrieve_tcrs_from_adata and retrieve_tcr_arrays_from_adata
+# id(adata) -> [weakref to adata, obs fingerprint, {what:value}]; entries go away along with their adata
+_tcrs_cache = {}
+
+def _obs_column_fingerprint( column, num_samples=64 ):
+    ''' cheap stand-in for the contents of an obs column: where its data lives, plus a few of its values. Assigning
+    a new column (or a new obs, or subsetting/copying adata) changes it
+    '''
+    values = column.values
+    if isinstance(values, pd.Categorical):
+        location = ('categorical', values.codes.__array_interface__['data'][0], id(values.categories))
+    else:
+        values = np.asarray(values)
+        location = (values.dtype.str, values.__array_interface__['data'][0], values.strides)
+    step = max(1, len(column)//num_samples)
+    return location + (len(column), tuple(column.iloc[::step]))
+
+def get_tcrs_cache( adata ):
+    ''' returns the dict of memoized values for adata, emptied if the tcr columns of adata.obs have changed
+
+    other modules can use it for memoizing things that only depend on the tcrs (eg tcr_scoring.make_tcr_score_table)
+    '''
+    keys = tcr_keys + [x for x in [util.SUBJECT_ID_OBS_KEY] if x in adata.obs]
+    fingerprint = (id(adata.obs), tuple(keys), tuple(_obs_column_fingerprint(adata.obs[x]) for x in keys))
+    entry = _tcrs_cache.get(id(adata))
+    if entry is None or entry[0]() is not adata:
+        entry = [weakref.ref(adata), None, {}]
+        _tcrs_cache[id(adata)] = entry
+        weakref.finalize(adata, _tcrs_cache.pop, id(adata), None)
+    if entry[1] != fingerprint:
+        entry[1] = fingerprint
+        entry[2].clear()
+    return entry[2]
+
+def clear_tcrs_cache():
+    ''' only needed if the tcr columns of adata.obs have been modified in place, eg adata.obs.loc[mask,'cdr3a'] = ...
+    '''
+    _tcrs_cache.clear()
+
 def retrieve_tcrs_from_adata(adata, include_subject_id_if_present=False):
     ''' include_subject_id_if_present = True means that we add to the tcr-tuples the subject_id
     as given in the obs array. This will prevent clones from being condensed across individuals
+
+    the tcr-tuples are memoized, so repeated calls with an unchanged adata only pay for a list copy
     '''
     global tcr_keys
-    tcrs = []
-    if include_subject_id_if_present and util.SUBJECT_ID_OBS_KEY in adata.obs_keys():
+    include_subject_id = include_subject_id_if_present and util.SUBJECT_ID_OBS_KEY in adata.obs_keys()
+    if include_subject_id:
         print(f'retrieve_tcrs_from_adata: include_subject_id_if_present is True and {util.SUBJECT_ID_OBS_KEY} present')
+    cache = get_tcrs_cache(adata)
+    if ('tcrs', include_subject_id) in cache:
+        return list(cache['tcrs', include_subject_id])
+
+    tcrs = []
+    if include_subject_id:
         arrays = [ adata.obs[x] for x in tcr_keys+[util.SUBJECT_ID_OBS_KEY] ]
         for va, ja, cdr3a, cdr3a_nucseq, vb, jb, cdr3b, cdr3b_nucseq, subject_id in zip( *arrays):
             tcrs.append( ( ( va, ja, cdr3a, cdr3a_nucseq, subject_id), (vb, jb, cdr3b, cdr3b_nucseq, subject_id) ) )
@@ -145,7 +195,31 @@ def retrieve_tcrs_from_adata(adata, include_subject_id_if_present=False):
         for va, ja, cdr3a, cdr3a_nucseq, vb, jb, cdr3b, cdr3b_nucseq in zip( *arrays):
             tcrs.append( ( ( va, ja, cdr3a, cdr3a_nucseq), (vb, jb, cdr3b, cdr3b_nucseq) ) )
 
-    return tcrs
+    cache['tcrs', include_subject_id] = tcrs
+    return list(tcrs)
+
+def retrieve_tcr_arrays_from_adata(adata):
+    ''' returns a dict with columnar numpy versions of the tcrs in adata.obs, memoized like retrieve_tcrs_from_adata
+
+    for the gene keys (va, ja, vb, jb):
+      arrays[k] is an int array of indices into arrays[k+'_genes'], the sorted list of distinct genes
+    for cdr3a and cdr3b:
+      arrays[k] is a uint8 array of shape (num_clones, max_len) with the ascii codes, padded with zeros
+      arrays[k+'_len'] is an int array with the lengths
+
+    don't modify the arrays, they are shared between calls
+    '''
+    cache = get_tcrs_cache(adata)
+    if 'arrays' not in cache:
+        arrays = {}
+        for k in ['va', 'ja', 'vb', 'jb']:
+            codes, genes = pd.factorize(np.asarray(adata.obs[k], dtype=object), sort=True)
+            arrays[k] = codes
+            arrays[k+'_genes'] = list(genes)
+        for k in ['cdr3a', 'cdr3b']:
+            arrays[k], arrays[k+'_len'] = util.encode_strings_as_padded_array(adata.obs[k])
+        cache['arrays'] = arrays
+    return cache['arrays']
 
 def setup_X_igex( adata ):
     ''' Side effect: will log1p-and-normalize the raw matrix if that's not already done
@@ -649,6 +723,20 @@ def filter_and_scale(
     return adata
 
 
+def _clone_averaging_matrix( clone_ids, num_clones ):
+    ''' returns (avg_matrix, clone_sizes) where avg_matrix is a sparse (num_clones, num_cells) matrix such that
+    avg_matrix @ X is the per-clone average of the rows of X
+
+    clone_ids are integers in range(num_clones), one per cell
+    '''
+    num_cells = clone_ids.shape[0]
+    clone_sizes = np.bincount(clone_ids, minlength=num_clones)
+    assert np.all(clone_sizes>0)
+    avg_matrix = csr_matrix( (1.0/clone_sizes[clone_ids], (clone_ids, np.arange(num_cells))),
+                             shape=(num_clones, num_cells))
+    return avg_matrix, clone_sizes
+
+
 def reduce_to_single_cell_per_clone(
         adata,
         n_pcs=50,
@@ -689,17 +777,14 @@ def reduce_to_single_cell_per_clone(
     if 'pmhc_var_names' in adata.uns_keys():
         pmhc_var_names = adata.uns['pmhc_var_names']
         X_pmhc = pmhc_scoring._get_X_pmhc(adata, pmhc_var_names)
-        new_X_pmhc = []
     else:
         pmhc_var_names = None
 
     if 'batch_keys' in adata.uns_keys():
-        clone_batch_counts = {}
         num_batch_key_choices = {}
         batch_keys = adata.uns['batch_keys']
         for k in batch_keys:
             assert k in adata.obs_keys()
-            clone_batch_counts[k] = []
             assert np.min(adata.obs[k]) >= 0
             max_val = np.max(adata.obs[k])
             if max_val==0: # we need at least two choices for obsm
@@ -712,90 +797,72 @@ def reduce_to_single_cell_per_clone(
 
     clone_ids = np.array( [ tcr2clone_id[x] for x in tcrs_with_duplicates ] )
 
-    X_pca = adata.obsm['X_pca']
-    clone_sizes = []
-    gex_var = []
-    batch_counts = []
-    rep_cell_indices = [] # parallel
-    new_X_igex = []
-
-    ## only used if average_clone_gex is True
-    old_raw_X = adata.raw.X
-    new_X_rows = []
+    # sparse (num_clones, num_cells) matrix for averaging over the cells in each clone, and the cells of each
+    # clone as contiguous slices of clone_cells_order
+    clone_avg_matrix, clone_sizes = _clone_averaging_matrix(clone_ids, num_clones)
+    clone_cells_order = np.argsort(clone_ids, kind='stable')
+    clone_starts = np.concatenate([[0], np.cumsum(clone_sizes)])
 
     ## for each clone (tcr) we pick a single representative cell, stored in rep_cell_indices
     ## rep_cell_indices is parallel with and aligned to the tcrs list
-    for c in range(num_clones):
-        if c%1000==0:
-            print('choose representative cell for clone:', c, num_clones, adata.shape)
-            sys.stdout.flush()
-        clone_mask = clone_ids==c
-        clone_cells = np.nonzero(clone_mask)[0] #array( [ x for x,y in enumerate(clone_ids) if y==c] )
+    ## singletons are their own rep; for bigger clones it's the medoid in gex pca space
+    X_pca = adata.obsm['X_pca']
+    rep_cell_indices = clone_cells_order[clone_starts[:-1]]
+    gex_var = np.zeros((num_clones,))
+    big_clones = np.nonzero(clone_sizes>1)[0]
+    print('choose representative cells for', big_clones.shape[0], 'multi-cell clones;', num_clones, 'clones total')
+    for c in big_clones:
+        clone_cells = clone_cells_order[clone_starts[c]:clone_starts[c+1]]
         clone_size = clone_cells.shape[0]
-        clone_sizes.append( clone_size )
-        if batch_keys is not None:
-            # store the distribution of this clone across the different batches
-            for k in batch_keys:
-                counts = Counter(adata.obs[k][clone_mask])
-                counts = [counts[x] for x in range(num_batch_key_choices[k]) ]
-                clone_batch_counts[k].append(counts)
-
-        if clone_size==1:
-            rep_cell_index = clone_cells[0]
-            gex_var.append(0.0)
-        else:
-            X_pca_clone = X_pca[ clone_cells, : ]
-            #print('X_pca_clone:',X_pca_clone.shape)
-            assert X_pca_clone.shape[0] == clone_size
-            D_gex_clone = pairwise_distances( X_pca_clone, X_pca_clone )
-            assert D_gex_clone.shape  == ( clone_size,clone_size )
-            avgdist = D_gex_clone.sum(axis=1)
-            #print('min_avgdist', np.min(avgdist)/clone_size, clone_size, np.argmin(avgdist))
-            rep_ind = np.argmin( avgdist )
-            rep_cell_index = clone_cells[rep_ind]
-            gex_var.append(np.sum(D_gex_clone[rep_ind,:]**2)/clone_size)
-        rep_cell_indices.append(rep_cell_index)
-        if average_clone_gex:
-            if clone_size == 1:
-                new_X_rows.append(old_raw_X[clone_cells[0],:])
-            else:
-                new_X_rows.append(csr_matrix(old_raw_X[clone_cells,:].sum(axis=0)/clone_size))
-                adata.X[rep_cell_index,:] = adata.X[clone_cells,:].sum(axis=0)/clone_size
-        new_X_igex.append( np.sum( X_igex[clone_cells,:], axis=0 ) / clone_size )
-        if pmhc_var_names:
-            new_X_pmhc.append( np.sum( X_pmhc[clone_cells,:], axis=0 ) / clone_size )
-
-    rep_cell_indices = np.array(rep_cell_indices)
-    new_X_igex = np.array(new_X_igex)
+        D_gex_clone = pairwise_distances( X_pca[ clone_cells, : ] )
+        assert D_gex_clone.shape  == ( clone_size,clone_size )
+        rep_ind = np.argmin( D_gex_clone.sum(axis=1) )
+        rep_cell_indices[c] = clone_cells[rep_ind]
+        gex_var[c] = np.sum(D_gex_clone[rep_ind,:]**2)/clone_size
+
+    new_X_igex = (clone_avg_matrix @ X_igex).astype(X_igex.dtype, copy=False)
     assert new_X_igex.shape == ( num_clones, len(good_genes))
 
+    if pmhc_var_names:
+        new_X_pmhc = (clone_avg_matrix @ X_pmhc).astype(X_pmhc.dtype, copy=False)
+
+    if batch_keys is not None:
+        # store the distribution of each clone across the different batches
+        clone_batch_counts = {}
+        for k in batch_keys:
+            counts = np.zeros((num_clones, num_batch_key_choices[k]), dtype=int)
+            np.add.at(counts, (clone_ids, np.array(adata.obs[k]).astype(int)), 1)
+            clone_batch_counts[k] = counts
+
+    if average_clone_gex:
+        new_raw_X = csr_matrix(clone_avg_matrix @ adata.raw.X, dtype=adata.raw.X.dtype)
+        new_X = (clone_avg_matrix @ adata.X).astype(adata.X.dtype, copy=False)
+        if not issparse(adata.X):
+            new_X = np.asarray(new_X)
+
     print(f'reduce from {adata.shape[0]} cells to {len(rep_cell_indices)} cells (one per clonotype)')
     adata = adata[ rep_cell_indices, : ].copy() ## seems like we need to copy here, something to do with adata 'views'
-    adata.obs['clone_sizes'] = np.array( clone_sizes )
-    adata.obs['gex_variation'] = np.sqrt(np.array( gex_var ))
+    adata.obs['clone_sizes'] = clone_sizes
+    adata.obs['gex_variation'] = np.sqrt(gex_var)
     adata.obsm['X_igex'] = new_X_igex
     adata.uns['X_igex_genes'] = good_genes
 
     if average_clone_gex:
-        print('vstacking new_X_rows...'); sys.stdout.flush()
-        new_X = scipy.sparse.vstack(new_X_rows, format="csr")
-        print('DONE vstacking new_X_rows...'); sys.stdout.flush()
-        assert new_X.shape == (adata.shape[0], adata.raw.X.shape[1])
-
-        adata_new = AnnData( X = new_X, obs = adata.obs, var = adata.raw.var )
+        adata.X = new_X
+        assert new_raw_X.shape == (adata.shape[0], adata.raw.X.shape[1])
+        adata_new = AnnData( X = new_raw_X, obs = adata.obs, var = adata.raw.var )
         adata.raw = adata_new
 
 
 
     if batch_keys:
         for k in batch_keys:
-            counts = np.array(clone_batch_counts[k])
+            counts = clone_batch_counts[k]
             assert counts.shape == (num_clones, num_batch_key_choices[k])
             adata.obsm[k] = counts
             print(f'storing clone batch info for key {k} with {num_batch_key_choices[k]} choices')
 
     if pmhc_var_names:
-        new_X_pmhc = np.array(new_X_pmhc)
         assert new_X_pmhc.shape == ( num_clones, len(pmhc_var_names))
         adata.obsm['X_pmhc'] = new_X_pmhc
 
@@ -903,6 +970,63 @@ def _calc_nndists( D, nbrs ):
     assert nndists.shape==(batch_size,)
     return nndists
 
+def _same_group_pairs( groups, row_start=0, row_stop=None ):
+    ''' returns (rows, cols) index arrays for all pairs of clones that share a group
+
+    clones are sorted by group ID so that each group occupies a contiguous block; the pairs
+    within each block are then enumerated without any python-level looping
+
+    only rows in the range [row_start, row_stop) are included, and the returned row indices
+    are relative to row_start (for filling a batch of the distance matrix)
+    '''
+    groups = np.asarray(groups)
+    num_clones = groups.shape[0]
+    if row_stop is None:
+        row_stop = num_clones
+
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    block_starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    block_sizes = np.diff(np.r_[block_starts, num_clones])
+
+    # per-clone (in sorted order) start and size of the enclosing block
+    elem_starts = np.repeat(block_starts, block_sizes)
+    elem_sizes = np.repeat(block_sizes, block_sizes)
+
+    mask = (order >= row_start) & (order < row_stop)
+    elem_rows, elem_starts, elem_sizes = order[mask], elem_starts[mask], elem_sizes[mask]
+
+    rows = np.repeat(elem_rows - row_start, elem_sizes)
+    offsets = np.arange(rows.shape[0]) - np.repeat(np.cumsum(elem_sizes) - elem_sizes, elem_sizes)
+    cols = order[np.repeat(elem_starts, elem_sizes) + offsets]
+    return rows, cols
+
+def _mask_same_group_distances( D, agroups, bgroups, row_start=0 ):
+    ''' Modifies D in place: D[i,j] = 1e3 if clone (i+row_start) and clone j share an agroup or bgroup
+
+    This includes the diagonal, so self is excluded from the nbrs. The large finite value (rather than inf)
+    keeps the nndists finite when a clone has fewer than num_nbrs unmasked candidates
+    '''
+    row_stop = row_start + D.shape[0]
+    for groups in [agroups, bgroups]:
+        rows, cols = _same_group_pairs(groups, row_start, row_stop)
+        D[rows, cols] = 1e3
+
+def _select_nbrs_for_nbr_fracs( D, nbr_fracs, num_clones ):
+    ''' returns dict mapping from nbr_frac to nbrs array, shape = (D.shape[0], num_neighbors)
+
+    does a single argpartition at the largest num_neighbors, then sorts that slice by distance
+    so that the nbrs for each smaller nbr_frac are just the leading columns
+    '''
+    nbr_frac2num = {x:max(1, int(x*num_clones)) for x in nbr_fracs}
+    max_num_neighbors = max(nbr_frac2num.values())
+
+    nbrs = np.argpartition( D, max_num_neighbors-1 )[:,:max_num_neighbors]
+    sample_range = np.arange(D.shape[0])[:, np.newaxis]
+    nbrs = nbrs[sample_range, np.argsort(D[sample_range, nbrs], kind='stable')]
+
+    return {x:np.ascontiguousarray(nbrs[:,:k]) for x,k in nbr_frac2num.items()}
+
 def _calc_nndists_old( D, nbrs ):
     num_clones, num_nbrs = nbrs.shape
     assert D.shape ==(num_clones, num_clones)
@@ -924,11 +1048,21 @@ def calc_nbrs_batched(
         nbr_frac_for_nndists = None,
         target_N_for_batching = 8192,
         use_exact_tcrdist_nbrs = False,
+        approximate_nbrs = False,
+        ann_num_trees = 8,
+        num_threads = 1, # for the C++ tcrdist calc if use_exact_tcrdist_nbrs
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
     nbrs exclude self and any clones in same atcr group or btcr group
+
+    approximate_nbrs = True means use a random projection forest index (see calc_nbrs_approximate)
     '''
+    if approximate_nbrs: ## EARLY RETURN
+        return calc_nbrs_approximate(adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+                                     nbr_frac_for_nndists, use_exact_tcrdist_nbrs, num_trees=ann_num_trees,
+                                     num_threads=num_threads)
+
     if also_calc_nndists:
         assert nbr_frac_for_nndists in nbr_fracs
 
@@ -951,7 +1085,6 @@ def calc_nbrs_batched(
     for bb in range(num_batches):
         b_start = bb*batch_size
         b_stop = min(N, (bb+1)*batch_size)
-        batch_indices = np.arange(b_start, b_stop)
 
         for itag, (tag, obsm_tag) in enumerate( [['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]] ):
             if obsm_tag is None:
@@ -961,14 +1094,14 @@ def calc_nbrs_batched(
             X = adata.obsm[obsm_tag]
             D = cdist( X[b_start:b_stop, :], X )
 
-            for ii in batch_indices:
-                D[ii-b_start, (agroups==agroups[ii]) ] = 1e3
-                D[ii-b_start, (bgroups==bgroups[ii]) ] = 1e3
+            _mask_same_group_distances( D, agroups, bgroups, row_start=b_start )
+
+            print(f'argpartition: {tag} batch= {bb} nbr_fracs= {nbr_fracs}')
+            batch_nbrs = _select_nbrs_for_nbr_fracs( D, nbr_fracs, N ) # will NOT include self in there
 
             for nbr_frac in nbr_fracs:
                 num_neighbors = max(1, int(nbr_frac*adata.shape[0]))
-                print(f'argpartitions: {tag} batch= {bb} nbr_frac= {nbr_frac}')
-                nbrs = np.argpartition( D, num_neighbors-1 )[:,:num_neighbors] # will NOT include self in there
+                nbrs = batch_nbrs[nbr_frac]
                 assert nbrs.shape == (D.shape[0], num_neighbors)
                 all_nbrs[nbr_frac][itag].append(nbrs)
 
@@ -983,7 +1116,8 @@ def calc_nbrs_batched(
         all_nbrs[nbr_frac] = [ np.vstack(nbrslist_gex), None if obsm_tag_tcr is None else np.vstack(nbrslist_tcr) ]
 
     if use_exact_tcrdist_nbrs:
-        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(adata, nbr_fracs, nbr_frac_for_nndists)
+        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(adata, nbr_fracs, nbr_frac_for_nndists,
+                                                       num_threads=num_threads)
         for nbr_frac in nbr_fracs:
             nbrs_gex,_ = all_nbrs[nbr_frac]
             all_nbrs[nbr_frac] = [nbrs_gex, tcr_nbrs[nbr_frac]]
@@ -998,6 +1132,102 @@ def calc_nbrs_batched(
         return all_nbrs
 
 
+def check_approximate_nbrs_recall(
+        X,
+        approx_nbrs, # shape (num_clones, num_nbrs), eg from ann.find_approximate_nbrs
+        agroups,
+        bgroups,
+        batch_size = 256,
+        random_state = 0,
+):
+    ''' returns the recall (fraction of the exact nbrs that are found) of approx_nbrs on a random batch of
+    batch_size consecutive clones, whose exact nbrs are computed the same way as in calc_nbrs_batched
+    '''
+    num_clones, num_nbrs = approx_nbrs.shape
+    batch_size = min(batch_size, num_clones)
+    b_start = np.random.default_rng(random_state).integers(num_clones - batch_size + 1)
+    b_stop = b_start + batch_size
+
+    D = cdist( X[b_start:b_stop, :], X )
+    _mask_same_group_distances( D, agroups, bgroups, row_start=b_start )
+    exact_nbrs = np.argpartition( D, num_nbrs-1 )[:,:num_nbrs]
+
+    return ann.calc_nbrs_recall( approx_nbrs[b_start:b_stop], exact_nbrs )
+
+
+def calc_nbrs_approximate(
+        adata,
+        nbr_fracs,
+        obsm_tag_gex = 'X_pca_gex',
+        obsm_tag_tcr = 'X_pca_tcr', # set to None to skip tcr calc
+        also_calc_nndists = False,
+        nbr_frac_for_nndists = None,
+        use_exact_tcrdist_nbrs = False,
+        num_trees = 8,
+        num_threads = 1, # for the C++ tcrdist calc if use_exact_tcrdist_nbrs
+        recall_check_batch_size = 256, # compare to the exact nbrs for this many clones; 0 to skip
+):
+    ''' Like calc_nbrs, but uses an approximate nearest neighbor index (random projection forest)
+    so we never compute the full NxN distance matrix
+
+    returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr] (plus nndists_gex, nndists_tcr if also_calc_nndists)
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+    '''
+    if also_calc_nndists:
+        assert nbr_frac_for_nndists in nbr_fracs
+
+    if use_exact_tcrdist_nbrs:
+        obsm_tag_tcr = None # dont do the standard calculation
+
+    num_clones = adata.shape[0]
+    nbr_frac2num = {x:max(1, int(x*num_clones)) for x in nbr_fracs}
+    max_num_neighbors = max(nbr_frac2num.values())
+
+    all_nbrs = {}
+    for nbr_frac in nbr_fracs:
+        all_nbrs[nbr_frac] = [ None, None ]
+    nndists = [ None, None ]
+
+    agroups, bgroups = setup_tcr_groups(adata)
+    for itag, (tag, obsm_tag) in enumerate([['gex', obsm_tag_gex], ['tcr', obsm_tag_tcr]]):
+        if obsm_tag is None:
+            print('skipping', tag, 'nbr calc:', obsm_tag)
+            continue
+
+        print('compute approximate nbrs', tag, num_clones)
+        nbrs, dists = ann.find_approximate_nbrs(
+            adata.obsm[obsm_tag], max_num_neighbors, agroups, bgroups, num_trees=num_trees)
+
+        if recall_check_batch_size:
+            recall = check_approximate_nbrs_recall(adata.obsm[obsm_tag], nbrs, agroups, bgroups,
+                                                   batch_size=recall_check_batch_size)
+            print(f'approximate nbrs recall: {tag} {recall:.4f} num_nbrs= {max_num_neighbors}')
+
+        # nbrs are sorted by distance, so the smaller nbr_fracs are just the leading columns
+        for nbr_frac, num_neighbors in nbr_frac2num.items():
+            all_nbrs[nbr_frac][itag] = np.ascontiguousarray(nbrs[:,:num_neighbors])
+
+        if also_calc_nndists:
+            num_neighbors = nbr_frac2num[nbr_frac_for_nndists]
+            wts = np.linspace(1.0, 1.0/num_neighbors, num_neighbors)
+            wts /= np.sum(wts)
+            nndists[itag] = np.sum( dists[:,:num_neighbors] * wts[np.newaxis,:], axis=1)
+
+    if use_exact_tcrdist_nbrs:
+        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(adata, nbr_fracs, nbr_frac_for_nndists,
+                                                       num_threads=num_threads)
+        for nbr_frac in nbr_fracs:
+            nbrs_gex,_ = all_nbrs[nbr_frac]
+            all_nbrs[nbr_frac] = [nbrs_gex, tcr_nbrs[nbr_frac]]
+        nndists[1] = tcr_nndists
+
+    if also_calc_nndists:
+        return all_nbrs, nndists[0], nndists[1]
+    else:
+        return all_nbrs
+
+
 def calc_nbrs(
         adata,
         nbr_fracs,
@@ -1007,14 +1237,26 @@ def calc_nbrs(
         nbr_frac_for_nndists = None,
         target_N_for_batching = 8192,
         use_exact_tcrdist_nbrs = False,
+        approximate_nbrs = False,
+        ann_num_trees = 8,
+        num_threads = 1, # for the C++ tcrdist calc if use_exact_tcrdist_nbrs
 ):
     ''' returns dict mapping from nbr_frac to [nbrs_gex, nbrs_tcr]
 
     nbrs exclude self and any clones in same atcr group or btcr group
+
+    approximate_nbrs = True means use a random projection forest index (see conga/ann.py) rather than
+    computing all the pairwise distances; ann_num_trees is the accuracy/speed knob
     '''
+    if approximate_nbrs: ## EARLY RETURN
+        return calc_nbrs_approximate(adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists,
+                                     nbr_frac_for_nndists, use_exact_tcrdist_nbrs, num_trees=ann_num_trees,
+                                     num_threads=num_threads)
+
     if adata.shape[0] > 1.25*target_N_for_batching: ## EARLY RETURN
         return calc_nbrs_batched(adata, nbr_fracs, obsm_tag_gex, obsm_tag_tcr, also_calc_nndists, nbr_frac_for_nndists,
-                                 target_N_for_batching, use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs)
+                                 target_N_for_batching, use_exact_tcrdist_nbrs=use_exact_tcrdist_nbrs,
+                                 num_threads=num_threads)
 
     if also_calc_nndists:
         assert nbr_frac_for_nndists in nbr_fracs
@@ -1035,14 +1277,14 @@ def calc_nbrs(
 
         print('compute D', tag, adata.shape[0])
         D = pairwise_distances( adata.obsm[obsm_tag], metric='euclidean' )
-        for ii,(a,b) in enumerate(zip(agroups, bgroups)):
-            D[ii, (agroups==a) ] = 1e3
-            D[ii, (bgroups==b) ] = 1e3
+        _mask_same_group_distances( D, agroups, bgroups )
+
+        print('argpartition:', nbr_fracs, adata.shape[0], tag)
+        tag_nbrs = _select_nbrs_for_nbr_fracs( D, nbr_fracs, adata.shape[0] ) # will NOT include self in there
 
         for nbr_frac in nbr_fracs:
             num_neighbors = max(1, int(nbr_frac*adata.shape[0]))
-            print('argpartitions:', nbr_frac, adata.shape[0], tag)
-            nbrs = np.argpartition( D, num_neighbors-1 )[:,:num_neighbors] # will NOT include self in there
+            nbrs = tag_nbrs[nbr_frac]
             assert nbrs.shape == (adata.shape[0], num_neighbors)
             all_nbrs[nbr_frac][itag] = nbrs
 
@@ -1053,7 +1295,8 @@ def calc_nbrs(
 
 
     if use_exact_tcrdist_nbrs:
-        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(adata, nbr_fracs, nbr_frac_for_nndists)
+        tcr_nbrs, tcr_nndists = calculate_tcrdist_nbrs(adata, nbr_fracs, nbr_frac_for_nndists,
+                                                       num_threads=num_threads)
         for nbr_frac in nbr_fracs:
             nbrs_gex,_ = all_nbrs[nbr_frac]
             all_nbrs[nbr_frac] = [nbrs_gex, tcr_nbrs[nbr_frac]]
@@ -1069,6 +1312,7 @@ def calculate_tcrdist_nbrs(
         adata,
         nbr_fracs,
         nbr_frac_for_nndists = None, # if not None, calculate nndists at this nbr fraction
+        num_threads = 1, # only used by the c++ routine
 ):
     ''' returns all_nbrs, nndists
 
@@ -1081,7 +1325,7 @@ def calculate_tcrdist_nbrs(
     nbrs exclude self and any clones in same atcr group or btcr group
     '''
     if util.tcrdist_cpp_available():
-        return calculate_tcrdist_nbrs_cpp(adata, nbr_fracs, nbr_frac_for_nndists)
+        return calculate_tcrdist_nbrs_cpp(adata, nbr_fracs, nbr_frac_for_nndists, num_threads=num_threads)
     else:
         return calculate_tcrdist_nbrs_python(adata, nbr_fracs, nbr_frac_for_nndists)
 
@@ -1113,12 +1357,13 @@ def calculate_tcrdist_nbrs_python(
 
     nndists = []
 
+    block_size = 1000 # compute the distances for this many rows at a time
     for ii in range(num_clones):
-        if ii%1000==0:
+        if ii%block_size==0:
             print('recalculate_tcrdist_nbrs:', ii, num_clones)
             sys.stdout.flush()
-        ii_tcr = tcrs[ii]
-        dists = np.array([ tcrdist(ii_tcr, x) for x in tcrs])
+            block_dists = tcrdist.distance_matrix(tcrs[ii:ii+block_size], tcrs)
+        dists = block_dists[ii%block_size].copy()
         dists[ agroups==agroups[ii] ] = 1e3
         dists[ bgroups==bgroups[ii] ] = 1e3
         for nbr_frac in nbr_fracs: # could do this more efficiently by going in decreasing order, saving partitions...
@@ -1144,34 +1389,20 @@ def calculate_tcrdist_nbrs_python(
 
     return all_nbrs, nndists
 
-def calculate_tcrdist_nbrs_cpp(
+def _run_find_neighbors_knn(
         adata,
-        nbr_fracs,
-        nbr_frac_for_nndists = None,
-        tmpfile_prefix = None
+        num_nbrs,
+        tmpfile_prefix,
+        agroups = None,
+        bgroups = None,
+        num_threads = 1,
 ):
-    ''' returns all_nbrs, nndists
-
-    all_nbrs is a dict mapping from nbr_frac to nbrs_tcr
-
-    nndists=None if nbr_frac_for_nndists is None
-
-    nbrs exclude self and any clones in same atcr group or btcr group
+    ''' returns knn_indices, knn_distances from the find_neighbors executable, which talks to us through
+    tmpfiles. Only used if the tcrdist_cpp shared library is not available, see conga.tcrdist_lib
     '''
-    if tmpfile_prefix is None:
-        tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
-
-    print('calculate_tcrdist_nbrs_cpp:', adata.shape, nbr_fracs, tmpfile_prefix)
-
-    agroups, bgroups = setup_tcr_groups(adata)
-
-    agroups_filename = str(tmpfile_prefix) +'_agroups.txt'
-    bgroups_filename = str(tmpfile_prefix) +'_bgroups.txt'
-    np.savetxt(agroups_filename, agroups, fmt='%d')
-    np.savetxt(bgroups_filename, bgroups, fmt='%d')
-
     tcrs_filename = str(tmpfile_prefix) +'_tcrs.tsv'
     adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_filename, sep='\t', index=False)
+    tmpfiles = [tcrs_filename]
 
     if os.name == 'posix':
         exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
@@ -1188,25 +1419,68 @@ def calculate_tcrdist_nbrs_cpp(
         print('need to create database file:', db_filename)
         exit(1)
 
-    max_nbr_frac = max(nbr_fracs)
-    num_nbrs = max(1, int(max_nbr_frac*adata.shape[0]))
-
     outprefix = str(tmpfile_prefix) +'_calc_tcrdist'
 
-    cmd = '{} -f {} -n {} -d {} -o {} -a {} -b {}'\
-    .format(exe, tcrs_filename, num_nbrs, db_filename, outprefix, agroups_filename, bgroups_filename)
+    cmd = '{} -f {} -n {} -d {} -o {} --binary --threads {}'\
+    .format(exe, tcrs_filename, num_nbrs, db_filename, outprefix, num_threads)
+
+    if agroups is not None:
+        agroups_filename = str(tmpfile_prefix) +'_agroups.txt'
+        bgroups_filename = str(tmpfile_prefix) +'_bgroups.txt'
+        np.savetxt(agroups_filename, agroups, fmt='%d')
+        np.savetxt(bgroups_filename, bgroups, fmt='%d')
+        cmd += f' -a {agroups_filename} -b {bgroups_filename}'
+        tmpfiles.extend([agroups_filename, bgroups_filename])
 
     util.run_command(cmd, verbose=True)
 
-    knn_indices_filename = outprefix+'_knn_indices.txt'
-    knn_distances_filename = outprefix+'_knn_distances.txt'
+    knn_indices_filename = outprefix+'_knn_indices.bin'
+    knn_distances_filename = outprefix+'_knn_distances.bin'
 
     if not exists(knn_indices_filename) or not exists(knn_distances_filename):
         print('find_neighbors failed:', exists(knn_indices_filename), exists(knn_distances_filename))
         exit(1)
 
-    knn_indices = np.loadtxt(knn_indices_filename, dtype=int)
-    knn_distances = np.loadtxt(knn_distances_filename, dtype=float)
+    knn_indices, knn_distances = util.read_tcrdist_knn_binary(outprefix)
+
+    for filename in tmpfiles + [knn_indices_filename, knn_distances_filename]:
+        os.remove(filename)
+
+    return knn_indices, knn_distances
+
+def calculate_tcrdist_nbrs_cpp(
+        adata,
+        nbr_fracs,
+        nbr_frac_for_nndists = None,
+        tmpfile_prefix = None,
+        num_threads = 1,
+):
+    ''' returns all_nbrs, nndists
+
+    all_nbrs is a dict mapping from nbr_frac to nbrs_tcr
+
+    nndists=None if nbr_frac_for_nndists is None
+
+    nbrs exclude self and any clones in same atcr group or btcr group
+    '''
+    if tmpfile_prefix is None:
+        tmpfile_prefix = Path('./tmp_nbrs{}'.format(random.randrange(1,10000)))
+
+    print('calculate_tcrdist_nbrs_cpp:', adata.shape, nbr_fracs, tmpfile_prefix)
+
+    agroups, bgroups = setup_tcr_groups(adata)
+
+    max_nbr_frac = max(nbr_fracs)
+    num_nbrs = max(1, int(max_nbr_frac*adata.shape[0]))
+
+    if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+        knn_indices, knn_distances = tcrdist_lib.calc_tcrdist_knn(
+            retrieve_tcrs_from_adata(adata), adata.uns['organism'], num_nbrs, agroups, bgroups,
+            num_threads=num_threads)
+    else:
+        knn_indices, knn_distances = _run_find_neighbors_knn(
+            adata, num_nbrs, tmpfile_prefix, agroups=agroups, bgroups=bgroups, num_threads=num_threads)
+    knn_indices, knn_distances = knn_indices.astype(int), knn_distances.astype(float)
 
     all_nbrs = {}
     all_nbrs[max_nbr_frac] = knn_indices
@@ -1218,9 +1492,6 @@ def calculate_tcrdist_nbrs_cpp(
         inds = np.argpartition( knn_distances, num_nbrs-1)[:,:num_nbrs]
         all_nbrs[nbr_frac] = knn_indices[np.arange(adata.shape[0])[:,np.newaxis], inds]
 
-    for filename in [tcrs_filename, agroups_filename, bgroups_filename, knn_indices_filename, knn_distances_filename]:
-        os.remove(filename)
-
     if nbr_frac_for_nndists is None:
         nndists = None
     else:
@@ -1287,6 +1558,273 @@ def setup_tcr_cluster_names(adata):
     adata.uns['clusters_tcr_names'] = names
 
 
+def _calc_tcrdists_for_kpca( tcrs, organism, target_tcrs=None, num_threads=1 ):
+    ''' returns the tcrdist matrix between tcrs (rows) and target_tcrs (cols), target_tcrs=None means tcrs
+    '''
+    if tcrdist_cpp_available():
+        return calc_tcrdist_matrix_cpp(tcrs, organism, num_threads=num_threads, target_tcrs=target_tcrs)
+    else:
+        if target_tcrs is None:
+            target_tcrs = tcrs
+        tcrdist_calculator = TcrDistCalculator(organism)
+        return tcrdist_calculator.distance_matrix(tcrs, target_tcrs)
+
+
+def _tcrdist_kpca_kernel( D, kernel, Dmax, gaussian_kernel_sdev ):
+    ''' Convert tcrdist distances to kernel values, see make_tcrdist_kernel_pcs_file_from_clones_file
+    '''
+    if kernel is None:
+        return np.maximum(0.0, 1 - ( D / Dmax ))
+    elif kernel == 'gaussian':
+        return np.exp(-0.5 * (D/gaussian_kernel_sdev)**2 )
+    else:
+        print('conga.preprocess._tcrdist_kpca_kernel:: unrecognized kernel:', kernel)
+        sys.exit(1)
+
+
+def select_kpca_landmarks(
+        tcrs,
+        num_landmarks,
+        method = 'random', # or 'kmeans++'
+        random_state = 0,
+):
+    ''' Choose landmark tcrs for the Nystrom kernel PCA approximation, returns sorted array of indices into tcrs
+
+    'kmeans++' does k-means++ style D^2 seeding using a cheap tcrdist-like distance based on the V genes and
+    the CDR3 lengths (V mismatch ~ 50, CDR3 length difference ~ 12 per residue, the tcrdist gap penalty)
+    so the landmarks cover the repertoire more evenly than a random sample
+    '''
+    num_tcrs = len(tcrs)
+    rng = np.random.default_rng(random_state)
+    if num_landmarks >= num_tcrs:
+        return np.arange(num_tcrs)
+
+    if method == 'random':
+        return np.sort(rng.choice(num_tcrs, num_landmarks, replace=False))
+
+    elif method != 'kmeans++':
+        print('conga.preprocess.select_kpca_landmarks:: unrecognized method:', method)
+        sys.exit(1)
+
+    va_codes = pd.factorize(np.array([x[0][0] for x in tcrs]))[0]
+    vb_codes = pd.factorize(np.array([x[1][0] for x in tcrs]))[0]
+    alens = np.array([len(x[0][2]) for x in tcrs])
+    blens = np.array([len(x[1][2]) for x in tcrs])
+
+    def dists_to( ii ):
+        return ( 50.0 * ( (va_codes != va_codes[ii]).astype(float) + (vb_codes != vb_codes[ii]) ) +
+                 12.0 * ( np.abs(alens-alens[ii]) + np.abs(blens-blens[ii]) ) )
+
+    landmarks = [ rng.integers(num_tcrs) ]
+    min_dists_sq = dists_to(landmarks[0])**2
+    for _ in range(num_landmarks-1):
+        total = np.sum(min_dists_sq)
+        if total == 0: # everything is a duplicate of a landmark; fill in randomly
+            others = np.setdiff1d(np.arange(num_tcrs), landmarks)
+            landmarks.extend(rng.choice(others, num_landmarks-len(landmarks), replace=False))
+            break
+        ii = rng.choice(num_tcrs, p=min_dists_sq/total)
+        landmarks.append(ii)
+        min_dists_sq = np.minimum(min_dists_sq, dists_to(ii)**2)
+
+    return np.sort(np.array(landmarks))
+
+
+def nystrom_kernel_pca( C, W, n_components ):
+    ''' Kernel PCA using the Nystrom approximation K ~ C W^-1 C.T
+
+    C is the (N,L) kernel block between all the points and the L landmarks, W is the (L,L) landmark kernel
+
+    returns xy, lambdas, projection, mean where
+    - xy (N,n_components) are the kernel PCs (same scaling as sklearn KernelPCA fit_transform)
+    - lambdas are the eigenvalues of the centered (approximate) kernel matrix
+    - a new point with landmark kernel row c projects to (c @ projection - mean)
+    '''
+    evals, evecs = np.linalg.eigh(W)
+    keep = evals > 1e-10 * max(1e-12, evals.max())
+    W_inv_sqrt = evecs[:,keep] / np.sqrt(evals[keep])[np.newaxis,:]
+
+    phi = C @ W_inv_sqrt # Nystrom feature map, phi @ phi.T ~ K
+    phi_mean = phi.mean(axis=0)
+    phi -= phi_mean[np.newaxis,:]
+
+    # PCA of the centered features == kernel PCA of the centered approximate kernel
+    lambdas, B = np.linalg.eigh(phi.T @ phi)
+    n_components = min(n_components, B.shape[1])
+    order = np.argsort(lambdas)[::-1][:n_components]
+    lambdas, B = lambdas[order], B[:,order]
+
+    projection = W_inv_sqrt @ B
+    xy = phi @ B
+    return xy, lambdas, projection, phi_mean @ B
+
+
+def report_nystrom_captured_variance(
+        tcrs,
+        organism,
+        C,
+        projection,
+        kernel_fn,
+        n_components,
+        sample_size = 1000,
+        random_state = 0,
+        num_threads = 1,
+):
+    ''' Diagnostic for the Nystrom kPCA: compare to exact kernel PCA on a random subsample of the tcrs
+
+    reports the fraction of the exact (centered) kernel variance in the subsample that is captured by the
+    top n_components exact kPCs versus by the n_components Nystrom kPCs, and returns (exact, nystrom)
+
+    the exact kPCs are optimal for the subsample itself, so the ratio is a bit below 1 even when the
+    approximation is very good
+    '''
+    rng = np.random.default_rng(random_state)
+    sample = np.sort(rng.choice(len(tcrs), min(sample_size, len(tcrs)), replace=False))
+    stcrs = [tcrs[x] for x in sample]
+    S = len(sample)
+
+    K = kernel_fn( _calc_tcrdists_for_kpca(stcrs, organism, num_threads=num_threads) )
+    H = np.eye(S) - 1.0/S
+    Kc = H @ K @ H
+    total_variance = np.trace(Kc)
+    n_components = min(n_components, S)
+
+    exact_evals = np.linalg.eigvalsh(Kc)[::-1][:n_components]
+    exact_fraction = np.sum(exact_evals) / total_variance
+
+    # the nystrom components, restricted to the subsample and orthonormalized
+    V = C[sample] @ projection
+    V -= V.mean(axis=0)[np.newaxis,:]
+    V = np.linalg.qr(V)[0][:,:n_components]
+    nystrom_fraction = np.trace(V.T @ Kc @ V) / total_variance
+
+    print(f'nystrom_kpca_diagnostic: sample_size= {S} n_components= {n_components} captured_variance: '
+          f'exact= {exact_fraction:.4f} nystrom= {nystrom_fraction:.4f} '
+          f'ratio= {nystrom_fraction/exact_fraction:.4f}')
+    return exact_fraction, nystrom_fraction
+
+
+def write_kpcs_file( outfile, ids, xy ):
+    ''' Write kernel PCs in the format expected by read_dataset: "pc_comps: <clone_id> <pc1> <pc2> ..."
+    '''
+    print( 'writing TCRdist kernel PCs to outfile:', outfile)
+    out = open(outfile,'w')
+    for ii in range(xy.shape[0]):
+        out.write('pc_comps: {} {}\n'\
+                  .format( ids[ii], ' '.join( '{:.6f}'.format(x) for x in xy[ii,:] ) ) )
+    out.close()
+
+
+def save_kpca_model(
+        model_file,
+        organism,
+        ref_tcrs,
+        projection,
+        lambdas,
+        kernel,
+        Dmax,
+        gaussian_kernel_sdev,
+        kernel_col_means = None, # exact kPCA: kernel centering stats
+        kernel_mean = None,
+        xy_mean = None, # Nystrom kPCA: subtract this after projecting
+):
+    ''' Save a TCRdist kPCA model (.npz) for project_tcrs_into_kpca_space
+
+    a new tcr with kernel row k (vs ref_tcrs) projects to
+
+    exact kPCA (centered kernel): (k - mean(k) - kernel_col_means + kernel_mean) @ projection
+      where projection = eigenvectors / sqrt(eigenvalues)
+
+    Nystrom kPCA (ref_tcrs are the landmarks): k @ projection - xy_mean
+    '''
+    centered = kernel_col_means is not None
+    num_pcs = projection.shape[1]
+    np.savez_compressed(
+        model_file,
+        organism = np.array(organism),
+        ref_tcrs = np.array([ [a[0], a[1], a[2], b[0], b[1], b[2]] for a,b in ref_tcrs ], dtype=str),
+        projection = projection,
+        lambdas = lambdas,
+        kernel = np.array('' if kernel is None else kernel),
+        Dmax = np.array(np.nan if Dmax is None else Dmax, dtype=float),
+        gaussian_kernel_sdev = np.array(gaussian_kernel_sdev, dtype=float),
+        centered = np.array(centered),
+        kernel_col_means = kernel_col_means if centered else np.zeros((0,)),
+        kernel_mean = np.array(kernel_mean if centered else 0.0, dtype=float),
+        xy_mean = np.zeros((num_pcs,)) if xy_mean is None else xy_mean,
+    )
+    print(f'saved kPCA model with {len(ref_tcrs)} reference tcrs and {num_pcs} components to {model_file}')
+
+
+def load_kpca_model( model_file ):
+    ''' Returns a dict with the kPCA model info saved by save_kpca_model
+    '''
+    data = np.load(model_file)
+    model = { k:data[k] for k in data.files }
+    model['organism'] = str(model['organism'])
+    model['kernel'] = None if str(model['kernel']) == '' else str(model['kernel'])
+    model['Dmax'] = float(model['Dmax'])
+    model['gaussian_kernel_sdev'] = float(model['gaussian_kernel_sdev'])
+    model['centered'] = bool(model['centered'])
+    model['kernel_mean'] = float(model['kernel_mean'])
+    model['ref_tcrs'] = [ ( (x[0], x[1], x[2]), (x[3], x[4], x[5]) ) for x in model['ref_tcrs'] ]
+    return model
+
+
+def project_tcrs_into_kpca_space(
+        tcrs,
+        model,
+        num_threads = 1,
+        batch_size = 10000, # limit the size of the tcrdist matrix
+):
+    ''' Place new tcrs into an existing TCRdist kPCA space, returns xy of shape (len(tcrs), num_pcs)
+
+    model is the dict returned by load_kpca_model (or the filename). Only the tcrdists from the new tcrs to
+    the reference tcrs are computed, O(M*N) rather than redoing the kPCA for all N+M
+    '''
+    if isinstance(model, str):
+        model = load_kpca_model(model)
+
+    if model['kernel'] is None and np.isnan(model['Dmax']):
+        print('conga.preprocess.project_tcrs_into_kpca_space:: model is missing Dmax')
+        sys.exit(1)
+
+    xy = np.zeros((len(tcrs), model['projection'].shape[1]))
+    for start in range(0, len(tcrs), batch_size):
+        stop = min(len(tcrs), start+batch_size)
+        D = _calc_tcrdists_for_kpca(tcrs[start:stop], model['organism'], model['ref_tcrs'],
+                                    num_threads=num_threads)
+        K = _tcrdist_kpca_kernel(D, model['kernel'], model['Dmax'], model['gaussian_kernel_sdev'])
+        if model['centered']:
+            K = ( K - K.mean(axis=1)[:,np.newaxis] - model['kernel_col_means'][np.newaxis,:] +
+                  model['kernel_mean'] )
+        xy[start:stop] = K @ model['projection'] - model['xy_mean'][np.newaxis,:]
+    return xy
+
+
+def project_clones_file_into_kpca_space(
+        clones_file,
+        model_file,
+        outfile = None,
+        num_threads = 1,
+):
+    ''' Write a kpcs file for clones_file by projecting into the kPCA space saved in model_file
+    (see make_tcrdist_kernel_pcs_file_from_clones_file)
+    '''
+    model = load_kpca_model(model_file)
+    if outfile is None: # this is the name expected by read_dataset
+        outfile = '{}_AB.dist_{}_kpcs'.format(clones_file[:-4], model['projection'].shape[1])
+
+    df = pd.read_csv(clones_file, sep='\t')
+    tcrs = [ ( ( l.va_gene, l.ja_gene, l.cdr3a ), ( l.vb_gene, l.jb_gene, l.cdr3b ) ) for l in df.itertuples() ]
+    ids = [ l.clone_id for l in df.itertuples() ]
+
+    print(f'projecting {len(tcrs)} clonotypes onto kPCA model with {len(model["ref_tcrs"])} reference tcrs')
+    xy = project_tcrs_into_kpca_space(tcrs, model, num_threads=num_threads)
+
+    write_kpcs_file(outfile, ids, xy)
+
+
 def make_tcrdist_kernel_pcs_file_from_clones_file(
         clones_file,
         organism,
@@ -1299,7 +1837,23 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
         output_distfile = None,
         force_Dmax = None,
         force_tcrdist_cpp = False,
+        num_threads = 1, # for the C++ tcrdist calculation
+        num_landmarks = None, # use the Nystrom approximation with this many landmark tcrs
+        landmark_selection = 'random', # or 'kmeans++', see select_kpca_landmarks
+        nystrom_diagnostic_sample_size = 0, # if >0, compare to exact kPCA on a subsample of this size
+        model_outfile = None, # save a kPCA model for project_clones_file_into_kpca_space (.npz)
 ):
+    ''' Compute the TCRdist kernel PCs and write them to outfile
+
+    If num_landmarks is not None (and less than the number of clonotypes) we use the Nystrom approximation:
+    only the tcrdists between all the clonotypes and the landmarks are computed, and the kernel PCs come
+    from the landmark kernel eigendecomposition. That's O(N*L) memory rather than O(N^2). In this case
+    the default kernel uses the largest tcrdist to a landmark for Dmax (unless force_Dmax is set)
+
+    If model_outfile is not None, the reference tcrs (all the clonotypes, or just the landmarks for
+    Nystrom) and the projection are saved there, so new clonotypes can be placed into this kPCA space
+    later on without redoing the whole thing, see project_clones_file_into_kpca_space
+    '''
     if outfile is None: # this is the name expected by read_dataset above (with n_components_in==50)
         outfile = '{}_AB.dist_{}_kpcs'.format(clones_file[:-4], n_components_in)
 
@@ -1309,17 +1863,48 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
     tcrs = [ ( ( l.va_gene, l.ja_gene, l.cdr3a ), ( l.vb_gene, l.jb_gene, l.cdr3b ) ) for l in df.itertuples() ]
     ids = [ l.clone_id for l in df.itertuples() ]
 
+    if num_landmarks is not None and num_landmarks < len(tcrs) and input_distfile is None: ## EARLY RETURN
+        landmarks = select_kpca_landmarks(tcrs, num_landmarks, landmark_selection)
+        print(f'compute tcrdist distances from {len(tcrs)} clonotypes to {len(landmarks)} {landmark_selection} '
+              'landmarks for Nystrom kPCA')
+        D = _calc_tcrdists_for_kpca(tcrs, organism, [tcrs[x] for x in landmarks], num_threads=num_threads)
+
+        Dmax = D.max() if force_Dmax is None else force_Dmax
+        kernel_fn = lambda x: _tcrdist_kpca_kernel(x, kernel, Dmax, gaussian_kernel_sdev)
+        C = kernel_fn(D)
+        del D
+
+        print(f'running Nystrom KernelPCA with {kernel} kernel, num_landmarks= {len(landmarks)} Dmax= {Dmax}')
+        xy, lambdas, projection, mean = nystrom_kernel_pca(C, C[landmarks], n_components_in)
+
+        if verbose: #show the eigenvalues
+            for ii, lam in enumerate(lambdas):
+                print( 'eigenvalue: {:3d} {:.3f}'.format( ii, lam))
+
+        if nystrom_diagnostic_sample_size:
+            report_nystrom_captured_variance(
+                tcrs, organism, C, projection, kernel_fn, xy.shape[1],
+                sample_size=nystrom_diagnostic_sample_size, num_threads=num_threads)
+
+        if model_outfile is not None:
+            save_kpca_model(
+                model_outfile, organism, [tcrs[x] for x in landmarks], projection, lambdas, kernel, Dmax,
+                gaussian_kernel_sdev, xy_mean=mean)
+
+        write_kpcs_file(outfile, ids, xy)
+        return
+
 
     if input_distfile is None: ## tcr distances
         print(f'compute tcrdist distance matrix for {len(tcrs)} clonotypes')
 
         if tcrdist_cpp_available():
             print('Using C++ TCRdist calculator')
-            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile)
+            D = calc_tcrdist_matrix_cpp(tcrs, organism, outfile, num_threads=num_threads)
         else:
             print('Using Python TCRdist calculator. Consider compiling C++ calculator for faster perfomance.')
             tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+            D = tcrdist_calculator.distance_matrix(tcrs)
     else:
         print(f'reload tcrdist distance matrix for {len(tcrs)} clonotypes')
         D = np.loadtxt(input_distfile)
@@ -1345,19 +1930,30 @@ def make_tcrdist_kernel_pcs_file_from_clones_file(
 
     xy = pca.fit_transform(gram)
 
+    # sklearn renamed lambdas_,alphas_ --> eigenvalues_,eigenvectors_
+    lambdas = getattr(pca, 'eigenvalues_', None)
+    if lambdas is None:
+        lambdas = pca.lambdas_
+    alphas = getattr(pca, 'eigenvectors_', None)
+    if alphas is None:
+        alphas = pca.alphas_
+
     if verbose: #show the eigenvalues
         for ii in range(n_components):
-            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, pca.lambdas_[ii]))
+            print( 'eigenvalue: {:3d} {:.3f}'.format( ii, lambdas[ii]))
+
+    if model_outfile is not None:
+        # sklearn drops the zero-eigenvalue components in transform
+        nonzero = lambdas > 0
+        projection = np.zeros_like(alphas)
+        projection[:,nonzero] = alphas[:,nonzero] / np.sqrt(lambdas[nonzero])[np.newaxis,:]
+        save_kpca_model(
+            model_outfile, organism, tcrs, projection, lambdas, kernel, force_Dmax, gaussian_kernel_sdev,
+            kernel_col_means=gram.mean(axis=0), kernel_mean=gram.mean())
 
     # this is the kpca_file that conga.preprocess.read_dataset is expecting:
     #kpca_file = clones_file[:-4]+'_AB.dist_50_kpcs'
-    print( 'writing TCRdist kernel PCs to outfile:', outfile)
-    out = open(outfile,'w')
-
-    for ii in range(D.shape[0]):
-        out.write('pc_comps: {} {}\n'\
-                  .format( ids[ii], ' '.join( '{:.6f}'.format(xy[ii,j]) for j in range(n_components) ) ) )
-    out.close()
+    write_kpcs_file(outfile, ids, xy)
     return
 
 
@@ -1382,38 +1978,42 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
     if output_distfile is None and (force_tcrdist_cpp or (util.tcrdist_cpp_available() and N>5000)):
         tcrdist_threshold = int(tcrdist_threshold+0.001) # cpp tcrdist threshold is integer
 
-        if os.name == 'posix':
-            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'find_neighbors')
+        if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+            tcrs = [ ( ( l.va_gene, l.ja_gene, l.cdr3a ), ( l.vb_gene, l.jb_gene, l.cdr3b ) )
+                     for l in df.itertuples() ]
+            indptr, indices, distances = tcrdist_lib.calc_tcrdist_threshold_nbrs(tcrs, organism, tcrdist_threshold)
         else:
-            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+            if os.name == 'posix':
+                exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'find_neighbors')
+            else:
+                exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+
+            db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format(organism) )
 
-        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format(organism) )
+            outprefix = old_clones_file + '_calc_tcrdist'
 
-        outprefix = old_clones_file + '_calc_tcrdist'
+            cmd = '{} -f {} -t {} -d {} -o {} --binary'.format(
+                exe, old_clones_file, tcrdist_threshold, db_filename, outprefix)
 
-        cmd = '{} -f {} -t {} -d {} -o {}'.format(exe, old_clones_file, tcrdist_threshold, db_filename, outprefix)
+            util.run_command(cmd, verbose=True)
 
-        util.run_command(cmd, verbose=True)
+            nbr_filenames = util.tcrdist_csr_binary_filenames(outprefix, tcrdist_threshold)
 
-        nbr_indices_filename = '{}_nbr{}_indices.txt'.format(outprefix, tcrdist_threshold)
-        nbr_distances_filename = '{}_nbr{}_distances.txt'.format(outprefix, tcrdist_threshold)
+            if not all(exists(x) for x in nbr_filenames):
+                print('find_neighbors failed:', [exists(x) for x in nbr_filenames])
+                exit(1)
 
-        if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
-            print('find_neighbors failed:', exists(nbr_indices_filename), exists(nbr_distances_filename))
-            exit(1)
+            indptr, indices, distances = util.read_tcrdist_csr_binary(outprefix, tcrdist_threshold)
+        assert indptr.shape[0] == N+1
 
         all_nbrs = []
         all_distances = []
         all_smallest_nbr = []
-        for line1, line2 in zip(open(nbr_indices_filename,'r'), open(nbr_distances_filename,'r')):
-            l1 = line1.split()
-            l2 = line2.split()
-            assert len(l1) == len(l2)
-            ii = len(all_nbrs)
-            all_nbrs.append([ii]+[int(x) for x in l1])
-            all_distances.append([0.]+[float(x) for x in l2])
+        for ii in range(N):
+            start, stop = indptr[ii], indptr[ii+1]
+            all_nbrs.append([ii]+indices[start:stop].tolist())
+            all_distances.append([0.]+distances[start:stop].astype(float).tolist())
             all_smallest_nbr.append(min(all_nbrs[-1]))
-        assert len(all_nbrs) == N
 
         # now do single linkage clustering
         all_smallest_nbr = np.array(all_smallest_nbr)
@@ -1467,7 +2067,7 @@ def condense_clones_file_and_barcode_mapping_file_by_tcrdist(
             D = calc_tcrdist_matrix_cpp(tcrs, organism)
         else:
             tcrdist_calculator = TcrDistCalculator(organism)
-            D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+            D = tcrdist_calculator.distance_matrix(tcrs)
 
         DT = squareform(D, force='tovector')
 
@@ -1536,39 +2136,12 @@ def calc_tcrdist_nbrs_umap_clusters_cpp(
         clustering_resolution = None,
         n_components_umap = 2,
 ):
-    tcrs_filename = outfile_prefix+'_tcrs.tsv'
-    adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_filename, sep='\t', index=False)
-
-    if os.name == 'posix':
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+    if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+        knn_indices, knn_distances = tcrdist_lib.calc_tcrdist_knn(
+            retrieve_tcrs_from_adata(adata), adata.uns['organism'], num_nbrs)
     else:
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
-
-    if not exists(exe):
-        print('need to compile c++ exe:', exe)
-        exit(1)
-
-    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), 'tcrdist_info_{}.txt'.format(adata.uns['organism']) )
-
-    if not exists(db_filename):
-        print('need to create database file:', db_filename)
-        exit(1)
-
-    outprefix = outfile_prefix+'_calc_tcrdist'
-
-    cmd = '{} -f {} -n {} -d {} -o {}'.format(exe, tcrs_filename, num_nbrs, db_filename, outprefix)
-
-    util.run_command(cmd, verbose=True)
-
-    knn_indices_filename = outprefix+'_knn_indices.txt'
-    knn_distances_filename = outprefix+'_knn_distances.txt'
-
-    if not exists(knn_indices_filename) or not exists(knn_distances_filename):
-        print('find_neighbors failed:', exists(knn_indices_filename), exists(knn_distances_filename))
-        exit(1)
-
-    knn_indices = np.loadtxt(knn_indices_filename, dtype=int)
-    knn_distances = np.loadtxt(knn_distances_filename, dtype=float)
+        knn_indices, knn_distances = _run_find_neighbors_knn(adata, num_nbrs, outfile_prefix)
+    knn_indices, knn_distances = knn_indices.astype(int), knn_distances.astype(float)
 
     # distances = sc.neighbors.get_sparse_matrix_from_indices_distances_numpy(
     #     knn_indices, knn_distances, adata.shape[0], num_nbrs)
@@ -1620,15 +2193,29 @@ def calc_tcrdist_matrix_cpp(
         tcrs,
         organism,
         tmpfile_prefix = None,
+        num_threads = 1,
+        target_tcrs = None,
 ):
+    ''' returns the matrix of tcrdists between tcrs (rows) and target_tcrs (columns)
+
+    target_tcrs=None means target_tcrs = tcrs
+    '''
+    if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+        return tcrdist_lib.calc_tcrdist_matrix(
+            tcrs, organism, target_tcrs=target_tcrs, num_threads=num_threads).astype(float)
+
     if tmpfile_prefix is None:
         tmpfile_prefix = Path('./tmp_tcrdists{}'.format(random.randrange(1,10000)))
 
     tcrs_filename = str(tmpfile_prefix) +'_tcrs.tsv'
+    target_tcrs_filename = str(tmpfile_prefix) +'_target_tcrs.tsv'
 
-    df = pd.DataFrame(dict(va=[x[0][0] for x in tcrs], cdr3a=[x[0][2] for x in tcrs],
-                           vb=[x[1][0] for x in tcrs], cdr3b=[x[1][2] for x in tcrs]))
-    df.to_csv(tcrs_filename, sep='\t', index=False)
+    for ttcrs, filename in [[tcrs, tcrs_filename], [target_tcrs, target_tcrs_filename]]:
+        if ttcrs is None:
+            continue
+        df = pd.DataFrame(dict(va=[x[0][0] for x in ttcrs], cdr3a=[x[0][2] for x in ttcrs],
+                               vb=[x[1][0] for x in ttcrs], cdr3b=[x[1][2] for x in ttcrs]))
+        df.to_csv(filename, sep='\t', index=False)
 
     if os.name == 'posix':
         exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
@@ -1645,19 +2232,23 @@ def calc_tcrdist_matrix_cpp(
         print('need to create database file:', db_filename)
         exit(1)
 
-    cmd = '{} -f {} --only_tcrdists -d {} -o {}'.format(exe, tcrs_filename, db_filename, tmpfile_prefix)
+    cmd = '{} -f {} --only_tcrdists --binary -d {} -o {} --threads {}'.format(
+        exe, tcrs_filename, db_filename, tmpfile_prefix, num_threads)
+    if target_tcrs is not None:
+        cmd += f' --target_tcrs_file {target_tcrs_filename}'
 
     util.run_command(cmd, verbose=True)
 
-    tcrdist_matrix_filename = str(tmpfile_prefix) +'_tcrdists.txt'
+    tcrdist_matrix_filename = str(tmpfile_prefix) +'_tcrdists.bin'
 
     if not exists(tcrdist_matrix_filename):
         print('find_neighbors failed, missing', tcrdist_matrix_filename)
         exit(1)
 
-    D = np.loadtxt(tcrdist_matrix_filename).astype(float)
+    D = util.read_tcrdist_binary_array(tcrdist_matrix_filename).astype(float)
+    assert D.shape == (len(tcrs), len(tcrs) if target_tcrs is None else len(target_tcrs))
 
-    for filename in [tcrs_filename, tcrdist_matrix_filename]:
+    for filename in [tcrs_filename, tcrdist_matrix_filename] + ([] if target_tcrs is None else [target_tcrs_filename]):
         os.remove(filename)
 
     return D
@@ -1886,7 +2477,7 @@ def make_tcrdist_kernel_pcs_file_from_clones_file_V2(
     else:
         print('Using Python TCRdist calculator. Consider compiling C++ calculator for faster perfomance.')
         tcrdist_calculator = TcrDistCalculator(organism)
-        D = np.array( [ tcrdist_calculator(x,y) for x in tcrs for y in tcrs ] ).reshape( (len(tcrs), len(tcrs)) )
+        D = tcrdist_calculator.distance_matrix(tcrs)
 
     n_components = min( n_components_in, D.shape[0] )
 
@@ -0,0 +1,163 @@
+######################################################################################################################
+# batched Mann-Whitney U tests for (nbrhood, feature) pairs
+#
+# scipy.stats.mannwhitneyu re-ranks the full feature vector for every test. Here we rank each feature once
+#  (midranks for ties, plus the tie-correction term) and then the fg rank sum for any nbrhood is just the sum of
+#  the ranks over the nbrhood members, so the U statistics for many nbrhoods come from one sparse product
+#  (nbrhood indicator matrix) @ (rank matrix). P-values use the normal approximation with tie and continuity
+#  corrections, ie the same as scipy.stats.mannwhitneyu(..., method='asymptotic'). Note that this is always
+#  asymptotic, whereas the scipy default (method='auto') uses the exact distribution when one of the samples has
+#  at most 8 members and there are no ties, so p-values for very small nbrhoods can differ from that default
+#
+# sparse features: all the zeros in a column share one midrank (the "base" rank), and we store the ranks minus
+#  that base, so the rank matrix has the same sparsity as the feature matrix
+#
+import numpy as np
+import scipy.sparse as sps
+import sys
+from scipy.stats import norm
+
+
+def rank_features( X ):
+    ''' Rank each column of X (num_samples, num_features), which can be dense or sparse
+
+    returns ranks, base, tie_term where
+    - the midrank of X[i,j] is ranks[i,j] + base[j]
+    - ranks is a sps.csc_matrix if X is sparse (zero where X is zero), otherwise a dense array
+    - tie_term[j] = sum over groups of tied values in column j of (t**3 - t), for the variance correction
+    '''
+    num_samples, num_features = X.shape
+    if sps.issparse(X):
+        X = sps.csc_matrix(X, dtype=float, copy=True)
+        X.eliminate_zeros()
+        X.sort_indices()
+        data, indices, indptr = X.data, X.indices, X.indptr
+    else: # every entry is "explicit"
+        data = np.asarray(X, dtype=float).T.ravel()
+        indices = np.tile(np.arange(num_samples), num_features)
+        indptr = np.arange(num_features+1) * num_samples
+
+    col_sizes = np.diff(indptr)
+    cols = np.repeat(np.arange(num_features), col_sizes)
+    num_zeros = num_samples - col_sizes # the implicit zeros, tied with one another
+    num_neg = np.bincount(cols[data<0], minlength=num_features)
+
+    # sort the explicit values within each column and assign midranks to runs of tied values
+    order = np.lexsort((data, cols))
+    sorted_data, sorted_cols = data[order], cols[order]
+    nnz = data.shape[0]
+    is_run_start = np.ones((nnz,), dtype=bool)
+    is_run_start[1:] = (sorted_data[1:] != sorted_data[:-1]) | (sorted_cols[1:] != sorted_cols[:-1])
+    run_starts = np.nonzero(is_run_start)[0]
+    run_lengths = np.diff(np.append(run_starts, nnz))
+    run_ids = np.cumsum(is_run_start)-1
+
+    positions = np.arange(nnz) - indptr[sorted_cols] # 0-indexed position among the explicit values in the column
+    run_start_positions = positions[run_starts]
+    midranks = run_start_positions[run_ids] + (run_lengths[run_ids]+1)/2.0
+    midranks += (sorted_data>0) * num_zeros[sorted_cols] # the zeros come between the negatives and the positives
+
+    base = num_neg + (num_zeros+1)/2.0
+    base[num_zeros==0] = 0.
+    sorted_ranks = midranks - base[sorted_cols]
+
+    run_cols = sorted_cols[run_starts]
+    tie_term = np.bincount(run_cols, weights=run_lengths**3 - run_lengths, minlength=num_features).astype(float)
+    tie_term += num_zeros.astype(float)**3 - num_zeros
+
+    rank_data = np.empty((nnz,))
+    rank_data[order] = sorted_ranks
+
+    if sps.issparse(X):
+        ranks = sps.csc_matrix( (rank_data, indices.copy(), indptr.copy()), shape=X.shape)
+    else:
+        ranks = rank_data.reshape((num_features, num_samples)).T.copy()
+    return ranks, base, tie_term
+
+
+def rank_sum_pvalues(
+        rank_sums,
+        num_fg,
+        num_samples,
+        tie_term,
+        alternative = 'two-sided', # or 'greater' or 'less' (for the fg relative to the bg)
+        use_continuity = True,
+):
+    ''' Mann-Whitney U statistics and normal-approximation p-values from fg rank sums
+
+    all the arguments broadcast against each other; returns U1, pvals where U1 is the fg U statistic
+    '''
+    n1 = np.asarray(num_fg, dtype=float)
+    n2 = num_samples - n1
+    U1 = rank_sums - n1*(n1+1)/2.
+    U2 = n1*n2 - U1
+    mu = n1*n2/2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt( n1*n2/12. * ( (num_samples+1) - tie_term/(num_samples*(num_samples-1.)) ) )
+
+        if alternative == 'greater':
+            U = U1
+        elif alternative == 'less':
+            U = U2
+        elif alternative == 'two-sided':
+            U = np.maximum(U1, U2)
+        else:
+            print('conga.rank_tests.rank_sum_pvalues:: unrecognized alternative:', alternative)
+            sys.exit(1)
+
+        z = (U - mu - (0.5 if use_continuity else 0.)) / sigma
+        pvals = norm.sf(z)
+    if alternative == 'two-sided':
+        pvals = np.minimum(1., 2*pvals)
+    pvals = np.where(np.isnan(pvals), 1., pvals) # no variation, eg all values tied
+    return U1, pvals
+
+
+def nbrhood_mwu_pvalues(
+        A,
+        X,
+        alternative = 'two-sided',
+        feature_ranks = None, # the output of rank_features(X), to avoid re-ranking
+):
+    ''' Mann-Whitney U p-values comparing each nbrhood to the rest of the samples, for all features
+
+    A is the (num_nbrhoods, num_samples) sparse 0/1 nbrhood indicator matrix (no explicit zeros)
+
+    returns dense (num_nbrhoods, num_features) array of pvals
+    '''
+    ranks, base, tie_term = rank_features(X) if feature_ranks is None else feature_ranks
+    A = sps.csr_matrix(A)
+    num_fg = A.getnnz(axis=1)[:,np.newaxis]
+    rank_sums = A @ ranks
+    if sps.issparse(rank_sums):
+        rank_sums = rank_sums.toarray()
+    rank_sums = rank_sums + num_fg * base[np.newaxis,:]
+    return rank_sum_pvalues(rank_sums, num_fg, A.shape[1], tie_term[np.newaxis,:], alternative)[1]
+
+
+def nbrhood_mwu_pvalues_for_pairs(
+        A,
+        nbrhood_indices,
+        feature_indices,
+        feature_ranks,
+        alternative = 'two-sided',
+):
+    ''' Like nbrhood_mwu_pvalues but just for the (nbrhood, feature) pairs
+    (nbrhood_indices[k], feature_indices[k])
+
+    feature_ranks is the output of rank_features; returns 1D array of pvals
+    '''
+    ranks, base, tie_term = feature_ranks
+    nbrhood_indices = np.asarray(nbrhood_indices, dtype=int)
+    feature_indices = np.asarray(feature_indices, dtype=int)
+    if nbrhood_indices.shape[0] == 0:
+        return np.zeros((0,))
+    A = sps.csr_matrix(A)
+    fg = A[nbrhood_indices]
+    num_fg = fg.getnnz(axis=1)
+    # gather the ranks of the fg members of each pair, then sum them up
+    pair_ids = np.repeat(np.arange(nbrhood_indices.shape[0]), num_fg)
+    fg_ranks = np.asarray(ranks[fg.indices, feature_indices[pair_ids]]).ravel()
+    rank_sums = np.bincount(pair_ids, weights=fg_ranks, minlength=nbrhood_indices.shape[0])
+    rank_sums = rank_sums + num_fg * base[feature_indices]
+    return rank_sum_pvalues(rank_sums, num_fg, A.shape[1], tie_term[feature_indices], alternative)[1]
@@ -13,6 +13,8 @@ import numpy as np
 # from scipy.spatial.distance import squareform, cdist
 # from scipy.sparse import issparse#, csr_matrix
 from scipy.stats import poisson
+import scipy.sparse as sps
+from scipy.sparse.csgraph import connected_components
 # from anndata import AnnData
 import sys
 import os
@@ -20,8 +22,19 @@ from sys import exit
 from . import util
 from . import preprocess
 from .tcrdist import tcr_sampler
+from . import tcrdist_lib
 import random
 
+# bump this when the background calculation changes, to invalidate old cache files
+BACKGROUND_CACHE_VERSION = 3
+
+
+def _group_sizes( *groupings ):
+    ''' For each element, the number of elements that share all of its group assignments in groupings
+    '''
+    _, inverse, counts = np.unique( np.vstack(groupings), axis=1, return_inverse=True, return_counts=True)
+    return counts[inverse.ravel()]
+
 
 def estimate_background_tcrdist_distributions(
         organism,
@@ -33,7 +46,19 @@ def estimate_background_tcrdist_distributions(
         background_alpha_chains = None, # default is to get these by shuffling tcrs_for_background_generation
         background_beta_chains = None, #  -- ditto --
         tcrs_for_background_generation = None, # default is to use 'tcrs'
+        random_seed = None, # seed for the background chain resampling, for reproducible results
+        cache_dir = None, # if not None, cache the background counts here, keyed by a hash of the inputs
+        cache_max_bytes = 2*1024**3, # evict least recently used cache files beyond this total size
+        num_threads = 1, # for the junction parsing, background resampling, and C++ calc_distributions
 ):
+    ''' Returns tcrdist_freqs, an array of shape (len(tcrs), max_dist+1) where tcrdist_freqs[i,d] is the
+    (pseudocounted) fraction of background tcrs within tcrdist d of tcrs[i]
+
+    If cache_dir is given, the cumulative background counts are saved there (compressed .npz) and
+    reused when the tcrs, organism, tcrdist database file, max_dist, num_random_samples, random_seed, and any
+    user-supplied background chains are the same. The cache is skipped if random_seed is None and the background
+    chains have to be resampled, since then each call should get a fresh random draw
+    '''
     if not util.tcrdist_cpp_available():
         print('conga.tcr_clumping.estimate_background_tcrdist_distributions:: need to compile the C++ tcrdist executables')
         exit(1)
@@ -50,61 +75,99 @@ def estimate_background_tcrdist_distributions(
 
     max_dist = int(0.1+max_dist) ## need an integer
 
-    if background_alpha_chains is None or background_beta_chains is None:
+    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format( organism))
+
+    need_resampling = background_alpha_chains is None or background_beta_chains is None
+    if cache_dir is not None and random_seed is None and need_resampling:
+        print('estimate_background_tcrdist_distributions: random_seed is None, not using the cache in', cache_dir)
+        cache_dir = None
+
+    if cache_dir is not None:
+        def tcr_strings(tcrs_or_chains):
+            return None if tcrs_or_chains is None else [ str(x) for x in tcrs_or_chains ]
+        cache_key = util.content_hash(
+            'background_tcrdist_counts', BACKGROUND_CACHE_VERSION, organism, util.file_content_hash(db_filename),
+            tcr_strings(tcrs), max_dist, num_random_samples, random_seed, tcr_strings(background_alpha_chains),
+            tcr_strings(background_beta_chains), tcr_strings(tcrs_for_background_generation))
+        cache_file = Path(cache_dir) / f'background_tcrdist_counts_{cache_key}.npz'
+        if exists(cache_file):
+            print('estimate_background_tcrdist_distributions: cache hit:', cache_file)
+            util.touch_cache_file(cache_file)
+            cached = np.load(cache_file)
+            counts, n_bg_pairs = cached['counts'], int(cached['n_bg_pairs'])
+            assert counts.shape == (len(tcrs), max_dist+1)
+            return np.maximum(pseudocount, counts.astype(float))/n_bg_pairs
+        print('estimate_background_tcrdist_distributions: cache miss:', cache_file)
+
+    # a local RNG for the per-chain resampling seeds, so we don't reseed the global random module
+    seed_rng = random.Random(random_seed) if random_seed is not None else random
+
+    if need_resampling:
         # parse the V(D)J junction regions of the tcrs to define split-points for shuffling
-        junctions_df = tcr_sampler.parse_tcr_junctions(organism, tcrs_for_background_generation)
+        junctions_df = tcr_sampler.parse_tcr_junctions(
+            organism, tcrs_for_background_generation, num_processes=num_threads)
 
         # resample shuffled single-chain tcrs
         if background_alpha_chains is None:
             background_alpha_chains = tcr_sampler.resample_shuffled_tcr_chains(
-                organism, num_random_samples, 'A', junctions_df)
+                organism, num_random_samples, 'A', junctions_df, num_processes=num_threads,
+                random_seed=seed_rng.getrandbits(32))
         if background_beta_chains is None:
             background_beta_chains  = tcr_sampler.resample_shuffled_tcr_chains(
-                organism, num_random_samples, 'B', junctions_df)
+                organism, num_random_samples, 'B', junctions_df, num_processes=num_threads,
+                random_seed=seed_rng.getrandbits(32))
 
-    # save all tcrs to files
-    achains_file = str(tmpfile_prefix) + '_bg_achains.tsv'
-    bchains_file = str(tmpfile_prefix) + '_bg_bchains.tsv'
-    tcrs_file = str(tmpfile_prefix) + '_tcrs.tsv'
+    if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+        counts = tcrdist_lib.calc_paired_tcrdist_distributions(
+            tcrs, organism, background_alpha_chains, background_beta_chains, max_dist, num_threads=num_threads)
+    else:
+        # save all tcrs to files
+        achains_file = str(tmpfile_prefix) + '_bg_achains.tsv'
+        bchains_file = str(tmpfile_prefix) + '_bg_bchains.tsv'
+        tcrs_file = str(tmpfile_prefix) + '_tcrs.tsv'
 
-    pd.DataFrame({'va'   :[x[0] for x in background_alpha_chains],
-                  'cdr3a':[x[2] for x in background_alpha_chains]}).to_csv(achains_file, sep='\t', index=False)
+        pd.DataFrame({'va'   :[x[0] for x in background_alpha_chains],
+                      'cdr3a':[x[2] for x in background_alpha_chains]}).to_csv(achains_file, sep='\t', index=False)
 
-    pd.DataFrame({'vb'   :[x[0] for x in background_beta_chains ],
-                  'cdr3b':[x[2] for x in background_beta_chains ]}).to_csv(bchains_file, sep='\t', index=False)
+        pd.DataFrame({'vb'   :[x[0] for x in background_beta_chains ],
+                      'cdr3b':[x[2] for x in background_beta_chains ]}).to_csv(bchains_file, sep='\t', index=False)
 
-    pd.DataFrame({'va':[x[0][0] for x in tcrs], 'cdr3a':[x[0][2] for x in tcrs],
-                  'vb':[x[1][0] for x in tcrs], 'cdr3b':[x[1][2] for x in tcrs]})\
-      .to_csv(tcrs_file, sep='\t', index=False)
+        pd.DataFrame({'va':[x[0][0] for x in tcrs], 'cdr3a':[x[0][2] for x in tcrs],
+                      'vb':[x[1][0] for x in tcrs], 'cdr3b':[x[1][2] for x in tcrs]})\
+          .to_csv(tcrs_file, sep='\t', index=False)
 
 
-    # compute distributions vs background chains
-    if os.name == 'posix':
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'calc_distributions')
-    else:
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'calc_distributions.exe')
+        # compute distributions vs background chains
+        if os.name == 'posix':
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'calc_distributions')
+        else:
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'calc_distributions.exe')
 
-    outfile = str(tmpfile_prefix) + '_dists.tsv'
+        outfile = str(tmpfile_prefix) + '_dists.tsv'
 
-    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db) , 'tcrdist_info_{}.txt'.format( organism))
+        cmd = '{} -f {} -m {} -d {} -a {} -b {} -o {} -p {}'\
+        .format(exe, tcrs_file, max_dist, db_filename, achains_file, bchains_file, outfile, num_threads)
 
-    cmd = '{} -f {} -m {} -d {} -a {} -b {} -o {}'\
-    .format(exe, tcrs_file, max_dist, db_filename, achains_file, bchains_file, outfile)
+        util.run_command(cmd, verbose=True)
 
-    util.run_command(cmd, verbose=True)
+        if not exists(outfile):
+            print('tcr_clumping:: calc_distributions failed: missing', outfile)
+            exit(1)
 
-    if not exists(outfile):
-        print('tcr_clumping:: calc_distributions failed: missing', outfile)
-        exit(1)
+        counts = np.loadtxt(outfile, dtype=int)
+
+        for filename in [achains_file, bchains_file, tcrs_file, outfile]:
+            os.remove(filename)
 
-    counts = np.loadtxt(outfile, dtype=int)
     counts = np.cumsum(counts, axis=1)
     assert counts.shape == (len(tcrs), max_dist+1)
     n_bg_pairs = len(background_alpha_chains) * len(background_beta_chains)
     tcrdist_freqs = np.maximum(pseudocount, counts.astype(float))/n_bg_pairs
 
-    for filename in [achains_file, bchains_file, tcrs_file, outfile]:
-        os.remove(filename)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez_compressed(cache_file, counts=counts, n_bg_pairs=n_bg_pairs)
+        util.evict_cache_files(cache_dir, cache_max_bytes, pattern='background_tcrdist_counts_*.npz')
 
     return tcrdist_freqs
 
@@ -117,6 +180,9 @@ def assess_tcr_clumping(
         pvalue_threshold = 1.0,
         verbose=True,
         also_find_clumps_within_gex_clusters=False,
+        num_threads=1, # for the C++ find_neighbors and calc_distributions calculations and the bg tcr resampling
+        random_seed=None, # for the background tcr resampling
+        background_cache_dir=None, # cache the background tcrdist distributions here, see estimate_background_...
 ):
     ''' Returns a pandas dataframe with the following columns:
     - clone_index
@@ -147,181 +213,154 @@ def assess_tcr_clumping(
     tcrs = preprocess.retrieve_tcrs_from_adata(adata)
 
     bg_freqs = estimate_background_tcrdist_distributions(
-        adata.uns['organism'], tcrs, max(radii), num_random_samples=num_random_samples, tmpfile_prefix=outprefix)
+        adata.uns['organism'], tcrs, max(radii), num_random_samples=num_random_samples, tmpfile_prefix=outprefix,
+        random_seed=random_seed, cache_dir=background_cache_dir, num_threads=num_threads)
 
-    tcrs_file = outprefix +'_tcrs.tsv'
-    adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_file, sep='\t', index=False)
+    # find neighbors in fg tcrs up to max(radii) #######################################
 
+    agroups, bgroups = preprocess.setup_tcr_groups(adata)
 
-    # find neighbors in fg tcrs up to max(radii) #######################################
+    tcrdist_threshold = max(radii)
 
-    if os.name == 'posix':
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+    if tcrdist_lib.tcrdist_lib_available(): # in-process, no tmpfiles
+        indptr, indices, distances = tcrdist_lib.calc_tcrdist_threshold_nbrs(
+            tcrs, organism, tcrdist_threshold, agroups, bgroups, num_threads=num_threads)
     else:
-        exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
+        tcrs_file = outprefix +'_tcrs.tsv'
+        adata.obs['va cdr3a vb cdr3b'.split()].to_csv(tcrs_file, sep='\t', index=False)
 
-    agroups, bgroups = preprocess.setup_tcr_groups(adata)
-    agroups_filename = outprefix+'_agroups.txt'
-    bgroups_filename = outprefix+'_bgroups.txt'
-    np.savetxt(agroups_filename, agroups, fmt='%d')
-    np.savetxt(bgroups_filename, bgroups, fmt='%d')
+        if os.name == 'posix':
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors')
+        else:
+            exe = Path.joinpath( Path(util.path_to_tcrdist_cpp_bin) , 'find_neighbors.exe')
 
-    db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
+        agroups_filename = outprefix+'_agroups.txt'
+        bgroups_filename = outprefix+'_bgroups.txt'
+        np.savetxt(agroups_filename, agroups, fmt='%d')
+        np.savetxt(bgroups_filename, bgroups, fmt='%d')
 
-    tcrdist_threshold = max(radii)
+        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
 
-    cmd = '{} -f {} -t {} -d {} -o {} -a {} -b {}'\
-    .format(exe, tcrs_file, tcrdist_threshold, db_filename, outprefix, agroups_filename, bgroups_filename)
+        cmd = '{} -f {} -t {} -d {} -o {} -a {} -b {} --binary --threads {}'\
+        .format(exe, tcrs_file, tcrdist_threshold, db_filename, outprefix, agroups_filename, bgroups_filename,
+                num_threads)
 
-    util.run_command(cmd, verbose=True)
+        util.run_command(cmd, verbose=True)
 
-    nbr_indices_filename = outprefix + '_nbr{}_indices.txt'.format( tcrdist_threshold)
-    nbr_distances_filename = outprefix + '_nbr{}_distances.txt'.format( tcrdist_threshold)
+        nbr_filenames = util.tcrdist_csr_binary_filenames(outprefix, tcrdist_threshold)
 
-    if not exists(nbr_indices_filename) or not exists(nbr_distances_filename):
-        print('find_neighbors failed:', exists(nbr_indices_filename), exists(nbr_distances_filename))
-        exit(1)
+        if not all(exists(x) for x in nbr_filenames):
+            print('find_neighbors failed:', [exists(x) for x in nbr_filenames])
+            exit(1)
 
-    all_nbrs = []
-    all_distances = []
-    for line1, line2 in zip(open(nbr_indices_filename,'r'), open(nbr_distances_filename,'r')):
-        l1 = line1.split()
-        l2 = line2.split()
-        assert len(l1) == len(l2)
-        #ii = len(all_nbrs)
-        all_nbrs.append([int(x) for x in l1])
-        all_distances.append([int(x) for x in l2])
-    assert len(all_nbrs) == num_clones
+        indptr, indices, distances = util.read_tcrdist_csr_binary(outprefix, tcrdist_threshold)
+    assert indptr.shape[0] == num_clones+1
+    indices = indices.astype(int)
+    distances = distances.astype(int)
+    rows = np.repeat(np.arange(num_clones), np.diff(indptr))
 
-    clone_sizes = adata.obs['clone_sizes']
+    # sort the nbrs by distance within each row, then the number of nbrs within each radius comes from
+    #  searchsorted on the combined (row, distance) key
+    order = np.lexsort((distances, rows))
+    indices, distances = indices[order], distances[order] # rows is unchanged by the sort
+    max_key = tcrdist_threshold+1
+    sorted_keys = rows * max_key + distances
+    radii_array = np.array(radii)
+    nbr_counts = np.searchsorted(
+        sorted_keys, np.arange(num_clones)[:,np.newaxis] * max_key + radii_array[np.newaxis,:], side='right')
+    nbr_counts -= indptr[:-1,np.newaxis] # shape (num_clones, len(radii))
 
-    # use poisson to find nbrhoods with more tcrs than expected; have to handle agroups/bgroups
-    dfl = []
+    # the nbr lists exclude clones in the same agroup or bgroup, so the max possible number of nbrs is
+    #  num_clones minus the size of the union of those groups (which includes ii itself)
+    asizes, bsizes, absizes = _group_sizes(agroups), _group_sizes(bgroups), _group_sizes(agroups, bgroups)
+    max_nbrs = num_clones - (asizes + bsizes - absizes)
 
-    is_clumped = np.full((num_clones,), False)
+    clone_sizes = np.array(adata.obs['clone_sizes'])
 
     n_bg_pairs = num_random_samples * num_random_samples
 
-    for ii in range(num_clones):
-        ii_freqs = bg_freqs[ii]
-        ii_dists = all_distances[ii]
-        for radius in radii:
-            num_nbrs = np.sum(x<=radius for x in ii_dists)
-            max_nbrs = np.sum( (agroups!=agroups[ii]) & (bgroups!=bgroups[ii]))
-            if num_nbrs:
-                # adjust for number of tests
-                mu = max_nbrs * ii_freqs[radius]
-                pval = len(radii) * num_clones * poisson.sf( num_nbrs-1, mu )
-                if pval< pvalue_threshold:
-                    is_clumped[ii] = True
-                    raw_count = ii_freqs[radius]*n_bg_pairs # if count was 0, will be pseudocount
-                    if verbose:
-                        print('tcr_nbrs_global: {:2d} {:9.6f} radius: {:2d} pval: {:9.1e} {:9.1f} tcr: {:3d} {} {}'\
-                              .format( num_nbrs, mu, radius, pval, raw_count, clone_sizes[ii],
-                                       ' '.join(tcrs[ii][0][:3]), ' '.join(tcrs[ii][1][:3])))
-                    dfl.append( OrderedDict(clump_type='global',
-                                            clone_index=ii,
-                                            nbr_radius=radius,
-                                            pvalue_adj=pval,
-                                            num_nbrs=num_nbrs,
-                                            expected_num_nbrs=mu,
-                                            raw_count=raw_count,
-                                            va   =tcrs[ii][0][0],
-                                            ja   =tcrs[ii][0][1],
-                                            cdr3a=tcrs[ii][0][2],
-                                            vb   =tcrs[ii][1][0],
-                                            jb   =tcrs[ii][1][1],
-                                            cdr3b=tcrs[ii][1][2],
-                    ))
-                if also_find_clumps_within_gex_clusters:
-                    ii_nbrs = all_nbrs[ii]
-                    ii_cluster = clusters_gex[ii]
-                    ii_cluster_mask = (clusters_gex==ii_cluster)
-                    num_nbrs = np.sum( (x<=radius and clusters_gex[y]==ii_cluster) for x,y in zip(ii_dists, ii_nbrs))
-                    if num_nbrs:
-                        max_nbrs = np.sum( (agroups!=agroups[ii]) & (bgroups!=bgroups[ii]) & ii_cluster_mask)
-                        mu = max_nbrs * ii_freqs[radius]
-                        pval = len(radii) * num_clones * poisson.sf( num_nbrs-1, mu )
-                        if pval< pvalue_threshold:
-                            is_clumped[ii] = True
-                            raw_count = ii_freqs[radius]*n_bg_pairs # if count was 0, will be pseudocount
-                            if verbose:
-                                print('tcr_nbrs_intra: {:2d} {:9.6f} radius: {:2d} pval: {:9.1e} {:9.1f} tcr: {:3d} {} {}'\
-                                      .format( num_nbrs, mu, radius, pval, raw_count, clone_sizes[ii],
-                                               ' '.join(tcrs[ii][0][:3]), ' '.join(tcrs[ii][1][:3])))
-                            dfl.append( OrderedDict(clump_type='intra_gex_cluster',
-                                                    clone_index=ii,
-                                                    nbr_radius=radius,
-                                                    pvalue_adj=pval,
-                                                    num_nbrs=num_nbrs,
-                                                    expected_num_nbrs=mu,
-                                                    raw_count=raw_count,
-                                                    va   =tcrs[ii][0][0],
-                                                    ja   =tcrs[ii][0][1],
-                                                    cdr3a=tcrs[ii][0][2],
-                                                    vb   =tcrs[ii][1][0],
-                                                    jb   =tcrs[ii][1][1],
-                                                    cdr3b=tcrs[ii][1][2],
-                            ))
-    results_df = pd.DataFrame(dfl)
+    # use poisson to find nbrhoods with more tcrs than expected; have to handle agroups/bgroups
+    radius_freqs = bg_freqs[:, radii_array] # shape (num_clones, len(radii))
+    all_counts = [ ('global', nbr_counts, max_nbrs[:,np.newaxis] * radius_freqs) ]
+
+    if also_find_clumps_within_gex_clusters:
+        # same thing but only counting nbrs in the same gex cluster
+        same_cluster = clusters_gex[indices] == clusters_gex[rows]
+        intra_counts = np.zeros((num_clones, len(radii)), dtype=int)
+        for ir, radius in enumerate(radii):
+            mask = same_cluster & (distances <= radius)
+            intra_counts[:,ir] = np.bincount(rows[mask], minlength=num_clones)
+        csizes = _group_sizes(clusters_gex)
+        intra_max_nbrs = csizes - ( _group_sizes(clusters_gex, agroups) + _group_sizes(clusters_gex, bgroups) -
+                                    _group_sizes(clusters_gex, agroups, bgroups) )
+        all_counts.append( ('intra_gex_cluster', intra_counts, intra_max_nbrs[:,np.newaxis] * radius_freqs))
+
+    # adjust for number of tests
+    dfl = []
+    for clump_type, counts, mus in all_counts:
+        inds, irs = np.nonzero(counts)
+        pvals = len(radii) * num_clones * poisson.sf( counts[inds,irs]-1, mus[inds,irs] )
+        hits = pvals < pvalue_threshold
+        dfl.append( pd.DataFrame(OrderedDict(
+            clump_type=clump_type,
+            clone_index=inds[hits],
+            nbr_radius=radii_array[irs[hits]],
+            pvalue_adj=pvals[hits],
+            num_nbrs=counts[inds[hits], irs[hits]],
+            expected_num_nbrs=mus[inds[hits], irs[hits]],
+            raw_count=radius_freqs[inds[hits], irs[hits]]*n_bg_pairs, # if count was 0, will be pseudocount
+            radius_index=irs[hits], # for sorting
+        )))
+
+    # same order as looping over clones, then radii, then global before intra
+    results_df = pd.concat(dfl, ignore_index=True)\
+                   .sort_values(['clone_index','radius_index'], kind='stable')\
+                   .drop(columns='radius_index')\
+                   .reset_index(drop=True)
     if results_df.shape[0] == 0:
-        return results_df
-
-    # identify groups of related hits?
-    all_clumped_nbrs = {}
-    for l in results_df.itertuples():
-        ii = l.clone_index
-        radius = l.nbr_radius
-        clumped_nbrs = set(x for x,y in zip(all_nbrs[ii], all_distances[ii]) if y<= radius and is_clumped[x])
-        clumped_nbrs.add(ii)
-        if ii in all_clumped_nbrs:
-            all_clumped_nbrs[ii] = all_clumped_nbrs[ii] | clumped_nbrs
-        else:
-            all_clumped_nbrs[ii] = clumped_nbrs
-
-
-    clumped_inds = sorted(all_clumped_nbrs.keys())
-    assert len(clumped_inds) == np.sum(is_clumped)
-
-    # make nbrs symmetric
-    for ii in clumped_inds:
-        for nbr in all_clumped_nbrs[ii]:
-            assert nbr in all_clumped_nbrs
-            all_clumped_nbrs[nbr].add(ii)
-
-    all_smallest_nbr = {}
-    for ii in clumped_inds:
-        all_smallest_nbr[ii] = min(all_clumped_nbrs[ii])
-
-    while True:
-        updated = False
-        for ii in clumped_inds:
-            nbr = all_smallest_nbr[ii]
-            new_nbr = min(nbr, np.min([all_smallest_nbr[x] for x in all_clumped_nbrs[ii]]))
-            if nbr != new_nbr:
-                all_smallest_nbr[ii] = new_nbr
-                updated = True
-        if not updated:
-            break
-    # define clusters, choose cluster centers
-    clusters = np.array([0]*num_clones) # 0 if not clumped
-
-    cluster_number=0
-    for ii in clumped_inds:
-        nbr = all_smallest_nbr[ii]
-        if ii==nbr:
-            cluster_number += 1
-            members = [ x for x,y in all_smallest_nbr.items() if y==nbr]
-            clusters[members] = cluster_number
-
-    for ii, nbrs in all_clumped_nbrs.items():
-        for nbr in nbrs:
-            assert clusters[ii] == clusters[nbr] # confirm single-linkage clusters
-
-    assert not np.any(clusters[is_clumped]==0)
-    assert np.all(clusters[~is_clumped]==0)
-
-    results_df['clumping_group'] = [ clusters[x.clone_index] for x in results_df.itertuples()]
+        return pd.DataFrame([])
+
+    hit_tcrs = [ tcrs[ii] for ii in results_df.clone_index ]
+    results_df['va'   ] = [ x[0][0] for x in hit_tcrs ]
+    results_df['ja'   ] = [ x[0][1] for x in hit_tcrs ]
+    results_df['cdr3a'] = [ x[0][2] for x in hit_tcrs ]
+    results_df['vb'   ] = [ x[1][0] for x in hit_tcrs ]
+    results_df['jb'   ] = [ x[1][1] for x in hit_tcrs ]
+    results_df['cdr3b'] = [ x[1][2] for x in hit_tcrs ]
+
+    if verbose:
+        for l in results_df.itertuples():
+            ii = l.clone_index
+            print('tcr_nbrs_{}: {:2d} {:9.6f} radius: {:2d} pval: {:9.1e} {:9.1f} tcr: {:3d} {} {}'\
+                  .format( 'global' if l.clump_type=='global' else 'intra', l.num_nbrs, l.expected_num_nbrs,
+                           l.nbr_radius, l.pvalue_adj, l.raw_count, clone_sizes[ii],
+                           ' '.join(tcrs[ii][0][:3]), ' '.join(tcrs[ii][1][:3])))
+
+    is_clumped = np.full((num_clones,), False)
+    is_clumped[results_df.clone_index] = True
+
+    # identify groups of related hits: link each hit clone to the clumped clones within its (largest)
+    #  significant radius, then take single-linkage clusters (connected components)
+    max_hit_radius = np.full((num_clones,), -1)
+    np.maximum.at(max_hit_radius, results_df.clone_index.values, results_df.nbr_radius.values)
+    edges = (distances <= max_hit_radius[rows]) & is_clumped[indices]
+    clumped_inds = np.nonzero(is_clumped)[0]
+    clumped_index = np.full((num_clones,), -1)
+    clumped_index[clumped_inds] = np.arange(clumped_inds.shape[0])
+    graph = sps.csr_matrix(
+        (np.ones(np.sum(edges)), (clumped_index[rows[edges]], clumped_index[indices[edges]])),
+        shape=(clumped_inds.shape[0], clumped_inds.shape[0]))
+    _, labels = connected_components(graph, directed=False)
+
+    # number the clusters 1,2,... in order of their smallest member; 0 if not clumped
+    first_member = np.full((labels.max()+1,), clumped_inds.shape[0])
+    np.minimum.at(first_member, labels, np.arange(clumped_inds.shape[0]))
+    cluster_numbers = np.empty_like(first_member)
+    cluster_numbers[np.argsort(first_member)] = np.arange(1, first_member.shape[0]+1)
+    clusters = np.zeros((num_clones,), dtype=int)
+    clusters[clumped_inds] = cluster_numbers[labels]
+
+    results_df['clumping_group'] = clusters[results_df.clone_index]
 
 
     return results_df
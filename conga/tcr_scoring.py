@@ -3,6 +3,7 @@ from sys import exit
 import math
 from os.path import exists
 from pathlib import Path
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from . import util
@@ -202,20 +203,23 @@ trav_list = [ x[1] for x in sorted( (y,x) for x,y in all_locus_order['A'].items(
 traj_list = [ x[1] for x in sorted( (y,x) for x,y in all_locus_order['A'].items() if x[:4] == 'TRAJ' ) ]
 
 
+trav_index = { x:i for i,x in enumerate(trav_list) }
+traj_index = { x:i for i,x in enumerate(traj_list) }
+
 def alphadist_score_tcr( tcr ):
     global trav_list
     global traj_list
     va, ja = tcr[0][:2]
     va = va[:va.index('*')]
     ja = ja[:ja.index('*')]
-    if va in trav_list:
-        va_dist = len(trav_list)-1 -trav_list.index(va)
+    if va in trav_index:
+        va_dist = len(trav_list)-1 -trav_index[va]
     else:
         #print('alphadist_score_tcr: unrecognized va:', va)
         va_dist = 0.5*(len(trav_list)-1)
 
-    if ja in traj_list:
-        ja_dist = traj_list.index(ja)
+    if ja in traj_index:
+        ja_dist = traj_index[ja]
     else:
         #print('alphadist_score_tcr: unrecognized ja:', ja)
         ja_dist = 0.5*(len(traj_list)-1)
@@ -263,42 +267,134 @@ def property_score_tcr(tcr, score_name, score_mode, alpha_weight=1.0, beta_weigh
              beta_weight  * property_score_cdr3(tcr[1][2], score_name, score_mode ) )
 
 
-def make_tcr_score_table(adata, scorenames):
-    ''' Returns an array of the tcr scores of shape: (adata.shape[0], len(scorenames))
+######################################################################################################################
+# vectorized versions of the per-tcr scores, working from the columnar arrays in
+# preprocess.retrieve_tcr_arrays_from_adata. These give the same values as the per-tcr functions above
+#
+
+@lru_cache(maxsize=None)
+def _aa_property_lookup( score_name ):
+    ''' returns a float array of length 256 mapping ascii code to the aa_props_df[score_name] value (nan if not an aa)
+    '''
+    lookup = np.full((256,), np.nan)
+    for aa, val in aa_props_df[score_name].items():
+        lookup[ord(aa)] = val
+    return lookup
+
+def property_score_cdr3s( cdr3s, lengths, score_name, score_mode ):
+    ''' vectorized property_score_cdr3; cdr3s and lengths as from util.encode_strings_as_padded_array
+    '''
+    lookup = _aa_property_lookup(score_name)
+    if score_mode == cdr3_score_CENTER:
+        # trim off the first 'C', then take the central center_len positions
+        start = 1 + (lengths-1-center_len)//2
+        stop = start + center_len
+        good_mask = (lengths-1 >= center_len)
+    elif score_mode == cdr3_score_FG:
+        start = np.full(lengths.shape, fg_trim)
+        stop = lengths - fg_trim
+        good_mask = (stop > start)
+    else:
+        print( 'property_score_cdr3s:: unrecognized score_mode:', score_mode)
+        exit()
+
+    # add up the positions in order, so the sums match property_score_cdr3 exactly
+    totals = np.zeros((cdr3s.shape[0],))
+    for pos in range(cdr3s.shape[1]):
+        totals += np.where( (start <= pos) & (pos < stop), lookup[cdr3s[:,pos]], 0.0)
+    if np.any(np.isnan(totals[good_mask])):
+        print('property_score_cdr3s:: unrecognized amino acid in cdr3s')
+        exit()
+    return np.where(good_mask, totals/np.maximum(1, stop-start), np.mean(aa_props_df[score_name]))
+
+def _score_by_genes_and_cdr3_lengths( tcr_arrays, score_tcr ):
+    ''' vectorized version of [score_tcr(x) for x in tcrs] for scoring functions that only look at the
+    V and J genes and the cdr3 lengths (alphadist, mait, inkt): score each distinct combination just once
+    '''
+    keys = ['va', 'ja', 'cdr3a_len', 'vb', 'jb', 'cdr3b_len']
+    combos, inverse = np.unique(np.stack([tcr_arrays[k] for k in keys], axis=1), axis=0, return_inverse=True)
+    scores = []
+    for va, ja, len_a, vb, jb, len_b in combos:
+        tcr = ( ( tcr_arrays['va_genes'][va], tcr_arrays['ja_genes'][ja], 'X'*len_a ),
+                ( tcr_arrays['vb_genes'][vb], tcr_arrays['jb_genes'][jb], 'X'*len_b ) )
+        scores.append( score_tcr(tcr) )
+    return np.array(scores, dtype=float)[inverse.ravel()]
+
+@lru_cache(maxsize=None)
+def _gene_feature_keys( organism ):
+    ''' returns gene_keys, count_rep_keys
+
+    gene_keys[gene] and count_rep_keys[count_rep] are the lists of tcr array keys ('va', 'ja', 'vb', or 'jb')
+    that the gene/count_rep occurs in
+    '''
+    gene_keys, count_rep_keys = {}, {}
+    for gene, g in all_genes[organism].items():
+        gene_keys.setdefault(gene, [])
+        count_rep_keys.setdefault(g.count_rep, [])
+        if g.chain in 'AB' and g.region in 'VJ':
+            k = g.region.lower() + g.chain.lower()
+            gene_keys[gene].append(k)
+            if k not in count_rep_keys[g.count_rep]:
+                count_rep_keys[g.count_rep].append(k)
+    return gene_keys, count_rep_keys
+
+def _make_tcr_score_column( adata, name ):
+    ''' returns a numpy array with the score for each tcr in adata, for the scores that only depend on the tcrs
     '''
-    global aa_props_df
     organism = adata.uns['organism']
+    tcr_arrays = pp.retrieve_tcr_arrays_from_adata(adata)
+    gene_keys, count_rep_keys = _gene_feature_keys(organism)
+
+    if name == 'cdr3len':
+        return tcr_arrays['cdr3a_len'] + 2*tcr_arrays['cdr3b_len']
+    elif name == 'alphadist':
+        return _score_by_genes_and_cdr3_lengths(tcr_arrays, alphadist_score_tcr)
+    elif name == 'oldcd8':# the 'old' cd8 score
+        return np.array([ cd8_score_tcr(x) for x in pp.retrieve_tcrs_from_adata(adata) ])
+    elif name == 'cd8': # see comparison between old/new in cd8_scoring.py
+        return np.array(cd8_scoring.make_cd8_score_table_column(pp.retrieve_tcrs_from_adata(adata)))
+    elif name == 'old_imhc':
+        return np.array([ old_imhc_score_tcr(x) for x in pp.retrieve_tcrs_from_adata(adata) ])
+    elif name == 'imhc':
+        return np.array(imhc_scoring.make_imhc_score_table_column(pp.retrieve_tcrs_from_adata(adata), aa_props_df))
+    elif name == 'mait':
+        return _score_by_genes_and_cdr3_lengths(tcr_arrays, lambda x:mait_score_tcr(x, organism))
+    elif name == 'inkt':
+        return _score_by_genes_and_cdr3_lengths(tcr_arrays, lambda x:inkt_score_tcr(x, organism))
+    elif name in gene_keys:
+        assert len(gene_keys[name]) == 1
+        k = gene_keys[name][0]
+        return np.array([float(x==name) for x in tcr_arrays[k+'_genes']])[tcr_arrays[k]]
+    elif name in count_rep_keys:
+        assert len(count_rep_keys[name]) == 1
+        k = count_rep_keys[name][0]
+        organism_genes = all_genes[organism]
+        return np.array([float(organism_genes[x].count_rep==name)
+                         for x in tcr_arrays[k+'_genes']])[tcr_arrays[k]]
+    else:
+        score_mode = name.split('_')[-1]
+        score_name = '_'.join( name.split('_')[:-1])
+        if score_mode not in cdr3_score_modes:
+            score_mode = default_cdr3_score_mode
+            score_name = name
+        # same as property_score_tcr with alpha_weight = beta_weight = 1.0
+        return ( 1.0 * property_score_cdr3s(tcr_arrays['cdr3a'], tcr_arrays['cdr3a_len'], score_name, score_mode) +
+                 1.0 * property_score_cdr3s(tcr_arrays['cdr3b'], tcr_arrays['cdr3b_len'], score_name, score_mode) )
 
-    tcrs = pp.retrieve_tcrs_from_adata(adata)
-    clusters_tcr = np.array(adata.obs['clusters_tcr'])
 
-    organism_genes = all_genes[organism]
-    genes = frozenset( organism_genes.keys())
-    count_reps = frozenset( [ x.count_rep for x in organism_genes.values() ] )
+def make_tcr_score_table(adata, scorenames):
+    ''' Returns an array of the tcr scores of shape: (adata.shape[0], len(scorenames))
+
+    the columns that only depend on the tcrs are memoized (see preprocess.get_tcrs_cache)
+    '''
+    clusters_tcr = np.array(adata.obs['clusters_tcr'])
+    tcrs_cache = pp.get_tcrs_cache(adata)
 
     cols = []
     for name in scorenames:
-        if name == 'cdr3len':
-            cols.append( [ cdr3len_score_tcr(x) for x in tcrs ])
-        elif name.startswith('tcr_cluster'):
+        if name.startswith('tcr_cluster'):
             num = int(name[11:])
             cols.append( [ float(x==num) for x in clusters_tcr])
-        elif name == 'alphadist':
-            cols.append( [ alphadist_score_tcr(x) for x in tcrs ])
-        elif name == 'oldcd8':# the 'old' cd8 score
-            cols.append( [ cd8_score_tcr(x) for x in tcrs ])
-        elif name == 'cd8': # see comparison between old/new in cd8_scoring.py
-            cols.append(cd8_scoring.make_cd8_score_table_column(tcrs))
-        elif name == 'old_imhc':
-            cols.append( [ old_imhc_score_tcr(x) for x in tcrs ])
-        elif name == 'imhc':
-            cols.append( imhc_scoring.make_imhc_score_table_column(tcrs, aa_props_df))
-        elif name == 'mait':
-            organism = adata.uns['organism']
-            cols.append( [ mait_score_tcr(x, organism) for x in tcrs ])
-        elif name == 'inkt':
-            organism = adata.uns['organism']
-            cols.append( [ inkt_score_tcr(x, organism) for x in tcrs ])
         elif name == 'nndists_tcr':
             if 'nndists_tcr' not in adata.obs_keys():
                 print('WARNING nndists_tcr score requested but not present in adata.obs!!!!')
@@ -311,38 +407,13 @@ def make_tcr_score_table(adata, scorenames):
                 cols.append( np.zeros( adata.shape[0] ) )
             else:
                 cols.append( np.array(adata.obs['N_ins']).astype(float) )
-        elif name in genes:
-            matched = False
-            for i_ab,ab in enumerate('AB'):
-                for i_vj,vj in enumerate('VJ'):
-                    ii_genes = set([x for x,y in organism_genes.items() if y.chain==ab and y.region==vj ])
-                    if name in ii_genes:
-                        assert not matched
-                        matched = True
-                        cols.append( [float(x[i_ab][i_vj]==name) for x in tcrs])
-            assert matched
-
-        elif name in count_reps:
-            matched = False
-            for i_ab,ab in enumerate('AB'):
-                for i_vj,vj in enumerate('VJ'):
-                    ii_count_reps = set([x.count_rep for x in organism_genes.values() if x.chain==ab and x.region==vj ])
-                    if name in ii_count_reps:
-                        assert not matched
-                        matched = True
-                        cols.append( [float(organism_genes[x[i_ab][i_vj]].count_rep==name) for x in tcrs])
-            assert matched
-
         else:
-            score_mode = name.split('_')[-1]
-            score_name = '_'.join( name.split('_')[:-1])
-            if score_mode not in cdr3_score_modes:
-                score_mode = default_cdr3_score_mode
-                score_name = name
-            cols.append( [ property_score_tcr(x, score_name, score_mode) for x in tcrs ] )
+            key = ('tcr_score', adata.uns['organism'], name)
+            if key not in tcrs_cache:
+                tcrs_cache[key] = _make_tcr_score_column(adata, name)
+            cols.append( tcrs_cache[key] )
     table = np.array(cols).transpose()#[:,np.newaxis]
     #print( table.shape, (adata.shape[0], len(scorenames)) )
     assert table.shape == (adata.shape[0], len(scorenames))
 
     return table
-
@@ -1,5 +1,9 @@
 import os
+import hashlib
+import pickle
+from collections.abc import Mapping
 from os.path import exists
+from pathlib import Path
 import pandas as pd
 from . import basic
 from .amino_acids import amino_acids
@@ -9,7 +13,6 @@ from . import translation
 cdrs_sep = ';'
 gap_character = '.'
 
-all_genes = {}
 
 class TCR_Gene:
     def __init__( self, l ):
@@ -44,19 +47,25 @@ def trim_allele_to_gene( id ):
 db_file = os.path.dirname(os.path.realpath(__file__))+'/db/'+basic.db_file
 assert exists(db_file)
 
-df = pd.read_csv(db_file, sep='\t')
+# the derived gene info (reps, mm1_reps, count_reps) is pickled here, one file per organism, keyed by a hash of
+#  the db file. Set the CONGA_CACHE_DIR environment variable to use a different location
+cache_dir = Path(os.environ.get('CONGA_CACHE_DIR', Path.home() / '.cache' / 'conga'))
+CACHE_VERSION = 1 # bump this if the setup below changes
 
-for l in df.itertuples():
-    g = TCR_Gene( l )
-    if g.organism not in all_genes:
-        all_genes[g.organism] = {} # map from id to TCR_Gene objects
-    all_genes[g.organism][g.id] = g
+verbose = ( __name__ == '__main__' )
 
+_db_df = None
 
-verbose = ( __name__ == '__main__' )
+def _read_db():
+    global _db_df
+    if _db_df is None:
+        _db_df = pd.read_csv(db_file, sep='\t')
+    return _db_df
 
-for organism,genes in all_genes.items():
 
+def _setup_reps( organism, genes ):
+    ''' sets the rep, mm1_rep, and count_rep fields of the TCR_Gene objects in genes (a dict from id to TCR_Gene)
+    '''
     for ab in 'AB':
         org_merged_loopseqs = {}
         for id,g in genes.items():
@@ -215,12 +224,12 @@ for organism,genes in all_genes.items():
 
     if not basic.CLASSIC_COUNTREPS:
         # simpler scheme for choosing the 'count_rep' field
-        for id, g in all_genes[organism].items():
+        for id, g in genes.items():
             g.count_rep = trim_allele_to_gene(id)
     else:
         for chain in 'AB':
             for vj in 'VJ':
-                allele_gs = [ (id,g) for (id,g) in all_genes[organism].items() if g.chain==chain and g.region==vj]
+                allele_gs = [ (id,g) for (id,g) in genes.items() if g.chain==chain and g.region==vj]
 
                 gene2rep = {}
                 gene2alleles = {}
@@ -246,9 +255,9 @@ for organism,genes in all_genes.items():
                         if verbose:
                             print('multireps:',organism, gene, reps)
                             for allele in gene2alleles[gene]:
-                                print(' '.join(all_genes[organism][allele].cdrs), allele, \
-                                    all_genes[organism][allele].rep, \
-                                    all_genes[organism][allele].mm1_rep)
+                                print(' '.join(genes[allele].cdrs), allele, \
+                                    genes[allele].rep, \
+                                    genes[allele].mm1_rep)
                         assert vj=='V'
 
                         ## we are going to merge these reps
@@ -274,6 +283,77 @@ for organism,genes in all_genes.items():
                         print('countrep:',organism, allele, count_rep)
 
 
+def _cache_filename( organism ):
+    db_hash = hashlib.sha1(open(db_file,'rb').read()).hexdigest()
+    key = hashlib.sha1(f'{db_hash} {organism} {basic.CLASSIC_COUNTREPS} {CACHE_VERSION}'.encode()).hexdigest()
+    return cache_dir / f'all_genes_{organism}_v{CACHE_VERSION}_{key[:16]}.pkl'
+
+def _load_organism_genes( organism ):
+    ''' returns the dict from id to TCR_Gene for organism, from the cache if possible
+    '''
+    use_cache = not verbose # when verbose we want to see the setup output
+    if use_cache:
+        cache_file = _cache_filename(organism)
+        if cache_file.exists():
+            try:
+                with open(cache_file, 'rb') as data:
+                    return pickle.load(data)
+            except Exception as err: # corrupted or incompatible, just recompute
+                print('all_genes:: failed to load cache file', cache_file, err)
+
+    genes = {} # map from id to TCR_Gene objects
+    for l in _read_db().itertuples():
+        if l.organism == organism:
+            g = TCR_Gene( l )
+            genes[g.id] = g
+    _setup_reps(organism, genes)
+
+    if use_cache:
+        try: # write to a temporary file and rename, in case another process is doing the same thing
+            os.makedirs(cache_dir, exist_ok=True)
+            tmpfile = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+            with open(tmpfile, 'wb') as out:
+                pickle.dump(genes, out, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpfile, cache_file)
+        except OSError as err: # eg, read-only home directory
+            print('all_genes:: failed to write cache file', cache_file, err)
+    return genes
+
+
+class _AllGenes(Mapping):
+    ''' map from organism to a dict from gene id to TCR_Gene
+
+    the genes for each organism are loaded the first time that organism is accessed, so importing this module
+    is cheap and we only pay for the organisms we actually use
+    '''
+    def __init__(self):
+        self._organisms = None
+        self._genes = {}
+
+    def _organism_names(self):
+        if self._organisms is None:
+            self._organisms = list(_read_db().organism.unique())
+        return self._organisms
+
+    def __getitem__(self, organism):
+        if organism not in self._genes:
+            if organism not in self._organism_names():
+                raise KeyError(organism)
+            self._genes[organism] = _load_organism_genes(organism)
+        return self._genes[organism]
+
+    def __contains__(self, organism):
+        return organism in self._organism_names()
+
+    def __iter__(self):
+        return iter(self._organism_names())
+
+    def __len__(self):
+        return len(self._organism_names())
+
+all_genes = _AllGenes()
+
+
 if __name__ == '__main__':
     for org, genes in all_genes.items():
         for id, g in genes.items():
@@ -1,4 +1,3 @@
-import numpy as np
 import pandas as pd
 
 from . import basic
@@ -397,12 +396,7 @@ def make_default_logo_svg_cmds(
 
     ## compute distances, used in logo construction for picking the center tcr for aligning against
     #print 'computing distances:',len(dist_tcrs)
-    all_dists = np.zeros( ( len(dist_tcrs), len(dist_tcrs)) )
-    for i,t1 in enumerate( dist_tcrs ):
-        for j in range(i+1,len(dist_tcrs)):
-            dist = tcrdist_calculator.single_chain_distance(t1, dist_tcrs[j])
-            all_dists[i][j] = dist
-            all_dists[j][i] = dist
+    all_dists = tcrdist_calculator.single_chain_distance_matrix(dist_tcrs)
 
     # now make the logo
     members = list(range(len(tcrs)))
@@ -480,7 +474,8 @@ def make_tcr_logo_for_tcrs(
         chain,
         organism,
         pngfile,
-        tcrdist_calculator=None # so we can avoid recalculating V gene distances over and over again
+        tcrdist_calculator=None, # so we can avoid recalculating V gene distances over and over again
+        create_png=True, # if False, just write the svg file (pngfile[:-4]+'.svg')
 ):
     ''' tcrs is a list of tuples: tcrs = [ (atcr1,btcr1), ....
     atcr1 = (va1, ja1, cdr3a1,*)
@@ -519,7 +514,7 @@ def make_tcr_logo_for_tcrs(
     svg_width = 2*xmargin + default_width
     svg_height = 2*ymargin + default_height
 
-    tcrdist_svg_basic.create_file( cmds, svg_width, svg_height, pngfile[:-4]+'.svg', create_png=True )
+    tcrdist_svg_basic.create_file( cmds, svg_width, svg_height, pngfile[:-4]+'.svg', create_png=create_png )
 
     #print default_width,default_height
 
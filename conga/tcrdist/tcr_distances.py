@@ -2,6 +2,7 @@ from .basic import *
 from .all_genes import all_genes, gap_character
 from .amino_acids import amino_acids
 from .tcr_distances_blosum import blosum, bsd4
+import numpy as np
 
 ## see the TcrDistCalculator at the end for simple tcrdist calculations
 
@@ -190,6 +191,97 @@ def compute_distance(t1, t2, chains, rep_dists):
                 weighted_cdr3_distance( t1[3], t2[3] )
     return dist
 
+##################################################################################################################
+## vectorized versions of the above, for computing whole distance matrices
+##
+## the cdr3s are integer-encoded and grouped by length; within a pair of length groups the gap position and the
+## aligned positions are fixed, so the cdr3 distances for all pairs are sums of DISTANCE_MATRIX lookups over
+## whole (block x group) arrays. The distances are all integers, so the sums are exactly the same as
+## weighted_cdr3_distance
+##
+
+def _distance_matrix_array():
+    ''' returns (char_to_index, M) where char_to_index is a length-256 int array (-1 for unknown characters)
+    and M is the DISTANCE_MATRIX as a square int array
+    '''
+    alphabet = sorted(set(a for a,b in DISTANCE_MATRIX))
+    char_to_index = np.full((256,), -1, dtype=np.int64)
+    for i,a in enumerate(alphabet):
+        char_to_index[ord(a)] = i
+    M = np.array([[DISTANCE_MATRIX[(a,b)] for b in alphabet] for a in alphabet], dtype=np.int64)
+    return char_to_index, M
+
+def _encode_cdr3s_by_length( cdr3s, char_to_index ):
+    ''' returns {length: (indices, encoded)} where indices are the positions in cdr3s with that length and
+    encoded is an int array of shape (len(indices), length)
+    '''
+    lengths = np.array([len(x) for x in cdr3s])
+    groups = {}
+    for L in np.unique(lengths):
+        indices = np.nonzero(lengths==L)[0]
+        seqs = ''.join(cdr3s[i] for i in indices).encode()
+        encoded = char_to_index[np.frombuffer(seqs, dtype=np.uint8)].reshape((len(indices), L))
+        if np.any(encoded<0):
+            bad = [cdr3s[i] for i,row in zip(indices, encoded) if np.any(row<0)]
+            print('weighted_cdr3_distance_matrix:: unrecognized characters in cdr3:', bad[0])
+            raise KeyError(bad[0])
+        groups[L] = (indices, encoded)
+    return groups
+
+def _aligned_positions( len1, len2 ):
+    ''' the positions in seq1 and seq2 that are compared in sequence_distance_with_gappos, with the fixed gappos
+    from weighted_cdr3_distance
+    '''
+    lenshort = min(len1, len2)
+    assert lenshort > 1
+    if TRIM_CDR3S:
+        assert lenshort >= 3+2
+    ntrim = 3 if TRIM_CDR3S else 0
+    ctrim = 2 if TRIM_CDR3S else 0
+    gappos = min( 6, 3 + (lenshort-5)//2 )
+    remainder = lenshort-gappos
+    pos1 = list(range(ntrim, gappos)) + [len1-1-i for i in range(ctrim, remainder)]
+    pos2 = list(range(ntrim, gappos)) + [len2-1-i for i in range(ctrim, remainder)]
+    return pos1, pos2
+
+def weighted_cdr3_distance_matrix( cdr3s1, cdr3s2=None, block_size=1000 ):
+    ''' returns float array D of shape (len(cdr3s1), len(cdr3s2)) with D[i,j] = weighted_cdr3_distance(
+    cdr3s1[i], cdr3s2[j]); cdr3s2=None means cdr3s2=cdr3s1
+
+    block_size limits the number of rows computed at once, to bound memory use
+    '''
+    if cdr3s2 is None:
+        cdr3s2 = cdr3s1
+    if ALIGN_CDR3S: # no fixed alignment, fall back to the scalar calculation
+        return np.array([weighted_cdr3_distance(x,y) for x in cdr3s1 for y in cdr3s2], dtype=float)\
+                 .reshape((len(cdr3s1), len(cdr3s2)))
+
+    char_to_index, M = _distance_matrix_array()
+    groups1 = _encode_cdr3s_by_length(cdr3s1, char_to_index)
+    groups2 = groups1 if cdr3s2 is cdr3s1 else _encode_cdr3s_by_length(cdr3s2, char_to_index)
+
+    D = np.zeros((len(cdr3s1), len(cdr3s2)))
+    for len1, (indices1, encoded1) in groups1.items():
+        for len2, (indices2, encoded2) in groups2.items():
+            pos1, pos2 = _aligned_positions(len1, len2)
+            gap_dist = abs(len1-len2) * GAP_PENALTY_CDR3_REGION
+            for start in range(0, len(indices1), block_size):
+                block1 = encoded1[start:start+block_size]
+                dists = np.zeros((block1.shape[0], len(indices2)), dtype=np.int64)
+                for p1, p2 in zip(pos1, pos2):
+                    dists += M[block1[:,p1][:,None], encoded2[:,p2][None,:]]
+                D[np.ix_(indices1[start:start+block_size], indices2)] = WEIGHT_CDR3_REGION * dists + gap_dist
+    return D
+
+def _v_distance_matrix( rep_dists, v_genes1, v_genes2 ):
+    ''' returns float array D of shape (len(v_genes1), len(v_genes2)) with D[i,j] = rep_dists[v_genes1[i]][v_genes2[j]]
+    '''
+    genes1, inverse1 = np.unique(v_genes1, return_inverse=True)
+    genes2, inverse2 = np.unique(v_genes2, return_inverse=True)
+    gene_dists = np.array([[rep_dists[x][y] for y in genes2] for x in genes1], dtype=float)
+    return gene_dists[inverse1[:,None], inverse2[None,:]]
+
+
 ##################################################################################################################
 ##################################################################################################################
 
@@ -251,5 +343,27 @@ class TcrDistCalculator:
         return self.rep_dists[chain1[0]][chain2[0]] + weighted_cdr3_distance(chain1[2], chain2[2])
 
 
+    def distance_matrix(self, tcrs1, tcrs2=None):
+        ''' returns float array D of shape (len(tcrs1), len(tcrs2)) with D[i,j] = self(tcrs1[i], tcrs2[j])
 
-
+        tcrs2=None means tcrs2=tcrs1. Much faster than calling self(x,y) for all pairs
+        '''
+        if tcrs2 is None:
+            tcrs2 = tcrs1
+        D = _v_distance_matrix(self.rep_dists, [x[0][0] for x in tcrs1], [x[0][0] for x in tcrs2])
+        D += weighted_cdr3_distance_matrix([x[0][2] for x in tcrs1], [x[0][2] for x in tcrs2])
+        D += _v_distance_matrix(self.rep_dists, [x[1][0] for x in tcrs1], [x[1][0] for x in tcrs2])
+        D += weighted_cdr3_distance_matrix([x[1][2] for x in tcrs1], [x[1][2] for x in tcrs2])
+        return D
+
+    def single_chain_distance_matrix(self, chains1, chains2=None):
+        ''' returns float array D of shape (len(chains1), len(chains2)) with
+        D[i,j] = self.single_chain_distance(chains1[i], chains2[j])
+
+        chains2=None means chains2=chains1
+        '''
+        if chains2 is None:
+            chains2 = chains1
+        D = _v_distance_matrix(self.rep_dists, [x[0] for x in chains1], [x[0] for x in chains2])
+        D += weighted_cdr3_distance_matrix([x[2] for x in chains1], [x[2] for x in chains2])
+        return D
@@ -1,5 +1,8 @@
 import sys
+import os
 import random
+import multiprocessing
+from functools import lru_cache
 from collections import OrderedDict, Counter
 import pandas as pd
 from .basic import *
@@ -8,10 +11,12 @@ from .all_genes import all_genes, gap_character
 from .genetic_code import genetic_code, reverse_genetic_code
 from . import logo_tools
 
-all_trbd_nucseq = {}
-for organism in all_genes:
+@lru_cache(maxsize=None)
+def get_all_trbd_nucseq( organism ):
+    ''' returns dict from D number (1,2,...) to TRBD nucseq; computed on first use since all_genes is lazy
+    '''
     d_ids = sorted( ( id for id,g in all_genes[organism].items() if g.region == 'D' and g.chain == 'B' ) )
-    all_trbd_nucseq[ organism ] = dict( ( ( d_ids.index(id)+1, all_genes[organism][id].nucseq ) for id in d_ids ) )
+    return dict( ( ( d_ids.index(id)+1, all_genes[organism][id].nucseq ) for id in d_ids ) )
 
 ########################################################################################################################
 default_mismatch_score_for_cdr3_nucseq_probabilities = -4 ## blast is -3
@@ -37,6 +42,7 @@ def count_matches( a,b,mismatch_score=-3 ):
 
 
 
+@lru_cache(maxsize=None)
 def get_v_cdr3_nucseq( organism, v_gene, paranoid = False ):
     vg = all_genes[organism][v_gene]
     ab = vg.chain
@@ -72,6 +78,7 @@ def get_v_cdr3_nucseq( organism, v_gene, paranoid = False ):
     return v_nucseq
 
 
+@lru_cache(maxsize=None)
 def get_j_cdr3_nucseq( organism, j_gene, paranoid = False ):
     jg = all_genes[organism][j_gene]
     ab = jg.chain
@@ -309,7 +316,7 @@ def analyze_junction( organism, v_gene, j_gene, cdr3_protseq, cdr3_nucseq, force
     elif ab == 'B':
         ## look for one of the d-gene segments
         max_overlap = 0
-        for d_id, d_nucseq in all_trbd_nucseq[organism].items():
+        for d_id, d_nucseq in get_all_trbd_nucseq(organism).items():
             if force_d_id and d_id != force_d_id: continue
             for start in range(len(d_nucseq)):
                 for stop in range(start,len(d_nucseq)):
@@ -335,7 +342,7 @@ def analyze_junction( organism, v_gene, j_gene, cdr3_protseq, cdr3_nucseq, force
             d1_trim = best_trim[1]
 
             expected_cdr3_nucseq_len = ( len(v_nucseq) + n_vd_insert +
-                                         len(all_trbd_nucseq[organism][best_d_id]) + n_dj_insert +
+                                         len(get_all_trbd_nucseq(organism)[best_d_id]) + n_dj_insert +
                                          len(j_nucseq) -
                                          ( v_trim + d0_trim + d1_trim + j_trim ) )
             assert len(cdr3_nucseq) == expected_cdr3_nucseq_len
@@ -386,17 +393,14 @@ def analyze_junction( organism, v_gene, j_gene, cdr3_protseq, cdr3_nucseq, force
         return new_nucseq, cdr3_protseq_masked, cdr3_protseq_new_nucleotide_countstring, trims, inserts
 
 
-def parse_tcr_junctions( organism, tcrs ):
-    '''
-    Analyze the junction regions of all the tcrs. Return a pandas dataframe with the results, in the same order
-    as tcrs
+def _parse_tcr_junctions_chunk( args ):
+    ''' Worker for parse_tcr_junctions; args = (organism, start_index, tcrs), returns list of dicts
     '''
+    organism, start_index, tcrs = args
 
     dfl = []
 
-    for ii, (atcr, btcr) in enumerate(tcrs):
-        if ii%1000==0:
-            print('parse_tcr_junctions:', ii, len(tcrs))
+    for ii, (atcr, btcr) in enumerate(tcrs, start=start_index):
         va, ja, cdr3a, cdr3a_nucseq = atcr
         vb, jb, cdr3b, cdr3b_nucseq = btcr
 
@@ -437,6 +441,38 @@ def parse_tcr_junctions( organism, tcrs ):
                                  dj_insert=b_inserts[2],
                                  vj_insert=b_inserts[3],
                                  ))
+    return dfl
+
+
+def _get_process_pool( num_processes, initializer=None, initargs=() ):
+    ''' On posix we fork, so the workers share the (read-only) gene tables etc with the parent
+    '''
+    if os.name == 'posix':
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    return context.Pool(num_processes, initializer=initializer, initargs=initargs)
+
+
+def parse_tcr_junctions( organism, tcrs, num_processes=1, chunk_size=1000 ):
+    '''
+    Analyze the junction regions of all the tcrs. Return a pandas dataframe with the results, in the same order
+    as tcrs
+
+    With num_processes>1 the tcrs are split into chunks of chunk_size that are parsed by a pool of worker
+    processes; the results don't depend on num_processes
+    '''
+    chunks = [ (organism, start, tcrs[start:start+chunk_size]) for start in range(0, len(tcrs), chunk_size) ]
+
+    if num_processes <= 1 or len(chunks) <= 1:
+        dfl = []
+        for chunk in chunks:
+            print('parse_tcr_junctions:', chunk[1], len(tcrs))
+            dfl.extend(_parse_tcr_junctions_chunk(chunk))
+    else:
+        print(f'parse_tcr_junctions: {len(tcrs)} tcrs in {len(chunks)} chunks using {num_processes} processes')
+        with _get_process_pool(num_processes) as pool:
+            dfl = [ x for chunk_dfl in pool.map(_parse_tcr_junctions_chunk, chunks) for x in chunk_dfl ]
 
     return pd.DataFrame(dfl)
 
@@ -448,18 +484,13 @@ def vj_compatible(v_gene, j_gene, organism):
     else:
         return True
 
-def resample_shuffled_tcr_chains(
-        organism,
-        num_samples,
-        chain, # 'A' or 'B'
-        junctions_df, # dataframe made by the above function
-):
-    ''' returns list of (v_gene, j_gene, cdr3, cdr3_nucseq) for inputting into tcrdist calcs (e.g.)
+def setup_junction_breakpoints( junctions_df, chain ):
+    ''' returns list of (v_gene, j_gene, cdr3_nucseq, breakpoints_pre_d, breakpoints_post_d) where the
+    breakpoints are frozensets of the acceptable breakpoints for shuffling, computed from the junction parse
+
+    breakpoints sets could contain negative numbers: that means read from the back
     '''
     assert chain in ['A', 'B']
-    # need list of (v_gene, j_gene, cdr3_nucseq, breakpoints_pre_d, breakpoints_post_d)
-    # breakpoints sets could contain negative numbers: that means read from the back
-    #
     junctions = []
     for l in junctions_df.itertuples():
         # where are the acceptable breakpoints?
@@ -488,24 +519,27 @@ def resample_shuffled_tcr_chains(
                         breakpoints_pre_d.add(bp)
         if chain=='A':
             junctions.append( (l.va, l.ja, l.cdr3a_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
+                               frozenset(breakpoints_pre_d), frozenset(breakpoints_post_d)))
         else:
             junctions.append( (l.vb, l.jb, l.cdr3b_nucseq,
-                               breakpoints_pre_d, breakpoints_post_d))
+                               frozenset(breakpoints_pre_d), frozenset(breakpoints_post_d)))
+    return junctions
+
 
+def _sample_shuffled_chains( organism, chain, junctions, num_samples, rng ):
+    ''' returns new_tcrs, attempts, successes
+    '''
     # repeat:
     # choose 2 random tcrs; are their breakpoints compatible?
     # if so, choose random compatible breakpoint, make frankentcr
 
-
     new_tcrs = []
     attempts = 0
     successes = 0
+    inds = [3] if chain=='A' else [3,4]
     while len(new_tcrs) < num_samples:
-        #print(len(new_tcrs))
-
-        t1 = random.choice(junctions)
-        t2 = random.choice(junctions)
+        t1 = rng.choice(junctions)
+        t2 = rng.choice(junctions)
         nucseq1 = t1[2]
         nucseq2 = t2[2]
         if nucseq1 == nucseq2:
@@ -514,14 +548,13 @@ def resample_shuffled_tcr_chains(
         if not vj_compatible(t1[0], t2[1], organism):
             continue
 
-        inds = [3] if chain=='A' else [3,4]
-        random.shuffle(inds)
+        rng.shuffle(inds)
 
         success = False
         for ind in inds:
             shared = t1[ind] & t2[ind]
             if shared:
-                bp = random.choice(list(shared))
+                bp = rng.choice(sorted(shared))
                 nucseq = nucseq1[: bp] + nucseq2[bp :]
                 assert len(nucseq)%3==0
                 if bp<0: # DEBUGGING
@@ -534,18 +567,66 @@ def resample_shuffled_tcr_chains(
                 if '*' not in cdr3:
                     success = True
                     t_new = ( t1[0], t2[1], cdr3, nucseq)
-                    # print('t1', translation.get_translation(t1[2]), t1)
-                    # print('t2', translation.get_translation(t2[2]), t2)
-                    # print('tn', translation.get_translation(t_new[3]), t_new)
-                    # print(bp, nucseq)
                     new_tcrs.append(t_new)
                     break
-        #print('success:', success)
         attempts += 1
         successes += success
-        if success and len(new_tcrs) >= num_samples:
-            break
-    print(f'success_rate: {100.0*successes/attempts:.2f}')
+    return new_tcrs, attempts, successes
+
+
+# the junctions for the resampling worker processes; set by _set_resampling_junctions in each worker
+#  (with fork this is just inherited from the parent, not copied)
+_resampling_junctions = None
+
+def _set_resampling_junctions( junctions ):
+    global _resampling_junctions
+    _resampling_junctions = junctions
+
+def _resample_block( args ):
+    organism, chain, block_seed, block_size = args
+    return _sample_shuffled_chains( organism, chain, _resampling_junctions, block_size, random.Random(block_seed))
+
+
+def resample_shuffled_tcr_chains(
+        organism,
+        num_samples,
+        chain, # 'A' or 'B'
+        junctions_df, # dataframe made by the above function
+        num_processes = 1,
+        random_seed = None, # default is to take a seed from the global python random module
+        block_size = 1000,
+):
+    ''' returns list of (v_gene, j_gene, cdr3, cdr3_nucseq) for inputting into tcrdist calcs (e.g.)
+
+    The samples are generated in blocks of block_size, each with its own RNG seeded from (random_seed, block
+    number), so the results only depend on random_seed and not on num_processes. With num_processes>1 the
+    blocks are farmed out to a pool of worker processes.
+    '''
+    assert chain in ['A', 'B']
+    # need list of (v_gene, j_gene, cdr3_nucseq, breakpoints_pre_d, breakpoints_post_d)
+    junctions = setup_junction_breakpoints(junctions_df, chain)
+
+    if random_seed is None:
+        random_seed = random.getrandbits(32)
+
+    num_blocks = (num_samples + block_size - 1)//block_size
+    blocks = [ (organism, chain, f'{random_seed}_{chain}_{b}', min(block_size, num_samples - b*block_size))
+               for b in range(num_blocks) ]
+
+    if num_processes <= 1 or num_blocks <= 1:
+        _set_resampling_junctions(junctions)
+        results = [ _resample_block(x) for x in blocks ]
+        _set_resampling_junctions(None)
+    else:
+        with _get_process_pool(num_processes, _set_resampling_junctions, (junctions,)) as pool:
+            results = pool.map(_resample_block, blocks)
+
+    new_tcrs = [ x for block_tcrs, _, _ in results for x in block_tcrs ]
+    attempts = sum(x[1] for x in results)
+    successes = sum(x[2] for x in results)
+    assert len(new_tcrs) == num_samples
+
+    print(f'success_rate: {100.0*successes/max(1,attempts):.2f}')
     return new_tcrs
 
 
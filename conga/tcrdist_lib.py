@@ -0,0 +1,241 @@
+######################################################################################################################
+# in-process tcrdist calculations using the tcrdist_cpp shared library (tcrdist_cpp/bin/libtcrdist.so), via ctypes
+#
+# these give the same results as the find_neighbors and calc_distributions executables, but without the temporary
+#  tsv files, subprocesses, and text parsing. The tcrs are passed to the C++ code as numpy arrays: V gene numbers
+#  plus the CDR3s concatenated into one byte buffer with offsets (see tcrdist_cpp/src/tcrdist_lib.cc)
+#
+# the library is built along with the executables by running make in tcrdist_cpp/; if it's missing, the callers
+#  fall back to the executables (see tcrdist_lib_available)
+#
+import ctypes
+import os
+import sys
+from os.path import exists
+from pathlib import Path
+import numpy as np
+from . import util
+
+_library = None # the ctypes.CDLL, loaded on first use
+_calculators = {} # organism -> handle to the C++ TCRdistCalculators for that organism
+_v_gene_numbers = {} # (organism, chain) -> {v_gene:v_num}
+
+
+def tcrdist_lib_filename():
+    if os.name == 'posix':
+        return Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'libtcrdist.so')
+    else:
+        return Path.joinpath( Path(util.path_to_tcrdist_cpp_bin), 'libtcrdist.dll')
+
+def tcrdist_lib_available():
+    ''' True if the shared library has been compiled and can be loaded
+    '''
+    return _get_library() is not None
+
+
+def _get_library():
+    global _library
+    if _library is None and exists(tcrdist_lib_filename()):
+        try:
+            lib = ctypes.CDLL(str(tcrdist_lib_filename()))
+        except OSError as err:
+            print('conga.tcrdist_lib:: failed to load', tcrdist_lib_filename(), err)
+            return None
+        ptr, i64 = ctypes.c_void_p, ctypes.c_int64
+        tcrs_args = [i64, ptr, ptr, ptr, ptr, ptr, ptr] # num_tcrs, va_nums, cdr3as, offsets, vb_nums, ...
+        chains_args = [i64, ptr, ptr, ptr] # num_chains, v_nums, cdr3s, offsets
+
+        lib.tcrdist_new_calculators.argtypes = [ctypes.c_char_p]
+        lib.tcrdist_new_calculators.restype = ptr
+        lib.tcrdist_delete_calculators.argtypes = [ptr]
+        lib.tcrdist_delete_calculators.restype = None
+        lib.tcrdist_v_gene_number.argtypes = [ptr, ctypes.c_char, ctypes.c_char_p]
+        lib.tcrdist_v_gene_number.restype = i64
+        lib.tcrdist_knn.argtypes = [ptr] + tcrs_args + [ptr, ptr, i64, i64, ptr, ptr]
+        lib.tcrdist_knn.restype = ctypes.c_int
+        lib.tcrdist_threshold_nbrs.argtypes = [ptr] + tcrs_args + [ptr, ptr, i64, i64]
+        lib.tcrdist_threshold_nbrs.restype = ptr
+        lib.tcrdist_csr_nnz.argtypes = [ptr]
+        lib.tcrdist_csr_nnz.restype = i64
+        lib.tcrdist_csr_copy.argtypes = [ptr, ptr, ptr, ptr]
+        lib.tcrdist_csr_copy.restype = None
+        lib.tcrdist_delete_csr.argtypes = [ptr]
+        lib.tcrdist_delete_csr.restype = None
+        lib.tcrdist_matrix.argtypes = [ptr] + tcrs_args + tcrs_args + [i64, ptr]
+        lib.tcrdist_matrix.restype = ctypes.c_int
+        lib.tcrdist_paired_distributions.argtypes = [ptr] + tcrs_args + chains_args + chains_args + [i64, i64, ptr]
+        lib.tcrdist_paired_distributions.restype = ctypes.c_int
+        _library = lib
+    return _library
+
+
+def _get_calculators( organism ):
+    if organism not in _calculators:
+        lib = _get_library()
+        if lib is None:
+            print('conga.tcrdist_lib:: need to compile the C++ tcrdist library:', tcrdist_lib_filename())
+            sys.exit(1)
+        db_filename = Path.joinpath( Path(util.path_to_tcrdist_cpp_db), f'tcrdist_info_{organism}.txt')
+        if not exists(db_filename):
+            print('need to create database file:', db_filename)
+            sys.exit(1)
+        handle = lib.tcrdist_new_calculators(str(db_filename).encode())
+        if not handle:
+            print('conga.tcrdist_lib:: failed to load the tcrdist database:', db_filename)
+            sys.exit(1)
+        _calculators[organism] = handle
+    return _calculators[organism]
+
+
+def _ptr( A ):
+    return None if A is None else A.ctypes.data_as(ctypes.c_void_p)
+
+
+def _encode_single_chains( organism, chain, v_genes, cdr3s ):
+    ''' returns (num_chains, v_nums, cdr3s_buffer, cdr3_offsets) numpy arrays for passing to the library
+    '''
+    key = (organism, chain)
+    if key not in _v_gene_numbers:
+        _v_gene_numbers[key] = {}
+    v_gene_numbers = _v_gene_numbers[key]
+    handle = _get_calculators(organism)
+    for v in set(v_genes):
+        if v not in v_gene_numbers:
+            v_num = _get_library().tcrdist_v_gene_number(handle, chain.encode(), v.encode())
+            if v_num < 0:
+                print(f'conga.tcrdist_lib:: unrecognized {chain} chain V gene: {v} organism: {organism}')
+                sys.exit(1)
+            v_gene_numbers[v] = v_num
+    v_nums = np.array([v_gene_numbers[v] for v in v_genes], dtype=np.int64)
+    cdr3s = [ x.encode() for x in cdr3s ]
+    offsets = np.zeros((len(cdr3s)+1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in cdr3s])
+    buffer = np.frombuffer(b''.join(cdr3s)+b'\0', dtype=np.uint8)
+    return len(cdr3s), v_nums, buffer, offsets
+
+def _encode_paired_tcrs( organism, tcrs ):
+    ''' tcrs is a list of ((va, ja, cdr3a, ...), (vb, jb, cdr3b, ...)), as from preprocess.retrieve_tcrs_from_adata
+
+    returns the list of arrays to pass to the library (keep it around until the call is done)
+    '''
+    num_tcrs, va_nums, cdr3as, cdr3a_offsets = _encode_single_chains(
+        organism, 'A', [x[0][0] for x in tcrs], [x[0][2] for x in tcrs])
+    _, vb_nums, cdr3bs, cdr3b_offsets = _encode_single_chains(
+        organism, 'B', [x[1][0] for x in tcrs], [x[1][2] for x in tcrs])
+    return [num_tcrs, va_nums, cdr3as, cdr3a_offsets, vb_nums, cdr3bs, cdr3b_offsets]
+
+def _as_args( encoded ):
+    return [encoded[0]] + [_ptr(x) for x in encoded[1:]]
+
+def _encode_groups( groups, num_tcrs ):
+    if groups is None:
+        return None
+    groups = np.ascontiguousarray(groups, dtype=np.int64)
+    assert groups.shape == (num_tcrs,)
+    return groups
+
+
+def calc_tcrdist_knn(
+        tcrs,
+        organism,
+        num_nbrs,
+        agroups = None, # exclude nbrs with the same agroup; default is to just exclude self
+        bgroups = None, # -- ditto --
+        num_threads = 1,
+):
+    ''' returns knn_indices, knn_distances, int32 and float32 arrays of shape (len(tcrs), num_nbrs)
+
+    same as find_neighbors -n num_nbrs
+    '''
+    encoded = _encode_paired_tcrs(organism, tcrs)
+    num_tcrs = encoded[0]
+    agroups, bgroups = _encode_groups(agroups, num_tcrs), _encode_groups(bgroups, num_tcrs)
+    knn_indices = np.zeros((num_tcrs, num_nbrs), dtype=np.int32)
+    knn_distances = np.zeros((num_tcrs, num_nbrs), dtype=np.float32)
+    status = _get_library().tcrdist_knn(
+        _get_calculators(organism), *_as_args(encoded), _ptr(agroups), _ptr(bgroups), num_nbrs, num_threads,
+        _ptr(knn_indices), _ptr(knn_distances))
+    if status:
+        print('conga.tcrdist_lib.calc_tcrdist_knn:: failed')
+        sys.exit(1)
+    return knn_indices, knn_distances
+
+
+def calc_tcrdist_threshold_nbrs(
+        tcrs,
+        organism,
+        threshold, # integer
+        agroups = None, # exclude nbrs with the same agroup; default is to just exclude self
+        bgroups = None, # -- ditto --
+        num_threads = 1,
+):
+    ''' returns indptr, indices, distances (1D int64, int32, float32 arrays in scipy CSR layout)
+
+    same as find_neighbors -t threshold; the nbrs of tcr i are indices[indptr[i]:indptr[i+1]]
+    '''
+    encoded = _encode_paired_tcrs(organism, tcrs)
+    num_tcrs = encoded[0]
+    agroups, bgroups = _encode_groups(agroups, num_tcrs), _encode_groups(bgroups, num_tcrs)
+    lib = _get_library()
+    csr = lib.tcrdist_threshold_nbrs(
+        _get_calculators(organism), *_as_args(encoded), _ptr(agroups), _ptr(bgroups), int(threshold),
+        num_threads)
+    if not csr:
+        print('conga.tcrdist_lib.calc_tcrdist_threshold_nbrs:: failed')
+        sys.exit(1)
+    nnz = lib.tcrdist_csr_nnz(csr)
+    indptr = np.zeros((num_tcrs+1,), dtype=np.int64)
+    indices = np.zeros((nnz,), dtype=np.int32)
+    distances = np.zeros((nnz,), dtype=np.float32)
+    lib.tcrdist_csr_copy(csr, _ptr(indptr), _ptr(indices), _ptr(distances))
+    lib.tcrdist_delete_csr(csr)
+    return indptr, indices, distances
+
+
+def calc_tcrdist_matrix(
+        tcrs,
+        organism,
+        target_tcrs = None, # None means target_tcrs = tcrs
+        num_threads = 1,
+):
+    ''' returns float32 array of shape (len(tcrs), len(target_tcrs)) with the tcrdists
+
+    same as find_neighbors --only_tcrdists
+    '''
+    encoded = _encode_paired_tcrs(organism, tcrs)
+    target_encoded = encoded if target_tcrs is None else _encode_paired_tcrs(organism, target_tcrs)
+    D = np.zeros((encoded[0], target_encoded[0]), dtype=np.float32)
+    status = _get_library().tcrdist_matrix(
+        _get_calculators(organism), *_as_args(encoded), *_as_args(target_encoded), num_threads, _ptr(D))
+    if status:
+        print('conga.tcrdist_lib.calc_tcrdist_matrix:: failed')
+        sys.exit(1)
+    return D
+
+
+def calc_paired_tcrdist_distributions(
+        tcrs,
+        organism,
+        background_alpha_chains, # list of (va, ja, cdr3a, ...)
+        background_beta_chains, # list of (vb, jb, cdr3b, ...)
+        max_dist,
+        num_threads = 1,
+):
+    ''' returns int64 array counts of shape (len(tcrs), max_dist+1) where counts[i,d] is the number of
+    (alpha,beta) background chain pairs at paired tcrdist d from tcrs[i] (not cumulative)
+
+    same as calc_distributions
+    '''
+    encoded = _encode_paired_tcrs(organism, tcrs)
+    achains = _encode_single_chains(organism, 'A', [x[0] for x in background_alpha_chains],
+                                    [x[2] for x in background_alpha_chains])
+    bchains = _encode_single_chains(organism, 'B', [x[0] for x in background_beta_chains],
+                                    [x[2] for x in background_beta_chains])
+    counts = np.zeros((encoded[0], max_dist+1), dtype=np.int64)
+    status = _get_library().tcrdist_paired_distributions(
+        _get_calculators(organism), *_as_args(encoded), *_as_args(achains), *_as_args(bchains), max_dist,
+        num_threads, _ptr(counts))
+    if status:
+        print('conga.tcrdist_lib.calc_paired_tcrdist_distributions:: failed')
+        sys.exit(1)
+    return counts
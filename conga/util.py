@@ -7,6 +7,7 @@ import os
 from scipy.sparse import issparse
 from collections import Counter
 import subprocess
+import hashlib
 
 # try not to have any conga imports here
 #
@@ -148,3 +149,119 @@ def get_feature_types_varname( adata ):
     print(adata.var_names)
     return None
 
+
+
+# binary output from the tcrdist_cpp executables (find_neighbors -B); see tcrdist_cpp/src/io.hh
+# 32 byte header of four int64s: magic, dtype_code, nrows, ncols, then the raw row-major data
+TCRDIST_BINARY_MAGIC = 0x54534944524354
+tcrdist_binary_dtypes = {1:np.int32, 2:np.float32, 3:np.int64}
+
+def read_tcrdist_binary_array( filename ):
+    ''' returns a 2D numpy array with shape (nrows, ncols); 1D arrays come back with ncols=1
+    '''
+    header = np.fromfile(filename, dtype=np.int64, count=4)
+    if header.shape[0] != 4 or header[0] != TCRDIST_BINARY_MAGIC:
+        print('ERROR read_tcrdist_binary_array: bad header in file:', filename)
+        sys.exit(1)
+    _, dtype_code, nrows, ncols = header
+    A = np.fromfile(filename, dtype=tcrdist_binary_dtypes[dtype_code], offset=header.nbytes)
+    assert A.shape[0] == nrows*ncols
+    return A.reshape((nrows, ncols))
+
+def read_tcrdist_knn_binary( outprefix ):
+    ''' returns knn_indices, knn_distances, each with shape (num_tcrs, num_nbrs)
+    read from the files written by find_neighbors -n <num_nbrs> -B -o <outprefix>
+    '''
+    knn_indices = read_tcrdist_binary_array(str(outprefix)+'_knn_indices.bin')
+    knn_distances = read_tcrdist_binary_array(str(outprefix)+'_knn_distances.bin')
+    assert knn_indices.shape == knn_distances.shape
+    return knn_indices, knn_distances
+
+def read_tcrdist_csr_binary( outprefix, threshold ):
+    ''' returns indptr, indices, distances (1D arrays in scipy CSR layout)
+    read from the files written by find_neighbors -t <threshold> -B -o <outprefix>
+
+    the nbrs of tcr i are indices[indptr[i]:indptr[i+1]]
+    '''
+    prefix = f'{outprefix}_nbr{threshold}'
+    indptr = read_tcrdist_binary_array(prefix+'_indptr.bin').ravel()
+    indices = read_tcrdist_binary_array(prefix+'_indices.bin').ravel()
+    distances = read_tcrdist_binary_array(prefix+'_distances.bin').ravel()
+    assert indptr[-1] == indices.shape[0] == distances.shape[0]
+    return indptr, indices, distances
+
+def tcrdist_csr_binary_filenames( outprefix, threshold ):
+    prefix = f'{outprefix}_nbr{threshold}'
+    return [ prefix+x for x in ['_indptr.bin', '_indices.bin', '_distances.bin']]
+
+def encode_strings_as_padded_array( strings ):
+    ''' returns (A, lengths) where A is a uint8 array of shape (len(strings), max_len) with the ascii codes of
+    strings[i] in A[i,:lengths[i]], padded with zeros
+    '''
+    encoded = [ x.encode() for x in strings ]
+    lengths = np.array([len(x) for x in encoded], dtype=int)
+    max_len = np.max(lengths) if len(encoded) else 0
+    A = np.zeros((len(encoded), max_len), dtype=np.uint8)
+    mask = np.arange(max_len)[None,:] < lengths[:,None]
+    A[mask] = np.frombuffer(b''.join(encoded), dtype=np.uint8) # row-major order, so this matches the join
+    return A, lengths
+
+def ascii_to_index_table( alphabet ):
+    ''' returns an int array of length 256 with table[ord(alphabet[i])] = i and -1 for everything else, for mapping
+    the output of encode_strings_as_padded_array (eg, amino acids to their position in an amino_acids list)
+    '''
+    table = np.full((256,), -1, dtype=int)
+    for i, a in enumerate(alphabet):
+        table[ord(a)] = i
+    return table
+
+
+# simple on-disk caching of expensive intermediate results
+#
+def content_hash( *objects ):
+    ''' returns a sha1 hex digest of the objects (numpy arrays or things with a stable repr, eg strings,
+    numbers, and lists/tuples/dicts of those)
+    '''
+    h = hashlib.sha1()
+    for obj in objects:
+        if isinstance(obj, np.ndarray):
+            h.update(f'ndarray {obj.dtype} {obj.shape}'.encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            h.update(repr(obj).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def file_content_hash( filename, chunk_size=1<<20 ):
+    ''' returns a sha1 hex digest of the contents of filename, or of all the files below it (with their relative
+    paths) if it's a directory. Returns 'None' if filename is None
+    '''
+    if filename is None:
+        return 'None'
+    path = Path(filename)
+    files = sorted(x for x in path.rglob('*') if x.is_file()) if path.is_dir() else [path]
+    h = hashlib.sha1()
+    for f in files:
+        h.update(str(f.relative_to(path) if path.is_dir() else '').encode()+b'\0')
+        with open(f, 'rb') as data:
+            for chunk in iter(lambda: data.read(chunk_size), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    return h.hexdigest()
+
+def touch_cache_file( filename ):
+    ''' mark a cache file as recently used, for evict_cache_files
+    '''
+    os.utime(filename)
+
+def evict_cache_files( cache_dir, max_bytes, pattern='*' ):
+    ''' delete the least recently used files matching pattern in cache_dir until their total size is <= max_bytes
+    '''
+    files = [ x for x in Path(cache_dir).glob(pattern) if x.is_file() ]
+    files.sort(key=lambda x:x.stat().st_mtime, reverse=True) # most recent first
+    total_bytes = 0
+    for filename in files:
+        total_bytes += filename.stat().st_size
+        if total_bytes > max_bytes:
+            print('evict_cache_files: removing', filename)
+            os.remove(filename)
@@ -17,6 +17,10 @@ parser.add_argument('--no_tcrdists', action='store_true', help='Don\'t compute t
 parser.add_argument('--no_kpcs', action='store_true')
 parser.add_argument('--force_tcrdist_cpp', action='store_true')
 parser.add_argument('--batch_keys', type=str, nargs='*')
+parser.add_argument('--kpca_num_landmarks', type=int, help='Use the Nystrom approximation for the tcrdist kernel PCA with this many landmark TCRs. Much faster and less memory for big merged datasets')
+parser.add_argument('--kpca_landmark_selection', choices=['random', 'kmeans++'], default='random')
+parser.add_argument('--kpca_model_outfile', help='(optional) Save the tcrdist kPCA model (.npz) to this file so that new samples can be projected into the same kPCA space later with --kpca_model_file')
+parser.add_argument('--kpca_model_file', help='Project the merged clonotypes into the existing kPCA space saved in this file (from --kpca_model_outfile) rather than recomputing the kernel PCs')
 
 
 args = parser.parse_args()
@@ -117,10 +121,13 @@ if args.no_tcrdists:
     out.close()
 elif args.no_kpcs:
     pass
+elif args.kpca_model_file:
+    conga.preprocess.project_clones_file_into_kpca_space(args.output_clones_file, args.kpca_model_file)
 else: # the usual route
     conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
         args.output_clones_file, args.organism, input_distfile=input_distfile,
-        output_distfile=args.output_distfile )
+        output_distfile=args.output_distfile, num_landmarks=args.kpca_num_landmarks,
+        landmark_selection=args.kpca_landmark_selection, model_outfile=args.kpca_model_outfile )
 
 if args.output_distfile is None and input_distfile is not None:
     os.remove(input_distfile)
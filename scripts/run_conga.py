@@ -14,9 +14,16 @@ parser.add_argument('--nbr_fracs', type=float, nargs='*', default=[0.01,0.1], he
 parser.add_argument('--outfile_prefix', required=True, help='string that will be prepended to all output files and images')
 parser.add_argument('--restart', help='Name of a scanpy h5ad file to restart from; skips preprocessing, clustering, UMAP, etc. Could be the *_final.h5ad file generated at the end of a previous conga run.')
 parser.add_argument('--checkpoint', action='store_true', help='Save a scanpy h5ad checkpoint file after preprocessing')
+parser.add_argument('--stage_cache_dir', help='Cache the outputs of the setup stages (preprocessing, clustering/UMAP, and the nbr graphs) in this directory, keyed by a hash of their input files and options; reruns that only change downstream options (eg --nbr_fracs or the analysis flags) skip the cached stages')
+parser.add_argument('--dry_run', action='store_true', help='Report which setup stages are cached (see --stage_cache_dir) and which analyses would run, then exit')
 parser.add_argument('--rerun_kpca', action='store_true')
 parser.add_argument('--no_kpca', action='store_true')
 parser.add_argument('--use_exact_tcrdist_nbrs', action='store_true', help='The default is to use the nbrs defined by euclidean distances in the tcrdist kernel pc space. This flag will force a re-computation of all the tcrdist distances')
+parser.add_argument('--approximate_nbrs', action='store_true', help='Use an approximate nearest neighbor index (random projection forest) to find the GEX and TCR kPCA nbrs, rather than computing all pairwise distances. Faster for very large datasets')
+parser.add_argument('--ann_num_trees', type=int, default=8, help='only used if --approximate_nbrs; more trees = more accurate but slower')
+parser.add_argument('--threads', type=int, default=1, help='Number of threads for the C++ TCRdist calculations (--rerun_kpca, --use_exact_tcrdist_nbrs, --tcr_clumping)')
+parser.add_argument('--analysis_processes', type=int, default=1, help='Run the independent analyses (graph_vs_graph, graph_vs_gex_features, graph_vs_tcr_features, tcr_clumping, find_batch_biases, find_hotspot_features) in parallel in this many forked worker processes (posix only); their results are merged back in a fixed order so the outputs match a serial run')
+parser.add_argument('--logo_processes', type=int, default=1, help='Rasterize the svg logos for the logo plots (graph_vs_graph, tcr_clumping, hotspot nbrhoods) by running this many svg-to-png conversions at once; the svg-to-png conversion is often the slowest part of making the logo plots')
 parser.add_argument('--use_tcrdist_umap', action='store_true')
 parser.add_argument('--use_tcrdist_clusters', action='store_true')
 parser.add_argument('--kpca_kernel', help='only used if rerun_kpca is True; if not provided will use classic kernel')
@@ -24,6 +31,13 @@ parser.add_argument('--kpca_gaussian_kernel_sdev', default=100.0, type=float,
                     help='only used if rerun_kpca and kpca_kernel==\'gaussian\'')
 parser.add_argument('--kpca_default_kernel_Dmax', type=float,
                     help='only used if rerun_kpca and kpca_kernel==None')
+parser.add_argument('--kpca_num_landmarks', type=int, help='only used if rerun_kpca; use the Nystrom approximation with this many landmark TCRs (much faster and less memory for big datasets)')
+parser.add_argument('--kpca_landmark_selection', choices=['random', 'kmeans++'], default='random',
+                    help='only used if kpca_num_landmarks is set')
+parser.add_argument('--kpca_nystrom_diagnostic_sample_size', type=int, default=0,
+                    help='only used if kpca_num_landmarks is set; compare captured variance against exact kPCA on a random subsample of this size')
+parser.add_argument('--kpca_model_outfile', help='only used if rerun_kpca; save the tcrdist kPCA model (.npz) here for later use with --kpca_model_file')
+parser.add_argument('--kpca_model_file', help='Place the clonotypes into the existing tcrdist kPCA space saved in this file (by --kpca_model_outfile) rather than recomputing the kernel PCs')
 parser.add_argument('--exclude_gex_clusters', type=int, nargs='*')
 parser.add_argument('--exclude_mait_and_inkt_cells', action='store_true')
 parser.add_argument('--subset_to_CD4', action='store_true')
@@ -79,6 +93,8 @@ parser.add_argument('--batch_keys', type=str, nargs='*')
 parser.add_argument('--exclude_batch_keys_for_biases', type=str, nargs='*')
 parser.add_argument('--radii_for_tcr_clumping', type=int, nargs='*')
 parser.add_argument('--num_random_samples_for_tcr_clumping', type=int)
+parser.add_argument('--random_seed_for_tcr_clumping', type=int, help='Seed for the background TCR resampling in --tcr_clumping, for reproducible results')
+parser.add_argument('--tcr_clumping_cache_dir', help='Cache the --tcr_clumping background tcrdist distributions in this directory; reruns on the same TCRs (with the same radii, num_random_samples, and seed) skip the background calculation. Only used together with --random_seed_for_tcr_clumping')
 parser.add_argument('--gex_nbrhood_tcr_score_names', type=str, nargs='*')
 parser.add_argument('--shuffle_tcr_kpcs', action='store_true') # shuffle the TCR kpcs to test for FDR
 parser.add_argument('--shuffle_gex_nbrs', action='store_true') # for debugging
@@ -95,6 +111,9 @@ import os
 from collections import Counter
 from os.path import exists
 import time
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 sys.path.append( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) ) # in order to import conga package
 import matplotlib
 matplotlib.use('Agg') # for remote calcs
@@ -125,6 +144,25 @@ if args.all:
         print(f'--all implies --{mode} ==> Running {mode} analysis.')
         setattr(args, mode, True)
 
+# the analyses that run after the nbr graphs are computed
+analysis_modes = """graph_vs_graph
+graph_vs_gex_features
+graph_vs_tcr_features
+tcr_clumping
+intra_cluster_tcr_clumping
+find_batch_biases
+make_tcrdist_trees
+cluster_vs_cluster
+plot_cluster_gene_compositions
+find_gex_cluster_degs
+find_hotspot_features
+make_hotspot_nbrhood_logos
+analyze_CD4_CD8
+analyze_proteins
+analyze_special_genes
+find_distance_correlations
+find_pmhc_nbrhood_overlaps""".split()
+
 if args.no_kpca:
     print('--no_kpca implies --use_exact_tcrdist_nbrs and --use_tcrdist_umap --use_tcrdist_clusters')
     print('setting those flags now')
@@ -149,6 +187,102 @@ if args.restart: # these are incompatible with restarting
                  #args.shuffle_tcr_kpcs or
                  args.rerun_kpca )
 
+
+## the setup before the analyses runs as a chain of stages whose outputs can be cached (--stage_cache_dir).
+## Each stage's cache key is a hash of its upstream stages' keys, the contents of its input files, and the values
+## of the args that affect its output, so a rerun that only changes downstream args (eg --nbr_fracs or the
+## analysis flags) loads the earlier stages from the cache. Cached stages don't regenerate their side outputs
+## (qc plots, --checkpoint files, etc); we print a warning if any of those were requested
+##
+STAGE_CACHE_VERSION = 1 # bump this if a stage changes in a way that affects its output
+
+# stage name, upstream stages, args that affect the output, input file args, output file suffix
+pipeline_stages = [
+    ['preprocess', [],
+     '''restart gex_data_type organism rerun_kpca kpca_kernel kpca_gaussian_kernel_sdev kpca_default_kernel_Dmax
+     kpca_num_landmarks kpca_landmark_selection use_exact_tcrdist_nbrs use_tcrdist_umap use_tcrdist_clusters
+     batch_keys exclude_vgene_strings exclude_mait_and_inkt_cells exclude_gex_clusters tenx_agbt
+     filter_ribo_norm_low_cells max_genes_per_cell make_clone_plots average_clone_gex include_protein_features
+     subset_to_CD4 subset_to_CD8 clustering_method clustering_resolution suffix_for_non_gene_features
+     calc_clone_pmhc_pvals'''.split(),
+     'restart gex_data clones_file kpca_file kpca_model_file bad_barcodes_file'.split(), '.h5ad'],
+    ['setup', ['preprocess'],
+     '''exclude_gex_clusters exclude_mait_and_inkt_cells subset_to_CD4 subset_to_CD8 include_protein_features
+     clustering_method clustering_resolution use_tcrdist_umap use_tcrdist_clusters'''.split(),
+     [], '.h5ad'],
+    ['nbrs', ['setup'],
+     'nbr_fracs use_exact_tcrdist_nbrs approximate_nbrs ann_num_trees'.split(),
+     [], '.npz'],
+]
+
+# args for the side outputs (files written along the way) of each stage, which are skipped when it's cached
+stage_side_output_args = {
+    'preprocess': '''qc_plots calc_clone_pmhc_pvals make_clone_plots checkpoint rerun_kpca kpca_model_outfile
+                  kpca_model_file'''.split(), # the last three write the kpca_file (and the kPCA model)
+    'setup': ['checkpoint'] if args.exclude_gex_clusters else [], # only written after excluding clusters
+}
+
+if args.stage_cache_dir and args.shuffle_tcr_kpcs:
+    print('WARNING:: not using the stage cache since --shuffle_tcr_kpcs is random')
+    args.stage_cache_dir = None
+
+# stages that are recomputed even if they are cached (their outputs are still saved to the cache)
+recompute_stages = set()
+if args.rerun_kpca and args.kpca_model_outfile and not exists(args.kpca_model_outfile):
+    print('not loading the preprocess stage from the cache since --kpca_model_outfile does not exist yet:',
+          args.kpca_model_outfile)
+    recompute_stages.add('preprocess')
+
+stage_keys, stage_cache_files = {}, {}
+if args.stage_cache_dir or args.dry_run:
+    for name, upstream, arg_names, file_arg_names, suffix in pipeline_stages:
+        if args.rerun_kpca or args.kpca_model_file: # kpca_file is an output, computed from the clones_file
+            file_arg_names = [x for x in file_arg_names if x != 'kpca_file']
+        stage_keys[name] = conga.util.content_hash(
+            name, STAGE_CACHE_VERSION, [stage_keys[x] for x in upstream],
+            [(x, getattr(args, x)) for x in arg_names],
+            [(x, conga.util.file_content_hash(getattr(args, x))) for x in file_arg_names])
+        if args.stage_cache_dir:
+            stage_cache_files[name] = os.path.join(args.stage_cache_dir, f'{name}_{stage_keys[name]}{suffix}')
+
+if args.dry_run:
+    for name, *_ in pipeline_stages:
+        cached = name in stage_cache_files and exists(stage_cache_files[name]) and name not in recompute_stages
+        print('dry_run: stage {:10s} {:6s} key: {}'.format(name, 'cached' if cached else 'stale', stage_keys[name]))
+    print('dry_run: analyses:', ' '.join(x for x in analysis_modes if getattr(args, x)))
+    sys.exit()
+
+
+def save_adata(adata, filename):
+    adata.write_h5ad(filename)
+
+def load_adata(filename):
+    return sc.read_h5ad(filename)
+
+def run_stage(name, compute, save, load):
+    ''' returns the output of the stage, loaded from the stage cache if possible, otherwise from compute()
+    '''
+    cache_file = stage_cache_files.get(name)
+    if cache_file is not None and exists(cache_file) and name not in recompute_stages:
+        print(f'stage {name}: loading cached output', cache_file)
+        for arg in stage_side_output_args.get(name, []):
+            if getattr(args, arg):
+                print(f'WARNING:: stage {name} is cached, so the --{arg} output is not being regenerated')
+        conga.util.touch_cache_file(cache_file)
+        return load(cache_file)
+    stage_start_time = time.time()
+    output = compute()
+    outlog.write('stage {} took {:.3f} minutes\n'.format(name, (time.time()-stage_start_time)/60))
+    if cache_file is not None:
+        os.makedirs(args.stage_cache_dir, exist_ok=True)
+        suffix = os.path.splitext(cache_file)[1]
+        tmpfile = f'{cache_file[:-len(suffix)]}_{os.getpid()}.tmp{suffix}' # in case other runs share the cache
+        save(output, tmpfile)
+        os.replace(tmpfile, cache_file)
+        print(f'stage {name}: saved output to', cache_file)
+    return output
+
+
 logfile = args.outfile_prefix+'_log.txt'
 outlog = open(logfile, 'w')
 outlog.write('sys.argv: {}\n'.format(' '.join(sys.argv)))
@@ -156,254 +290,279 @@ sc.logging.print_versions() # goes to stdout
 hostname = os.popen('hostname').readlines()[0][:-1]
 outlog.write('hostname: {}\n'.format(hostname))
 
-if args.restart is None:
-    allow_missing_kpca_file = args.use_exact_tcrdist_nbrs and args.use_tcrdist_umap and args.use_tcrdist_clusters
+def run_preprocess_stage():
+    ''' read the dataset (or the --restart h5ad file), filter, reduce to a single cell per clone, cluster, and umap
+    '''
+    if args.restart is None:
+        allow_missing_kpca_file = args.use_exact_tcrdist_nbrs and args.use_tcrdist_umap and args.use_tcrdist_clusters
 
-    assert exists(args.gex_data)
-    assert exists(args.clones_file)
+        assert exists(args.gex_data)
+        assert exists(args.clones_file)
 
-    ## load the dataset
-    if args.rerun_kpca:
-        if args.kpca_file is None:
-            args.kpca_file = args.outfile_prefix+'_rerun_tcrdist_kpca.txt'
-        else:
-            print('WARNING:: overwriting', args.kpca_file, 'since --rerun_kpca is True')
-        conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
-            args.clones_file,
-            args.organism,
-            kernel=args.kpca_kernel,
-            outfile=args.kpca_file,
-            gaussian_kernel_sdev=args.kpca_gaussian_kernel_sdev,
-            force_Dmax=args.kpca_default_kernel_Dmax,
-        )
-
-    adata = conga.preprocess.read_dataset(
-        args.gex_data, args.gex_data_type, args.clones_file, kpca_file=args.kpca_file, # default is None
-        allow_missing_kpca_file=allow_missing_kpca_file, gex_only=False,
-        suffix_for_non_gene_features=args.suffix_for_non_gene_features)
-    assert args.organism
-    adata.uns['organism'] = args.organism
-    assert 'organism' in adata.uns_keys()
-    if args.batch_keys:
-        adata.uns['batch_keys'] = args.batch_keys
-        for k in args.batch_keys:
-            assert k in adata.obs_keys()
-            vals = np.array(adata.obs[k]).astype(int)
-            #assert np.min(vals)==0
-            counts = Counter(vals)
-            expected_choices = np.max(vals)+1
-            observed_choices = len(counts.keys())
-            print(f'read batch info for key {k} with {expected_choices} possible and {observed_choices} observed choices')
-            # confirm integer-value
-            adata.obs[k] = vals
-
-    if args.exclude_vgene_strings:
-        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
-        exclude_mask = np.full((adata.shape[0],),False)
-        for s in args.exclude_vgene_strings:
-            mask = np.array([s in x[0][0] or s in x[1][0] for x in tcrs])
-            print('exclude_vgene_strings:', s, 'num_matches:', np.sum(mask))
-            exclude_mask |= mask
-        adata = adata[~exclude_mask].copy()
-
-    if args.exclude_mait_and_inkt_cells:
-        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
-        if args.organism == 'human':
-            mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
-        elif args.organism == 'mouse':
-            mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
-        else:
-            print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
-            print('ERROR:   but organism is not "human" or "mouse"')
-            sys.exit(1)
-        print('excluding {} mait/inkt cells from dataset of size {}'\
-              .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
-        adata = adata[mask].copy()
-
-
-    if args.tenx_agbt:
-        conga.pmhc_scoring.shorten_pmhc_var_names(adata)
-
-        adata.uns['pmhc_var_names'] = conga.pmhc_scoring.get_tenx_agbt_pmhc_var_names(adata)
-        print('pmhc_var_names:', adata.uns['pmhc_var_names'])
-
-    if args.bad_barcodes_file:
-        bad_barcodes = frozenset([x[:-1] for x in open(args.bad_barcodes_file,'rU')])
-        bad_bc_mask = np.array( [x in bad_barcodes for x in adata.obs_names ] )
-        num_bad = np.sum(bad_bc_mask)
-        if num_bad:
-            print('excluding {} bad barcodes found in {}'\
-                  .format(num_bad, args.bad_barcodes_file))
-            adata = adata[~bad_bc_mask,:].copy()
-        else:
-            print('WARNING:: no matched barcodes in bad_barcodes_file: {}'.format(args.bad_barcodes_file))
+        ## load the dataset
+        if args.rerun_kpca:
+            if args.kpca_file is None:
+                args.kpca_file = args.outfile_prefix+'_rerun_tcrdist_kpca.txt'
+            else:
+                print('WARNING:: overwriting', args.kpca_file, 'since --rerun_kpca is True')
+            conga.preprocess.make_tcrdist_kernel_pcs_file_from_clones_file(
+                args.clones_file,
+                args.organism,
+                kernel=args.kpca_kernel,
+                outfile=args.kpca_file,
+                gaussian_kernel_sdev=args.kpca_gaussian_kernel_sdev,
+                force_Dmax=args.kpca_default_kernel_Dmax,
+                num_threads=args.threads,
+                num_landmarks=args.kpca_num_landmarks,
+                landmark_selection=args.kpca_landmark_selection,
+                nystrom_diagnostic_sample_size=args.kpca_nystrom_diagnostic_sample_size,
+                model_outfile=args.kpca_model_outfile,
+            )
+        elif args.kpca_model_file:
+            if args.kpca_file is None:
+                args.kpca_file = args.outfile_prefix+'_projected_tcrdist_kpca.txt'
+            conga.preprocess.project_clones_file_into_kpca_space(
+                args.clones_file, args.kpca_model_file, outfile=args.kpca_file, num_threads=args.threads)
+
+        adata = conga.preprocess.read_dataset(
+            args.gex_data, args.gex_data_type, args.clones_file, kpca_file=args.kpca_file, # default is None
+            allow_missing_kpca_file=allow_missing_kpca_file, gex_only=False,
+            suffix_for_non_gene_features=args.suffix_for_non_gene_features)
+        assert args.organism
+        adata.uns['organism'] = args.organism
+        assert 'organism' in adata.uns_keys()
+        if args.batch_keys:
+            adata.uns['batch_keys'] = args.batch_keys
+            for k in args.batch_keys:
+                assert k in adata.obs_keys()
+                vals = np.array(adata.obs[k]).astype(int)
+                #assert np.min(vals)==0
+                counts = Counter(vals)
+                expected_choices = np.max(vals)+1
+                observed_choices = len(counts.keys())
+                print(f'read batch info for key {k} with {expected_choices} possible and {observed_choices} observed choices')
+                # confirm integer-value
+                adata.obs[k] = vals
+
+        if args.exclude_vgene_strings:
+            tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
+            exclude_mask = np.full((adata.shape[0],),False)
+            for s in args.exclude_vgene_strings:
+                mask = np.array([s in x[0][0] or s in x[1][0] for x in tcrs])
+                print('exclude_vgene_strings:', s, 'num_matches:', np.sum(mask))
+                exclude_mask |= mask
+            adata = adata[~exclude_mask].copy()
+
+        if args.exclude_mait_and_inkt_cells:
+            tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
+            if args.organism == 'human':
+                mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
+            elif args.organism == 'mouse':
+                mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
+            else:
+                print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
+                print('ERROR:   but organism is not "human" or "mouse"')
+                sys.exit(1)
+            print('excluding {} mait/inkt cells from dataset of size {}'\
+                  .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
+            adata = adata[mask].copy()
+
+
+        if args.tenx_agbt:
+            conga.pmhc_scoring.shorten_pmhc_var_names(adata)
+
+            adata.uns['pmhc_var_names'] = conga.pmhc_scoring.get_tenx_agbt_pmhc_var_names(adata)
+            print('pmhc_var_names:', adata.uns['pmhc_var_names'])
+
+        if args.bad_barcodes_file:
+            bad_barcodes = frozenset([x[:-1] for x in open(args.bad_barcodes_file,'rU')])
+            bad_bc_mask = np.array( [x in bad_barcodes for x in adata.obs_names ] )
+            num_bad = np.sum(bad_bc_mask)
+            if num_bad:
+                print('excluding {} bad barcodes found in {}'\
+                      .format(num_bad, args.bad_barcodes_file))
+                adata = adata[~bad_bc_mask,:].copy()
+            else:
+                print('WARNING:: no matched barcodes in bad_barcodes_file: {}'.format(args.bad_barcodes_file))
 
 
-    assert not adata.isview
-    assert allow_missing_kpca_file or 'X_pca_tcr' in adata.obsm_keys() # tcr-dist kPCA info
-    assert 'cdr3a' in adata.obs # tcr sequence (VDJ) info (plus other obs keys)
+        assert not adata.isview
+        assert allow_missing_kpca_file or 'X_pca_tcr' in adata.obsm_keys() # tcr-dist kPCA info
+        assert 'cdr3a' in adata.obs # tcr sequence (VDJ) info (plus other obs keys)
 
-    print(adata)
+        print(adata)
 
-    outfile_prefix_for_qc_plots = None if args.qc_plots is None else args.outfile_prefix
-    adata = conga.preprocess.filter_and_scale( adata, n_genes = args.max_genes_per_cell,
-                                               outfile_prefix_for_qc_plots = outfile_prefix_for_qc_plots )
+        outfile_prefix_for_qc_plots = None if args.qc_plots is None else args.outfile_prefix
+        adata = conga.preprocess.filter_and_scale( adata, n_genes = args.max_genes_per_cell,
+                                                   outfile_prefix_for_qc_plots = outfile_prefix_for_qc_plots )
 
-    if args.filter_ribo_norm_low_cells:
-        adata = conga.preprocess.filter_cells_by_ribo_norm( adata )
+        if args.filter_ribo_norm_low_cells:
+            adata = conga.preprocess.filter_cells_by_ribo_norm( adata )
 
-    if args.calc_clone_pmhc_pvals: # do this before condensing to a single clone per cell
-        # note that we are doing this after filtering out the ribo-low cells
-        results_df = conga.pmhc_scoring.calc_clone_pmhc_pvals(adata)
-        tsvfile = args.outfile_prefix+'_clone_pvals.tsv'
-        print('making:', tsvfile)
-        results_df.to_csv(tsvfile, sep='\t', index=False)
+        if args.calc_clone_pmhc_pvals: # do this before condensing to a single clone per cell
+            # note that we are doing this after filtering out the ribo-low cells
+            results_df = conga.pmhc_scoring.calc_clone_pmhc_pvals(adata)
+            tsvfile = args.outfile_prefix+'_clone_pvals.tsv'
+            print('making:', tsvfile)
+            results_df.to_csv(tsvfile, sep='\t', index=False)
 
-    if args.make_clone_plots:
-        # need to compute cluster and umaps for these plots
-        # these will be re-computed once we reduce to a single cell per clonotype
-        #
-        print('make_clone_plots: cluster_and_tsne_and_umap')
-        adata = pp.cluster_and_tsne_and_umap( adata, skip_tcr=True )
+        if args.make_clone_plots:
+            # need to compute cluster and umaps for these plots
+            # these will be re-computed once we reduce to a single cell per clonotype
+            #
+            print('make_clone_plots: cluster_and_tsne_and_umap')
+            adata = pp.cluster_and_tsne_and_umap( adata, skip_tcr=True )
 
-        conga.plotting.make_clone_gex_umap_plots(adata, args.outfile_prefix)
+            conga.plotting.make_clone_gex_umap_plots(adata, args.outfile_prefix)
 
 
-    print('run reduce_to_single_cell_per_clone'); sys.stdout.flush()
-    adata = conga.preprocess.reduce_to_single_cell_per_clone( adata, average_clone_gex=args.average_clone_gex )
-    assert 'X_igex' in adata.obsm_keys()
+        print('run reduce_to_single_cell_per_clone'); sys.stdout.flush()
+        adata = conga.preprocess.reduce_to_single_cell_per_clone( adata, average_clone_gex=args.average_clone_gex )
+        assert 'X_igex' in adata.obsm_keys()
 
-    if args.include_protein_features:
-        # this fills X_pca_gex_only, X_pca_gex (combo), X_pca_prot
-        # in the adata.obsm array
-        conga.preprocess.calc_X_pca_gex_including_protein_features(
-            adata, compare_distance_distributions=True)
+        if args.include_protein_features:
+            # this fills X_pca_gex_only, X_pca_gex (combo), X_pca_prot
+            # in the adata.obsm array
+            conga.preprocess.calc_X_pca_gex_including_protein_features(
+                adata, compare_distance_distributions=True)
 
-    if args.shuffle_tcr_kpcs:
-        X_pca_tcr = adata.obsm['X_pca_tcr']
-        assert X_pca_tcr.shape[0] == adata.shape[0]
-        reorder = np.random.permutation(X_pca_tcr.shape[0])
-        adata.obsm['X_pca_tcr'] = X_pca_tcr[reorder,:]
-        outlog.write('randomly permuting X_pca_tcr {}\n'.format(X_pca_tcr.shape))
+        if args.shuffle_tcr_kpcs:
+            X_pca_tcr = adata.obsm['X_pca_tcr']
+            assert X_pca_tcr.shape[0] == adata.shape[0]
+            reorder = np.random.permutation(X_pca_tcr.shape[0])
+            adata.obsm['X_pca_tcr'] = X_pca_tcr[reorder,:]
+            outlog.write('randomly permuting X_pca_tcr {}\n'.format(X_pca_tcr.shape))
 
-    clustering_resolution = 2.0 if (args.subset_to_CD8 or args.subset_to_CD4) else args.clustering_resolution
+        clustering_resolution = 2.0 if (args.subset_to_CD8 or args.subset_to_CD4) else args.clustering_resolution
 
-    print('run cluster_and_tsne_and_umap'); sys.stdout.flush()
-    adata = conga.preprocess.cluster_and_tsne_and_umap(
-        adata, clustering_resolution = clustering_resolution,
-        clustering_method=args.clustering_method,
-        skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
+        print('run cluster_and_tsne_and_umap'); sys.stdout.flush()
+        adata = conga.preprocess.cluster_and_tsne_and_umap(
+            adata, clustering_resolution = clustering_resolution,
+            clustering_method=args.clustering_method,
+            skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
 
-    if args.checkpoint:
-        adata.write_h5ad(args.outfile_prefix+'_checkpoint.h5ad')
+        if args.checkpoint:
+            adata.write_h5ad(args.outfile_prefix+'_checkpoint.h5ad')
+
+        #############################################################################
+    else: ############## restarting from a previous conga run #######################
+        #############################################################################
+
+        assert exists(args.restart)
+        adata = sc.read_h5ad(args.restart)
+        print('recover from h5ad file:', args.restart, adata )
+
+        if 'organism' not in adata.uns_keys():
+            assert args.organism
+            adata.uns['organism'] = args.organism
+
+        if args.exclude_mait_and_inkt_cells and not args.exclude_gex_clusters:
+            # should move this code into a helper function in conga!
+            organism = adata.uns['organism']
+            tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
+            if organism == 'human':
+                mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
+            elif organism == 'mouse':
+                mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
+            else:
+                print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
+                print('ERROR:   but organism is not "human" or "mouse"')
+                sys.exit(1)
+            print('excluding {} mait/inkt cells from dataset of size {}'\
+                  .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
+            adata = adata[mask].copy()
+            # need to redo the cluster/tsne/umap
+            adata = conga.preprocess.cluster_and_tsne_and_umap(
+                adata, clustering_method=args.clustering_method,
+                clustering_resolution=args.clustering_resolution,
+                skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
+
+
+        if args.shuffle_tcr_kpcs:
+            # shuffle the kpcs and anything derived from them that is relevant to GvG (this is just for testing)
+            # NOTE: we need to add shuffling of the neighbors if we are going to recover nbr info rather
+            # than recomputing...
+            X_pca_tcr = adata.obsm['X_pca_tcr']
+            assert X_pca_tcr.shape[0] == adata.shape[0]
+            reorder = np.random.permutation(X_pca_tcr.shape[0])
+            adata.obsm['X_pca_tcr'] = X_pca_tcr[reorder,:]
+            adata.obs['clusters_tcr'] = np.array(adata.obs['clusters_tcr'])[reorder]
+            adata.obsm['X_tcr_2d'] = np.array(adata.obsm['X_tcr_2d'])[reorder,:]
+            print('shuffle_tcr_kpcs:: shuffled X_pca_tcr, clusters_tcr, and X_tcr_2d')
+            outlog.write('randomly permuting X_pca_tcr {}\n'.format(X_pca_tcr.shape))
+
+    return adata
+
+
+adata = run_stage('preprocess', run_preprocess_stage, save_adata, load_adata)
+
+
+def run_setup_stage(adata):
+    ''' exclude gex clusters and subset to CD4/CD8 (reclustering after each), and the tcrdist umap/clusters
+    '''
+    if args.exclude_gex_clusters:
+        xl = args.exclude_gex_clusters
+        clusters_gex = np.array(adata.obs['clusters_gex'])
+        mask = (clusters_gex==xl[0])
+        for c in xl[1:]:
+            mask |= (clusters_gex==c)
+        print('exclude_gex_clusters: exclude {} cells in {} clusters: {}'.format(np.sum(mask), len(xl), xl))
+        sys.stdout.flush()
+        adata = adata[~mask,:].copy()
+
+        if args.exclude_mait_and_inkt_cells:
+            organism = adata.uns['organism']
+            tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
+            if organism == 'human':
+                mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
+            elif organism == 'mouse':
+                mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
+                              conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
+            else:
+                print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
+                print('ERROR:   but organism is not "human" or "mouse"')
+                sys.exit(1)
+            print('excluding {} mait/inkt cells from dataset of size {}'\
+                  .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
+            adata = adata[mask].copy()
 
-    #############################################################################
-else: ############## restarting from a previous conga run #######################
-    #############################################################################
+        adata = conga.preprocess.cluster_and_tsne_and_umap(
+            adata, clustering_method=args.clustering_method,
+            clustering_resolution=args.clustering_resolution,
+            skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
 
-    assert exists(args.restart)
-    adata = sc.read_h5ad(args.restart)
-    print('recover from h5ad file:', args.restart, adata )
+        if args.checkpoint:
+            adata.write_h5ad(args.outfile_prefix+'_checkpoint.h5ad')
 
-    if 'organism' not in adata.uns_keys():
-        assert args.organism
-        adata.uns['organism'] = args.organism
+    if args.subset_to_CD4 or args.subset_to_CD8:
+        assert not (args.subset_to_CD4 and args.subset_to_CD8)
+        which_subset = 'CD4' if args.subset_to_CD4 else 'CD8'
+        adata = conga.preprocess.subset_to_CD4_or_CD8_clusters(
+            adata, which_subset, use_protein_features=args.include_protein_features)
 
-    if args.exclude_mait_and_inkt_cells and not args.exclude_gex_clusters:
-        # should move this code into a helper function in conga!
-        organism = adata.uns['organism']
-        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
-        if organism == 'human':
-            mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
-        elif organism == 'mouse':
-            mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
-        else:
-            print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
-            print('ERROR:   but organism is not "human" or "mouse"')
-            sys.exit(1)
-        print('excluding {} mait/inkt cells from dataset of size {}'\
-              .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
-        adata = adata[mask].copy()
-        # need to redo the cluster/tsne/umap
         adata = conga.preprocess.cluster_and_tsne_and_umap(
             adata, clustering_method=args.clustering_method,
             clustering_resolution=args.clustering_resolution,
             skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
 
 
-    if args.shuffle_tcr_kpcs:
-        # shuffle the kpcs and anything derived from them that is relevant to GvG (this is just for testing)
-        # NOTE: we need to add shuffling of the neighbors if we are going to recover nbr info rather
-        # than recomputing...
-        X_pca_tcr = adata.obsm['X_pca_tcr']
-        assert X_pca_tcr.shape[0] == adata.shape[0]
-        reorder = np.random.permutation(X_pca_tcr.shape[0])
-        adata.obsm['X_pca_tcr'] = X_pca_tcr[reorder,:]
-        adata.obs['clusters_tcr'] = np.array(adata.obs['clusters_tcr'])[reorder]
-        adata.obsm['X_tcr_2d'] = np.array(adata.obsm['X_tcr_2d'])[reorder,:]
-        print('shuffle_tcr_kpcs:: shuffled X_pca_tcr, clusters_tcr, and X_tcr_2d')
-        outlog.write('randomly permuting X_pca_tcr {}\n'.format(X_pca_tcr.shape))
+    if args.use_tcrdist_umap or args.use_tcrdist_clusters:
+        umap_key_added = 'X_tcr_2d' if args.use_tcrdist_umap else 'X_tcrdist_2d'
+        cluster_key_added = 'clusters_tcr' if args.use_tcrdist_clusters else 'clusters_tcrdist'
+        num_nbrs = 10
+        conga.preprocess.calc_tcrdist_nbrs_umap_clusters_cpp(
+            adata, num_nbrs, args.outfile_prefix, umap_key_added=umap_key_added, cluster_key_added=cluster_key_added)
 
+    return adata
 
 
+adata = run_stage('setup', lambda: run_setup_stage(adata), save_adata, load_adata)
 
-if args.exclude_gex_clusters:
-    xl = args.exclude_gex_clusters
-    clusters_gex = np.array(adata.obs['clusters_gex'])
-    mask = (clusters_gex==xl[0])
-    for c in xl[1:]:
-        mask |= (clusters_gex==c)
-    print('exclude_gex_clusters: exclude {} cells in {} clusters: {}'.format(np.sum(mask), len(xl), xl))
-    sys.stdout.flush()
-    adata = adata[~mask,:].copy()
-
-    if args.exclude_mait_and_inkt_cells:
-        organism = adata.uns['organism']
-        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
-        if organism == 'human':
-            mask = [ not (conga.tcr_scoring.is_human_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_human_inkt_tcr(x)) for x in tcrs ]
-        elif organism == 'mouse':
-            mask = [ not (conga.tcr_scoring.is_mouse_mait_alpha_chain(x[0]) or
-                          conga.tcr_scoring.is_mouse_inkt_alpha_chain(x[0])) for x in tcrs ]
-        else:
-            print('ERROR: --exclude_mait_and_inkt_cells option is only compatible with a/b tcrs')
-            print('ERROR:   but organism is not "human" or "mouse"')
-            sys.exit(1)
-        print('excluding {} mait/inkt cells from dataset of size {}'\
-              .format(adata.shape[0]-np.sum(mask), adata.shape[0]))
-        adata = adata[mask].copy()
-
-    adata = conga.preprocess.cluster_and_tsne_and_umap(
-        adata, clustering_method=args.clustering_method,
-        clustering_resolution=args.clustering_resolution,
-        skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
-
-    if args.checkpoint:
-        adata.write_h5ad(args.outfile_prefix+'_checkpoint.h5ad')
-
-if args.subset_to_CD4 or args.subset_to_CD8:
-    assert not (args.subset_to_CD4 and args.subset_to_CD8)
-    which_subset = 'CD4' if args.subset_to_CD4 else 'CD8'
-    adata = conga.preprocess.subset_to_CD4_or_CD8_clusters(
-        adata, which_subset, use_protein_features=args.include_protein_features)
-
-    adata = conga.preprocess.cluster_and_tsne_and_umap(
-        adata, clustering_method=args.clustering_method,
-        clustering_resolution=args.clustering_resolution,
-        skip_tcr=(args.use_tcrdist_umap and args.use_tcrdist_clusters))
-
-
-if args.use_tcrdist_umap or args.use_tcrdist_clusters:
-    umap_key_added = 'X_tcr_2d' if args.use_tcrdist_umap else 'X_tcrdist_2d'
-    cluster_key_added = 'clusters_tcr' if args.use_tcrdist_clusters else 'clusters_tcrdist'
-    num_nbrs = 10
-    conga.preprocess.calc_tcrdist_nbrs_umap_clusters_cpp(
-        adata, num_nbrs, args.outfile_prefix, umap_key_added=umap_key_added, cluster_key_added=cluster_key_added)
 
 ################################################ DONE WITH INITIAL SETUP #########################################
 
@@ -415,9 +574,27 @@ num_clones = adata.shape[0]
 nbr_frac_for_nndists = min( x for x in args.nbr_fracs if x*num_clones>=10 or x==max(args.nbr_fracs) )
 outlog.write(f'nbr_frac_for_nndists: {nbr_frac_for_nndists}\n')
 obsm_tag_tcr = None if args.use_exact_tcrdist_nbrs else 'X_pca_tcr'
-all_nbrs, nndists_gex, nndists_tcr = conga.preprocess.calc_nbrs(
-    adata, args.nbr_fracs, also_calc_nndists=True, nbr_frac_for_nndists=nbr_frac_for_nndists,
-    obsm_tag_tcr=obsm_tag_tcr, use_exact_tcrdist_nbrs=args.use_exact_tcrdist_nbrs)
+
+def run_nbrs_stage():
+    return conga.preprocess.calc_nbrs(
+        adata, args.nbr_fracs, also_calc_nndists=True, nbr_frac_for_nndists=nbr_frac_for_nndists,
+        obsm_tag_tcr=obsm_tag_tcr, use_exact_tcrdist_nbrs=args.use_exact_tcrdist_nbrs,
+        approximate_nbrs=args.approximate_nbrs, ann_num_trees=args.ann_num_trees, num_threads=args.threads)
+
+def save_nbrs(output, filename):
+    all_nbrs, nndists_gex, nndists_tcr = output
+    arrays = {'nndists_gex': nndists_gex, 'nndists_tcr': nndists_tcr}
+    for ii, nbr_frac in enumerate(args.nbr_fracs):
+        arrays[f'nbrs_gex_{ii}'], arrays[f'nbrs_tcr_{ii}'] = all_nbrs[nbr_frac]
+    np.savez(filename, **arrays)
+
+def load_nbrs(filename):
+    data = np.load(filename)
+    all_nbrs = { nbr_frac: [data[f'nbrs_gex_{ii}'], data[f'nbrs_tcr_{ii}']]
+                 for ii, nbr_frac in enumerate(args.nbr_fracs) }
+    return all_nbrs, data['nndists_gex'], data['nndists_tcr']
+
+all_nbrs, nndists_gex, nndists_tcr = run_stage('nbrs', run_nbrs_stage, save_nbrs, load_nbrs)
 
 
 #
@@ -426,7 +603,7 @@ if args.analyze_junctions:
     new_tcrs = conga.tcrdist.tcr_sampler.find_alternate_alleles_for_tcrs(
         adata.uns['organism'], tcrs, verbose=True)
     junctions_df = conga.tcrdist.tcr_sampler.parse_tcr_junctions(
-        adata.uns['organism'], new_tcrs)
+        adata.uns['organism'], new_tcrs, num_processes=args.threads)
 
     num_inserts = (np.array(junctions_df.a_insert) +
                    np.array(junctions_df.vd_insert) +
@@ -464,7 +641,9 @@ if args.verbose_nbrs:
             np.savetxt(outfile, nbrs, fmt='%d')
             print('wrote nbrs to file:', outfile)
 
-if args.tcr_clumping:
+def run_tcr_clumping():
+    ''' run the tcr clumping analysis; stores tcr_clumping_pvalues in adata.obs
+    '''
     num_random_samples = 50000 if args.num_random_samples_for_tcr_clumping is None \
                          else args.num_random_samples_for_tcr_clumping
 
@@ -475,7 +654,8 @@ if args.tcr_clumping:
     results = conga.tcr_clumping.assess_tcr_clumping(
         adata, args.outfile_prefix, radii=radii, num_random_samples=num_random_samples,
         pvalue_threshold = pvalue_threshold,
-        also_find_clumps_within_gex_clusters=args.intra_cluster_tcr_clumping)
+        also_find_clumps_within_gex_clusters=args.intra_cluster_tcr_clumping, num_threads=args.threads,
+        random_seed=args.random_seed_for_tcr_clumping, background_cache_dir=args.tcr_clumping_cache_dir)
 
     if results.shape[0]:
         # add clusters info for results tsvfile
@@ -492,7 +672,7 @@ if args.tcr_clumping:
         #min_cluster_size = max( args.min_cluster_size, int( 0.5 + args.min_cluster_size_fraction * num_clones) )
         conga.plotting.make_tcr_clumping_plots(
             adata, results, nbrs_gex, nbrs_tcr, args.min_cluster_size_for_tcr_clumping_logos,
-            pvalue_threshold, args.outfile_prefix)
+            pvalue_threshold, args.outfile_prefix, logo_processes=args.logo_processes)
 
     num_clones = adata.shape[0]
     tcr_clumping_pvalues = np.full((num_clones,), num_clones).astype(float)
@@ -502,7 +682,9 @@ if args.tcr_clumping:
     adata.obs['tcr_clumping_pvalues'] = tcr_clumping_pvalues # stash in adata.obs
 
 
-if args.graph_vs_graph: ############################################################################################
+def run_graph_vs_graph():
+    ''' run the graph vs graph analysis; stores conga_scores etc in adata.obs
+    '''
     # make these numpy arrays because there seems to be a problem with np.nonzero on pandas series...
     clusters_gex = np.array(adata.obs['clusters_gex'])
     clusters_tcr = np.array(adata.obs['clusters_tcr'])
@@ -573,10 +755,13 @@ if args.graph_vs_graph: ########################################################
             include_alphadist_in_tcr_feature_logos=args.include_alphadist_in_tcr_feature_logos,
             rank_genes_uns_tag = rank_genes_uns_tag,
             show_pmhc_info_in_logos = args.show_pmhc_info_in_logos,
-            gex_header_tcr_score_names = gex_header_tcr_score_names )
+            gex_header_tcr_score_names = gex_header_tcr_score_names,
+            logo_processes = args.logo_processes )
+
 
-batch_bias_results = None
-if args.find_batch_biases:
+def run_find_batch_biases():
+    ''' returns (nbrhood_results, hotspot_results)
+    '''
     pval_threshold = 0.05 # kind of arbitrary
     nbrhood_results, hotspot_results = conga.correlations.find_batch_biases(
         adata, all_nbrs, pval_threshold=pval_threshold, exclude_batch_keys=args.exclude_batch_keys_for_biases)
@@ -598,9 +783,12 @@ if args.find_batch_biases:
 
     batch_bias_results = (nbrhood_results, hotspot_results)
 
+    return batch_bias_results
 
-if args.graph_vs_gex_features: #######################################################################################
-    clusters_gex = np.array(adata.obs['clusters_gex'])
+
+def run_graph_vs_gex_features():
+    ''' returns tcr_nbrhood_genes_results, tcr_cluster_genes_results (for the summary figure)
+    '''
     clusters_tcr = np.array(adata.obs['clusters_tcr'])
 
     ## first use the TCRdist kPCA nbr graph:
@@ -705,10 +893,13 @@ if args.graph_vs_gex_features: #################################################
                 conga.plotting.make_feature_panel_plots(adata, 'tcr', all_nbrs, results_df, pngfile,
                                                         use_nbr_frac=use_nbr_frac)
 
+    return tcr_nbrhood_genes_results, tcr_cluster_genes_results
+
 
-if args.graph_vs_tcr_features: #######################################################################################
+def run_graph_vs_tcr_features():
+    ''' returns gex_nbrhood_scores_results, gex_cluster_scores_results (for the summary figure)
+    '''
     clusters_gex = np.array(adata.obs['clusters_gex'])
-    clusters_tcr = np.array(adata.obs['clusters_tcr'])
 
     pval_threshold = 1.
     results = []
@@ -769,10 +960,269 @@ if args.graph_vs_tcr_features: #################################################
         print('making:', pngfile)
         conga.plotting.make_feature_panel_plots(adata, 'gex', all_nbrs, results_df, pngfile)
 
+    return gex_nbrhood_scores_results, gex_cluster_scores_results
+
+
+def run_find_hotspot_features():
+    ''' look for hotspot features and nbrhoods
+    '''
+    # My hacky and probably buggy first implementation of the HotSpot method:
+    #
+    # "Identifying Informative Gene Modules Across Modalities of Single Cell Genomics"
+    # David DeTomaso, Nir Yosef
+    # https://www.biorxiv.org/content/10.1101/2020.02.06.937805v1
+
+    #all_bicluster_pvals = {}
+    all_hotspot_nbrhood_results = []
+    for nbr_frac in args.nbr_fracs:
+        nbrs_gex, nbrs_tcr = all_nbrs[nbr_frac]
+        print('find_hotspot_nbrhoods for nbr_frac', nbr_frac)
+        nbrhood_results = conga.correlations.find_hotspot_nbrhoods(
+            adata, nbrs_gex, nbrs_tcr, pval_threshold=1.0, also_use_cluster_graphs=False)
+        # the feature_type column is already set in nbrhood_results to {tcr/gex}_nbrs_vs_graph
+        if nbrhood_results.shape[0]: #make some simple plots
+            nbrhood_results['nbr_frac'] = nbr_frac
+            all_hotspot_nbrhood_results.append( nbrhood_results )
+            # nrows, ncols = 4, 6
+            # plt.figure(figsize=(ncols*4, nrows*4))
+            # for ii,(xy_tag, feature_nbr_tag, graph_tag) in enumerate([(x,y,z) for x in ['gex','tcr']
+            #                                                           for y in ['gex','tcr','combo','max']
+            #                                                           for z in ['graph','clust','combo']]):
+            #     mask = np.full((nbrhood_results.shape[0],), False)
+            #     for ftag in ['gex','tcr'] if feature_nbr_tag in ['combo','max'] else [feature_nbr_tag]:
+            #         for gtag in ['graph','clust'] if graph_tag=='combo' else [graph_tag]:
+            #             feature_type = '{}_nbrs_vs_{}'.format(ftag, gtag)
+            #             mask |= nbrhood_results.feature_type==feature_type
+            #     df = nbrhood_results[mask]
+            #     if df.shape[0]==0:
+            #         print('no hits:', feature_nbr_tag, graph_tag)
+            #         continue
+            #     if feature_nbr_tag == 'max':
+            #         all_pvals = {}
+            #         for tag in ['gex','tcr']:
+            #             pvals = np.full((adata.shape[0],),1000.0)
+            #             for l in df.itertuples():
+            #                 if l.feature_type.startswith(tag):
+            #                     pvals[l.clone_index] = min(l.pvalue_adj, pvals[l.clone_index])
+            #             all_pvals[tag] = pvals
+            #         pvals = np.maximum(all_pvals['gex'], all_pvals['tcr'])
+            #     else:
+            #         pvals = np.full((adata.shape[0],),1000.0)
+            #         for l in df.itertuples():
+            #             pvals[l.clone_index] = min(l.pvalue_adj, pvals[l.clone_index])
+            #     colors = np.sqrt( np.maximum(0.0, -1*np.log10(pvals)))
+            #     plt.subplot(nrows, ncols, ii+1)
+            #     reorder = np.argsort(colors)
+            #     xy = adata.obsm['X_{}_2d'.format(xy_tag)] # same umap as feature nbr-type
+            #     vmax = np.sqrt(-1*np.log10(1e-5))
+            #     plt.scatter( xy[reorder,0], xy[reorder,1], c=colors[reorder], vmin=0, vmax=vmax)
+            #     plt.xticks([],[])
+            #     plt.yticks([],[])
+            #     plt.xlabel('{} UMAP1'.format(xy_tag))
+            #     plt.title('{}_nbrs_vs_{} nbrfrac= {:.3f}'.format(feature_nbr_tag, graph_tag, nbr_frac))
+
+            #     if feature_nbr_tag == 'max' and graph_tag == 'graph' and xy_tag=='gex':
+            #         all_bicluster_pvals[nbr_frac] = pvals
+
+
+            # pngfile = '{}_hotspot_nbrhoods_{:.3f}_nbrs.png'.format(args.outfile_prefix, nbr_frac)
+            # print('making:', pngfile)
+            # plt.tight_layout()
+            # plt.savefig(pngfile)
+
+
+        # try making some logo plots. Here we are just using the graph-graph hotspot pvals, max'ed per clone over gex/tcr
+        # min_cluster_size = max( args.min_cluster_size, int(np.round(args.min_cluster_size_fraction * num_clones)))
+        # min_pvals = np.array([num_clones]*num_clones)
+        # for nbr_frac, pvals in all_bicluster_pvals.items():
+        #     min_pvals = np.minimum(min_pvals, pvals)
+
+        # pngfile = '{}_hotspot_nbrhood_biclusters.png'.format(args.outfile_prefix)
+        # conga.plotting.make_cluster_logo_plots_figure(adata, min_pvals, 1.0, nbrs_gex, nbrs_tcr,
+        #                                               min_cluster_size, pngfile)
+
+        print('find_hotspot_genes for nbr_frac', nbr_frac)
+        gex_results = conga.correlations.find_hotspot_genes(adata, nbrs_tcr, pval_threshold=0.05)
+        #gex_results['feature_type'] = 'gex'
+
+        print('find_hotspot_tcr_features for nbr_frac', nbr_frac)
+        tcr_results = conga.correlations.find_hotspot_tcr_features(adata, nbrs_gex, pval_threshold=0.05)
+        #tcr_results['feature_type'] = 'tcr'
+
+        combo_results = pd.concat([gex_results, tcr_results])
+        if combo_results.shape[0]:
+            tsvfile = '{}_hotspot_features_{:.3f}_nbrs.tsv'.format(args.outfile_prefix, nbr_frac)
+            combo_results.to_csv(tsvfile, sep='\t', index=False)
+
+        for tag, results in [ ['gex', gex_results],
+                              ['tcr', tcr_results],
+                              ['combo', combo_results] ]:
+            if results.shape[0]<1:
+                continue
+
+            for plot_tag, plot_nbrs in [['gex',nbrs_gex], ['tcr',nbrs_tcr]]:
+                if tag == plot_tag:
+                    continue
+                # 2D UMAPs colored by nbr-averaged feature values
+                pngfile = '{}_hotspot_{}_features_{:.3f}_nbrs_{}_umap.png'\
+                          .format(args.outfile_prefix, tag, nbr_frac, plot_tag)
+                print('making:', pngfile)
+                conga.plotting.plot_hotspot_umap(adata, plot_tag, results, pngfile, nbrs=plot_nbrs,
+                                                  compute_nbr_averages=True)
+
+                if results.shape[0]<2:
+                    continue # clustermap not interesting...
+
+                if 'X_pca_'+plot_tag not in adata.obsm_keys():
+                    print(f'skipping clustermap vs {plot_tag} since no X_pca_{plot_tag} in adata.obsm_keys!')
+                    continue
+
+                if adata.shape[0] > 30000: ######################### TEMPORARY HACKING ############################
+                    print('skipping hotspot clustermaps because adata is too big:', adata.shape)
+                    continue
+
+                ## clustermap of features versus cells
+                features = list(results.feature)
+                feature_labels = ['{:9.1e} {} {}'.format(x,y,z)
+                                  for x,y,z in zip(results.pvalue_adj, results.feature_type, results.feature)]
+                min_pval = 1e-299 # dont want log10 of 0.0
+                feature_scores = [np.sqrt(-1*np.log10(max(min_pval, x.pvalue_adj))) for x in results.itertuples()]
+
+                if False: # skip the redundant one
+                    pngfile = '{}_{:.3f}_nbrs_{}_hotspot_features_vs_{}_clustermap.png'\
+                              .format(args.outfile_prefix, nbr_frac, tag, plot_tag)
+                    conga.plotting.plot_interesting_features_vs_clustermap(
+                        adata, features, pngfile, plot_tag, nbrs=plot_nbrs, compute_nbr_averages=True,
+                        feature_labels=feature_labels, feature_types = list(results.feature_type),
+                        feature_scores = feature_scores )
+
+                # now a more compact version where we filter out redundant features
+                pngfile = '{}_{:.3f}_nbrs_{}_hotspot_features_vs_{}_clustermap_lessredundant.png'\
+                          .format(args.outfile_prefix, nbr_frac, tag, plot_tag)
+                redundancy_threshold = 0.9 # duplicate if linear correlation > 0.9
+                if len(features)>60:
+                    max_redundant_features = 0 # ie anything 1 or higher ==> no duplicates
+                elif len(features)>30:
+                    max_redundant_features = 1 # at most 1 duplicate
+                else:
+                    max_redundant_features = 2 # at most 2 duplicates
+                conga.plotting.plot_interesting_features_vs_clustermap(
+                    adata, features, pngfile, plot_tag, nbrs=plot_nbrs, compute_nbr_averages=True,
+                    feature_labels=feature_labels, feature_types = list(results.feature_type),
+                    max_redundant_features=max_redundant_features, redundancy_threshold=redundancy_threshold,
+                    feature_scores=feature_scores)
+
+    # make a plot summarizing the hotspot nbrhood pvals and also save them to a file
+    if all_hotspot_nbrhood_results:
+        nbrhood_results = pd.concat(all_hotspot_nbrhood_results)
+
+        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
+
+        outfile = '{}_hotspot_nbrhoods.tsv'.format(args.outfile_prefix)
+        for iab, ivj in [ (x,y) for x in range(2) for y in range(3) ]:
+            key = [ 'va ja cdr3a'.split(), 'vb jb cdr3b'.split()][iab][ivj]
+            nbrhood_results[key] = [tcrs[x.clone_index][iab][ivj]
+                                    for x in nbrhood_results.itertuples()]
+        print('making:', outfile)
+        nbrhood_results.to_csv(outfile, sep='\t', index=False)
+
+        num_clones = adata.shape[0]
+        nbrhood_pvals = { 'gex':np.full((num_clones,), num_clones).astype(float),
+                          'tcr':np.full((num_clones,), num_clones).astype(float) }
+        for l in nbrhood_results.itertuples():
+            assert l.feature_type[3:] == '_nbrs_vs_graph'
+            tag = l.feature_type[:3]
+            nbrhood_pvals[tag][l.clone_index] = min(l.pvalue_adj, nbrhood_pvals[tag][l.clone_index])
+
+        plt.figure(figsize=(12,6))
+        for icol, tag in enumerate(['gex','tcr']):
+            plt.subplot(1,2,icol+1)
+            colors = np.sqrt( np.maximum(0.0, -1*np.log10(np.maximum(1e-100, nbrhood_pvals[tag])))) # no log10 of 0.0
+            print('colors:', tag, np.max(colors), list(colors[:100]))
+            reorder = np.argsort(colors)
+            xy = adata.obsm['X_{}_2d'.format(tag)] # same umap as feature nbr-type
+            vmax = np.sqrt(-1*np.log10(1e-5))
+            plt.scatter( xy[reorder,0], xy[reorder,1], c=colors[reorder], vmin=0, vmax=vmax)
+            plt.xticks([],[])
+            plt.yticks([],[])
+            plt.xlabel('{} UMAP1'.format(tag))
+            plt.ylabel('{} UMAP2'.format(tag))
+            plt.title('{} hotspot nbrhood pvalues'.format(tag))
+        plt.tight_layout()
+        pngfile = '{}_hotspot_nbrhoods.png'.format(args.outfile_prefix)
+        print('making:', pngfile)
+        plt.savefig(pngfile)
+
+        if args.make_hotspot_nbrhood_logos:
+            nbrs_gex, nbrs_tcr = all_nbrs[ max(args.nbr_fracs) ]
+            min_cluster_size = max( args.min_cluster_size, int( 0.5 + args.min_cluster_size_fraction * num_clones) )
+            conga.plotting.make_hotspot_nbrhood_logo_figures(adata, nbrs_gex, nbrs_tcr, nbrhood_results,
+                                                             min_cluster_size, args.outfile_prefix,
+                                                             pvalue_threshold=1.0,
+                                                             logo_processes=args.logo_processes)
+
+
+# these analyses only read the nbr graphs and the setup stage outputs, and each one writes its own output files
+# and adata.obs/adata.uns keys, so they can run in parallel in forked worker processes, which share all the arrays
+# copy-on-write. The workers send back their new obs columns and uns entries, which are merged in the order below
+#
+parallel_analyses = [
+    ['tcr_clumping', run_tcr_clumping],
+    ['graph_vs_graph', run_graph_vs_graph],
+    ['find_batch_biases', run_find_batch_biases],
+    ['graph_vs_gex_features', run_graph_vs_gex_features],
+    ['graph_vs_tcr_features', run_graph_vs_tcr_features],
+    ['find_hotspot_features', run_find_hotspot_features],
+]
+
+def run_analysis_in_worker(name):
+    ''' returns (results, obs_changes, uns_changes, log) where log is what the analysis wrote to outlog
+    '''
+    global outlog
+    outlog = io.StringIO()
+    old_obs = adata.obs.copy()
+    old_uns = dict(adata.uns)
+    results = dict(parallel_analyses)[name]()
+    obs_changes = {k:adata.obs[k] for k in adata.obs_keys()
+                   if k not in old_obs.columns or not adata.obs[k].equals(old_obs[k])}
+    uns_changes = {k:v for k,v in adata.uns.items() if k not in old_uns or v is not old_uns[k]}
+    sys.stdout.flush()
+    return results, obs_changes, uns_changes, outlog.getvalue()
+
+todo_analyses = [ name for name,_ in parallel_analyses if getattr(args, name) ]
+analysis_results = {}
+
+if args.analysis_processes > 1 and len(todo_analyses) > 1 and os.name == 'posix':
+    print('running', len(todo_analyses), 'analyses in', args.analysis_processes, 'processes:', todo_analyses)
+    outlog.flush() # dont want the workers to inherit buffered output
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with ProcessPoolExecutor(max_workers=args.analysis_processes,
+                             mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = [ executor.submit(run_analysis_in_worker, name) for name in todo_analyses ]
+        worker_outputs = [ x.result() for x in futures ]
+    for name, (results, obs_changes, uns_changes, log) in zip(todo_analyses, worker_outputs):
+        for k,v in obs_changes.items():
+            adata.obs[k] = v
+        for k,v in uns_changes.items():
+            adata.uns[k] = v
+        outlog.write(log)
+        analysis_results[name] = results
+else:
+    for name, analysis in parallel_analyses:
+        if name in todo_analyses:
+            analysis_results[name] = analysis()
+
+batch_bias_results = analysis_results.get('find_batch_biases')
+
+
 if args.graph_vs_graph and args.graph_vs_tcr_features and args.graph_vs_gex_features: ################################
     pngfile = args.outfile_prefix+'_summary.png'
     print('making:', pngfile)
 
+    tcr_nbrhood_genes_results, tcr_cluster_genes_results = analysis_results['graph_vs_gex_features']
+    gex_nbrhood_scores_results, gex_cluster_scores_results = analysis_results['graph_vs_tcr_features']
+
     if tcr_cluster_genes_results is not None:
         tcr_genes_results = pd.concat( [tcr_nbrhood_genes_results, tcr_cluster_genes_results ], ignore_index=True )
     else:
@@ -832,7 +1282,7 @@ if args.make_tcrdist_trees: # make tcrdist trees for each of the gex clusters, a
         if csize>1000 and conga.util.tcrdist_cpp_available():
             cdists = conga.preprocess.calc_tcrdist_matrix_cpp(ctcrs, adata.uns['organism'])
         else:
-            cdists = np.array([ tcrdist(x,y) for x in ctcrs for y in ctcrs]).reshape(csize,csize)
+            cdists = tcrdist.distance_matrix(ctcrs)
 
         cmds = conga.tcrdist.make_tcr_trees.make_tcr_tree_svg_commands(
             ctcrs, organism, [x_offset,0], [width,height], cdists, max_tcrs_for_trees=400, tcrdist_calculator=tcrdist,
@@ -863,7 +1313,7 @@ if args.make_tcrdist_trees: # make tcrdist trees for each of the gex clusters, a
                 cdists = conga.preprocess.calc_tcrdist_matrix_cpp(ctcrs, adata.uns['organism'])
             else:
                 print('computing tcrdist distances:', clust, csize)
-                cdists = np.array([ tcrdist(x,y) for x in ctcrs for y in ctcrs]).reshape(csize,csize)
+                cdists = tcrdist.distance_matrix(ctcrs)
 
             cmds = conga.tcrdist.make_tcr_trees.make_tcr_tree_svg_commands(
                 ctcrs, organism, [0,0], [width,height], cdists, max_tcrs_for_trees=400, tcrdist_calculator=tcrdist,
@@ -996,201 +1446,6 @@ if args.find_gex_cluster_degs: # look at differentially expressed genes in gex c
 
 
 
-if args.find_hotspot_features:
-    # My hacky and probably buggy first implementation of the HotSpot method:
-    #
-    # "Identifying Informative Gene Modules Across Modalities of Single Cell Genomics"
-    # David DeTomaso, Nir Yosef
-    # https://www.biorxiv.org/content/10.1101/2020.02.06.937805v1
-
-    #all_bicluster_pvals = {}
-    all_hotspot_nbrhood_results = []
-    for nbr_frac in args.nbr_fracs:
-        nbrs_gex, nbrs_tcr = all_nbrs[nbr_frac]
-        print('find_hotspot_nbrhoods for nbr_frac', nbr_frac)
-        nbrhood_results = conga.correlations.find_hotspot_nbrhoods(
-            adata, nbrs_gex, nbrs_tcr, pval_threshold=1.0, also_use_cluster_graphs=False)
-        # the feature_type column is already set in nbrhood_results to {tcr/gex}_nbrs_vs_graph
-        if nbrhood_results.shape[0]: #make some simple plots
-            nbrhood_results['nbr_frac'] = nbr_frac
-            all_hotspot_nbrhood_results.append( nbrhood_results )
-            # nrows, ncols = 4, 6
-            # plt.figure(figsize=(ncols*4, nrows*4))
-            # for ii,(xy_tag, feature_nbr_tag, graph_tag) in enumerate([(x,y,z) for x in ['gex','tcr']
-            #                                                           for y in ['gex','tcr','combo','max']
-            #                                                           for z in ['graph','clust','combo']]):
-            #     mask = np.full((nbrhood_results.shape[0],), False)
-            #     for ftag in ['gex','tcr'] if feature_nbr_tag in ['combo','max'] else [feature_nbr_tag]:
-            #         for gtag in ['graph','clust'] if graph_tag=='combo' else [graph_tag]:
-            #             feature_type = '{}_nbrs_vs_{}'.format(ftag, gtag)
-            #             mask |= nbrhood_results.feature_type==feature_type
-            #     df = nbrhood_results[mask]
-            #     if df.shape[0]==0:
-            #         print('no hits:', feature_nbr_tag, graph_tag)
-            #         continue
-            #     if feature_nbr_tag == 'max':
-            #         all_pvals = {}
-            #         for tag in ['gex','tcr']:
-            #             pvals = np.full((adata.shape[0],),1000.0)
-            #             for l in df.itertuples():
-            #                 if l.feature_type.startswith(tag):
-            #                     pvals[l.clone_index] = min(l.pvalue_adj, pvals[l.clone_index])
-            #             all_pvals[tag] = pvals
-            #         pvals = np.maximum(all_pvals['gex'], all_pvals['tcr'])
-            #     else:
-            #         pvals = np.full((adata.shape[0],),1000.0)
-            #         for l in df.itertuples():
-            #             pvals[l.clone_index] = min(l.pvalue_adj, pvals[l.clone_index])
-            #     colors = np.sqrt( np.maximum(0.0, -1*np.log10(pvals)))
-            #     plt.subplot(nrows, ncols, ii+1)
-            #     reorder = np.argsort(colors)
-            #     xy = adata.obsm['X_{}_2d'.format(xy_tag)] # same umap as feature nbr-type
-            #     vmax = np.sqrt(-1*np.log10(1e-5))
-            #     plt.scatter( xy[reorder,0], xy[reorder,1], c=colors[reorder], vmin=0, vmax=vmax)
-            #     plt.xticks([],[])
-            #     plt.yticks([],[])
-            #     plt.xlabel('{} UMAP1'.format(xy_tag))
-            #     plt.title('{}_nbrs_vs_{} nbrfrac= {:.3f}'.format(feature_nbr_tag, graph_tag, nbr_frac))
-
-            #     if feature_nbr_tag == 'max' and graph_tag == 'graph' and xy_tag=='gex':
-            #         all_bicluster_pvals[nbr_frac] = pvals
-
-
-            # pngfile = '{}_hotspot_nbrhoods_{:.3f}_nbrs.png'.format(args.outfile_prefix, nbr_frac)
-            # print('making:', pngfile)
-            # plt.tight_layout()
-            # plt.savefig(pngfile)
-
-
-        # try making some logo plots. Here we are just using the graph-graph hotspot pvals, max'ed per clone over gex/tcr
-        # min_cluster_size = max( args.min_cluster_size, int(np.round(args.min_cluster_size_fraction * num_clones)))
-        # min_pvals = np.array([num_clones]*num_clones)
-        # for nbr_frac, pvals in all_bicluster_pvals.items():
-        #     min_pvals = np.minimum(min_pvals, pvals)
-
-        # pngfile = '{}_hotspot_nbrhood_biclusters.png'.format(args.outfile_prefix)
-        # conga.plotting.make_cluster_logo_plots_figure(adata, min_pvals, 1.0, nbrs_gex, nbrs_tcr,
-        #                                               min_cluster_size, pngfile)
-
-        print('find_hotspot_genes for nbr_frac', nbr_frac)
-        gex_results = conga.correlations.find_hotspot_genes(adata, nbrs_tcr, pval_threshold=0.05)
-        #gex_results['feature_type'] = 'gex'
-
-        print('find_hotspot_tcr_features for nbr_frac', nbr_frac)
-        tcr_results = conga.correlations.find_hotspot_tcr_features(adata, nbrs_gex, pval_threshold=0.05)
-        #tcr_results['feature_type'] = 'tcr'
-
-        combo_results = pd.concat([gex_results, tcr_results])
-        if combo_results.shape[0]:
-            tsvfile = '{}_hotspot_features_{:.3f}_nbrs.tsv'.format(args.outfile_prefix, nbr_frac)
-            combo_results.to_csv(tsvfile, sep='\t', index=False)
-
-        for tag, results in [ ['gex', gex_results],
-                              ['tcr', tcr_results],
-                              ['combo', combo_results] ]:
-            if results.shape[0]<1:
-                continue
-
-            for plot_tag, plot_nbrs in [['gex',nbrs_gex], ['tcr',nbrs_tcr]]:
-                if tag == plot_tag:
-                    continue
-                # 2D UMAPs colored by nbr-averaged feature values
-                pngfile = '{}_hotspot_{}_features_{:.3f}_nbrs_{}_umap.png'\
-                          .format(args.outfile_prefix, tag, nbr_frac, plot_tag)
-                print('making:', pngfile)
-                conga.plotting.plot_hotspot_umap(adata, plot_tag, results, pngfile, nbrs=plot_nbrs,
-                                                  compute_nbr_averages=True)
-
-                if results.shape[0]<2:
-                    continue # clustermap not interesting...
-
-                if 'X_pca_'+plot_tag not in adata.obsm_keys():
-                    print(f'skipping clustermap vs {plot_tag} since no X_pca_{plot_tag} in adata.obsm_keys!')
-                    continue
-
-                if adata.shape[0] > 30000: ######################### TEMPORARY HACKING ############################
-                    print('skipping hotspot clustermaps because adata is too big:', adata.shape)
-                    continue
-
-                ## clustermap of features versus cells
-                features = list(results.feature)
-                feature_labels = ['{:9.1e} {} {}'.format(x,y,z)
-                                  for x,y,z in zip(results.pvalue_adj, results.feature_type, results.feature)]
-                min_pval = 1e-299 # dont want log10 of 0.0
-                feature_scores = [np.sqrt(-1*np.log10(max(min_pval, x.pvalue_adj))) for x in results.itertuples()]
-
-                if False: # skip the redundant one
-                    pngfile = '{}_{:.3f}_nbrs_{}_hotspot_features_vs_{}_clustermap.png'\
-                              .format(args.outfile_prefix, nbr_frac, tag, plot_tag)
-                    conga.plotting.plot_interesting_features_vs_clustermap(
-                        adata, features, pngfile, plot_tag, nbrs=plot_nbrs, compute_nbr_averages=True,
-                        feature_labels=feature_labels, feature_types = list(results.feature_type),
-                        feature_scores = feature_scores )
-
-                # now a more compact version where we filter out redundant features
-                pngfile = '{}_{:.3f}_nbrs_{}_hotspot_features_vs_{}_clustermap_lessredundant.png'\
-                          .format(args.outfile_prefix, nbr_frac, tag, plot_tag)
-                redundancy_threshold = 0.9 # duplicate if linear correlation > 0.9
-                if len(features)>60:
-                    max_redundant_features = 0 # ie anything 1 or higher ==> no duplicates
-                elif len(features)>30:
-                    max_redundant_features = 1 # at most 1 duplicate
-                else:
-                    max_redundant_features = 2 # at most 2 duplicates
-                conga.plotting.plot_interesting_features_vs_clustermap(
-                    adata, features, pngfile, plot_tag, nbrs=plot_nbrs, compute_nbr_averages=True,
-                    feature_labels=feature_labels, feature_types = list(results.feature_type),
-                    max_redundant_features=max_redundant_features, redundancy_threshold=redundancy_threshold,
-                    feature_scores=feature_scores)
-
-    # make a plot summarizing the hotspot nbrhood pvals and also save them to a file
-    if all_hotspot_nbrhood_results:
-        nbrhood_results = pd.concat(all_hotspot_nbrhood_results)
-
-        tcrs = conga.preprocess.retrieve_tcrs_from_adata(adata)
-
-        outfile = '{}_hotspot_nbrhoods.tsv'.format(args.outfile_prefix)
-        for iab, ivj in [ (x,y) for x in range(2) for y in range(3) ]:
-            key = [ 'va ja cdr3a'.split(), 'vb jb cdr3b'.split()][iab][ivj]
-            nbrhood_results[key] = [tcrs[x.clone_index][iab][ivj]
-                                    for x in nbrhood_results.itertuples()]
-        print('making:', outfile)
-        nbrhood_results.to_csv(outfile, sep='\t', index=False)
-
-        num_clones = adata.shape[0]
-        nbrhood_pvals = { 'gex':np.full((num_clones,), num_clones).astype(float),
-                          'tcr':np.full((num_clones,), num_clones).astype(float) }
-        for l in nbrhood_results.itertuples():
-            assert l.feature_type[3:] == '_nbrs_vs_graph'
-            tag = l.feature_type[:3]
-            nbrhood_pvals[tag][l.clone_index] = min(l.pvalue_adj, nbrhood_pvals[tag][l.clone_index])
-
-        plt.figure(figsize=(12,6))
-        for icol, tag in enumerate(['gex','tcr']):
-            plt.subplot(1,2,icol+1)
-            colors = np.sqrt( np.maximum(0.0, -1*np.log10(np.maximum(1e-100, nbrhood_pvals[tag])))) # no log10 of 0.0
-            print('colors:', tag, np.max(colors), list(colors[:100]))
-            reorder = np.argsort(colors)
-            xy = adata.obsm['X_{}_2d'.format(tag)] # same umap as feature nbr-type
-            vmax = np.sqrt(-1*np.log10(1e-5))
-            plt.scatter( xy[reorder,0], xy[reorder,1], c=colors[reorder], vmin=0, vmax=vmax)
-            plt.xticks([],[])
-            plt.yticks([],[])
-            plt.xlabel('{} UMAP1'.format(tag))
-            plt.ylabel('{} UMAP2'.format(tag))
-            plt.title('{} hotspot nbrhood pvalues'.format(tag))
-        plt.tight_layout()
-        pngfile = '{}_hotspot_nbrhoods.png'.format(args.outfile_prefix)
-        print('making:', pngfile)
-        plt.savefig(pngfile)
-
-        if args.make_hotspot_nbrhood_logos:
-            nbrs_gex, nbrs_tcr = all_nbrs[ max(args.nbr_fracs) ]
-            min_cluster_size = max( args.min_cluster_size, int( 0.5 + args.min_cluster_size_fraction * num_clones) )
-            conga.plotting.make_hotspot_nbrhood_logo_figures(adata, nbrs_gex, nbrs_tcr, nbrhood_results,
-                                                             min_cluster_size, args.outfile_prefix,
-                                                             pvalue_threshold=1.0)
-
 if args.analyze_CD4_CD8:
     min_nbrs = 10
     for nbr_frac in sorted(all_nbrs.keys()):
@@ -1,6 +1,7 @@
 #include "types.hh"
-#include "tcrdist.hh"
+#include "nbrs.hh"
 #include "io.hh"
+#include "parallel.hh"
 #include <random>
 
 
@@ -35,6 +36,9 @@ int main(int argc, char** argv)
  		TCLAP::ValueArg<string> bchains_file_arg("b", "bchains_file",
 			"TSV file with the background TCR beta chains", true, "", "string", cmd);
 
+ 		TCLAP::ValueArg<Size> threads_arg("p","threads",
+			"Number of threads to use. Output does not depend on the number of threads.", false,
+			1, "integer", cmd);
 
 		cmd.parse( argc, argv );
 
@@ -44,6 +48,7 @@ int main(int argc, char** argv)
 		string const achains_file( achains_file_arg.getValue() );
 		string const bchains_file( bchains_file_arg.getValue() );
 		string const outfile( outfile_arg.getValue());
+		Size const num_threads( max( Size(1), threads_arg.getValue() ) );
 
 		TCRdistCalculator const atcrdist('A', db_filename), btcrdist('B', db_filename);
 
@@ -57,41 +62,32 @@ int main(int argc, char** argv)
 
 		Size const num_tcrs(tcrs.size());
 
-		Sizes acounts(max_dist+1), bcounts(max_dist+1);
+		// CDR3s as aa indices, grouped by length, for the one-vs-many distance counts
+		EncodedSingleChains const encoded_achains( atcrdist.encode_single_chains( achains ) ),
+			encoded_bchains( btcrdist.encode_single_chains( bchains ) );
+
+		// per-thread scratch space
+		vector< CountsScratch > scratch( num_threads );
+
 		ofstream out(outfile);
 
 		cout << "making " << outfile << endl;
 
-		for ( Size ii=0; ii< num_tcrs; ++ii ) {
-			if ( ii && ii%100==0 ) cerr << '.';
-			if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-
-			//DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-
-			for ( Size r=0; r<2; ++r){
-				Sizes & counts( r==0 ? acounts : bcounts);
-				fill( counts.begin(), counts.end(), 0);
-				DistanceTCR_g const &fg_tcr( r==0 ? tcrs[ii].first : tcrs[ii].second);
-				vector<DistanceTCR_g> const & bg_tcrs( r==0 ? achains : bchains );
-				TCRdistCalculator const & tcrdist( r==0 ? atcrdist : btcrdist );
-				Size dist(0);
-				for ( DistanceTCR_g const & bg_tcr : bg_tcrs ) {
-					dist = Size( 0.5 + tcrdist(fg_tcr, bg_tcr));
-					if ( dist <= max_dist ) ++counts[dist];
-				}
-			}
-
-			// compute probability distribution for paired distances using convolution
-			for ( Size d=0; d<= max_dist; ++d ) {
-				Size count(0);
-				for ( Size adist=0; adist<= d; ++adist ) {
-					count += acounts[adist] * bcounts[d-adist];
+		run_rows_in_parallel< Sizes >(
+			num_tcrs, num_threads,
+			[&]( Size const ii, Sizes & paired_counts, Size const thread_index ) {
+				count_paired_distances_row( atcrdist, btcrdist, tcrs[ii], encoded_achains, encoded_bchains, max_dist,
+					scratch[ thread_index ], paired_counts );
+			},
+			[&]( Size const ii, Sizes const & paired_counts ) {
+				if ( ii && ii%100==0 ) cerr << '.';
+				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
+				for ( Size d=0; d<= max_dist; ++d ) {
+					if (d) out << ' ';
+					out << paired_counts[d];
 				}
-				if (d) out << ' ';
-				out << count;
-			}
-			out << '\n';
-		}
+				out << '\n';
+			});
 
 		cerr << endl;
 		out.close();
@@ -1,7 +1,9 @@
 #include "types.hh"
-#include "tcrdist.hh"
+#include "nbrs.hh"
 #include "io.hh"
+#include "parallel.hh"
 #include <random>
+#include <numeric>
 
 
 int main(int argc, char** argv)
@@ -31,6 +33,16 @@ int main(int argc, char** argv)
 		TCLAP::SwitchArg only_tcrdists_arg("m","only_tcrdists", "Just write the matrix of tcrdists. "
 			"Don't find neighbors. Matrix will be called <outfile_prefix>_tcrdists.txt", cmd, false);
 
+		TCLAP::ValueArg<string> target_tcrs_file_arg("g","target_tcrs_file","Optional TSV file with a second set "
+			"of TCRs, same format as --tcrs_file. Only used with --only_tcrdists: the matrix will have one column "
+			"for each target TCR instead of one for each TCR in --tcrs_file", false,
+			"", "string", cmd);
+
+		TCLAP::SwitchArg binary_arg("B","binary", "Write binary output files (.bin, see io.hh) instead of text. "
+			"knn mode writes int32 <outfile_prefix>_knn_indices.bin and float32 <outfile_prefix>_knn_distances.bin; "
+			"threshold mode writes CSR arrays <outfile_prefix>_nbr<T>_{indptr,indices,distances}.bin; "
+			"--only_tcrdists writes float32 <outfile_prefix>_tcrdists.bin", cmd, false);
+
  		TCLAP::ValueArg<string> tcrs_file_arg("f","tcrs_file","TSV (tab separated values) "
 			"file containing TCRs for neighbor calculation. Should contain the 4 columns "
 			"'va_gene' 'cdr3a' 'vb_gene' 'cdr3b' (or alt fieldnames: 'va' and 'vb')", true,
@@ -44,13 +56,20 @@ int main(int argc, char** argv)
 			"(ie, one integer per line) ith the bgroups information so we can exclude same-group neighbors", false,
 			"", "string", cmd);
 
+		TCLAP::ValueArg<Size> threads_arg("p","threads",
+			"Number of threads to use. Output does not depend on the number of threads.", false,
+			1, "integer", cmd);
+
 		cmd.parse( argc, argv );
 
 		string const db_filename( db_filename_arg.getValue() );
 		Size const num_nbrs( num_nbrs_arg.getValue() );
 		int const threshold_int( threshold_arg.getValue() );
 		bool const only_tcrdists( only_tcrdists_arg.getValue() );
+		bool const binary( binary_arg.getValue() );
+		Size const num_threads( max( Size(1), threads_arg.getValue() ) );
 		string const tcrs_file( tcrs_file_arg.getValue() );
+		string const target_tcrs_file( target_tcrs_file_arg.getValue() );
 		string const agroups_file( agroups_file_arg.getValue() );
 		string const bgroups_file( bgroups_file_arg.getValue() );
 		string const outfile_prefix( outfile_prefix_arg.getValue());
@@ -64,6 +83,14 @@ int main(int argc, char** argv)
 
 		Size const num_tcrs(tcrs.size());
 
+		// the columns of the --only_tcrdists matrix
+		vector< PairedTCR > target_tcrs;
+		if ( target_tcrs_file.size() ) {
+			runtime_assert( only_tcrdists );
+			read_paired_tcrs_from_tsv_file(target_tcrs_file, atcrdist, btcrdist, target_tcrs);
+		}
+		vector< PairedTCR > const & column_tcrs( target_tcrs_file.size() ? target_tcrs : tcrs );
+
 		Sizes agroups( agroups_file.size() ? read_groups_from_file(agroups_file) : Sizes() );
 		Sizes bgroups( bgroups_file.size() ? read_groups_from_file(bgroups_file) : Sizes() );
 		if ( agroups.empty() ) {
@@ -77,159 +104,154 @@ int main(int argc, char** argv)
 		runtime_assert( bgroups.size() == num_tcrs );
 		// two different modes of operations
 
-		Size const BIG_DIST(10000);
+		// print progress as rows are written out
+		auto show_progress = [&]( Size const ii ) {
+			if ( ii && ii%100==0 ) cerr << '.';
+			if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
+		};
+
+		// text output helper
+		auto write_line = [&]( ofstream & out, Sizes const & values ) {
+			for ( Size j=0; j<values.size(); ++j ) {
+				if (j) out << ' ';
+				out << values[j];
+			}
+			out << '\n';
+		};
+
+		// the nbrs for one tcr
+		struct NbrsResult {
+			Sizes indices, distances;
+		};
 
 		if ( only_tcrdists ) {
-			ofstream out(outfile_prefix+"_tcrdists.txt");
-			cout << "making " << outfile_prefix+"_tcrdists.txt" << endl;
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				bool first(true);
-				for ( PairedTCR const & other_tcr : tcrs ) {
-					// NOTE we round down to an integer here!
-					if ( first ) first=false;
-					else out << ' ';
-					out << Size( 0.5 + atcrdist(atcr, other_tcr.first) + btcrdist(btcr, other_tcr.second) );
-				}
-				out << '\n';
-			}
+			string const filename( outfile_prefix+"_tcrdists"+( binary ? ".bin" : ".txt" ) );
+			cout << "making " << filename << endl;
+			ofstream out;
+			BinaryArrayWriter< float > * bin_out(0);
+			if ( binary ) bin_out = new BinaryArrayWriter< float >( filename, column_tcrs.size() );
+			else out.open( filename );
+
+			run_rows_in_parallel< Sizes >(
+				num_tcrs, num_threads,
+				[&]( Size const ii, Sizes & dists, Size ) {
+					compute_tcrdist_row( atcrdist, btcrdist, tcrs[ii], column_tcrs, dists );
+				},
+				[&]( Size const ii, Sizes const & dists ) {
+					show_progress( ii );
+					if ( binary ) bin_out->write_row( dists );
+					else write_line( out, dists );
+				} );
 			cerr << endl;
-			out.close();
+			if ( binary ) delete bin_out;
+			else out.close();
 
 		} else if ( num_nbrs > 0 ) {
 			// open the outfiles
-			ofstream out_indices(outfile_prefix+"_knn_indices.txt");
-			ofstream out_distances(outfile_prefix+"_knn_distances.txt");
-
-			cout << "making " << outfile_prefix+"_knn_indices.txt" << " and " <<
-				outfile_prefix+"_knn_distances.txt" << endl;
-
-			Sizes dists(num_tcrs), sortdists(num_tcrs); // must be a better way to do this...
-			Sizes knn_indices, knn_distances;
-			knn_indices.reserve(num_nbrs);
-			knn_distances.reserve(num_nbrs);
-
-			minstd_rand0 rng(1); // seed
-			Sizes shuffled_indices;
-			for ( Size i=0; i<num_tcrs; ++i ) shuffled_indices.push_back(i);
-
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-
-				// for ties, shuffle so we don't get biases based on file order
-				shuffle(shuffled_indices.begin(), shuffled_indices.end(), rng);
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				{
-					Size i(0);
-					for ( PairedTCR const & other_tcr : tcrs ) {
-						// NOTE we round down to an integer here!
-						dists[i] = Size( 0.5 + atcrdist(atcr, other_tcr.first) + btcrdist(btcr, other_tcr.second) );
-						++i;
-					}
-				}
-				Size const a(agroups[ii]), b(bgroups[ii]);
-				for ( Size jj=0; jj< num_tcrs; ++jj ) {
-					if ( agroups[jj] == a || bgroups[jj] == b ) dists[jj] = BIG_DIST;
-				}
-				runtime_assert( dists[ii] == BIG_DIST );
-				copy(dists.begin(), dists.end(), sortdists.begin());
-				nth_element(sortdists.begin(), sortdists.begin()+num_nbrs-1, sortdists.end());
-				Size const threshold(sortdists[num_nbrs-1]);
-				Size num_at_threshold(0);
-				for ( Size i=0; i<num_nbrs; ++i ) {
-					// runtime_assert( sortdists[i] <= threshold ); // for debugging
-					if ( sortdists[i] == threshold ) ++num_at_threshold;
-				}
-				// for ( Size i=num_nbrs; i< num_tcrs; ++i ) { // just for debugging
-				// 	runtime_assert( sortdists[i] >= threshold );
-				// }
-				// if ( ii%500==0 ) {
-				// 	cout << "threshold: " << threshold << " num_at_threshold: " <<
-				// 		num_at_threshold << " ii: " << ii << endl;
-				// }
-				knn_distances.clear();
-				knn_indices.clear();
-				for ( Size i : shuffled_indices ) {
-					if ( dists[i] < threshold ) {
-						knn_indices.push_back(i);
-						knn_distances.push_back(dists[i]);
-					} else if ( dists[i] == threshold && num_at_threshold>0 ) {
-						knn_indices.push_back(i);
-						knn_distances.push_back(dists[i]);
-						--num_at_threshold;
-					}
-				}
-				runtime_assert(knn_indices.size() == num_nbrs);
-				runtime_assert(knn_distances.size() == num_nbrs);
-				// save to files:
-				for ( Size j=0; j<num_nbrs; ++j ) {
-					if (j) {
-						out_indices << ' ';
-						out_distances << ' ';
-					}
-					out_indices << knn_indices[j];
-					out_distances << knn_distances[j];
-				}
-				out_indices << '\n';
-				out_distances << '\n';
+			string const suffix( binary ? ".bin" : ".txt" );
+			ofstream out_indices, out_distances;
+			BinaryArrayWriter< int32_t > * bin_indices(0);
+			BinaryArrayWriter< float > * bin_distances(0);
+			if ( binary ) {
+				bin_indices = new BinaryArrayWriter< int32_t >(outfile_prefix+"_knn_indices.bin", num_nbrs);
+				bin_distances = new BinaryArrayWriter< float >(outfile_prefix+"_knn_distances.bin", num_nbrs);
+			} else {
+				out_indices.open(outfile_prefix+"_knn_indices.txt");
+				out_distances.open(outfile_prefix+"_knn_distances.txt");
 			}
+
+			cout << "making " << outfile_prefix+"_knn_indices"+suffix << " and " <<
+				outfile_prefix+"_knn_distances"+suffix << endl;
+
+			// per-thread scratch space
+			vector< KnnScratch > scratch( num_threads );
+
+			auto compute_knn = [&]( Size const ii, NbrsResult & result, Size const thread_index ) {
+				find_knn_row( ii, atcrdist, btcrdist, tcrs, agroups, bgroups, num_nbrs, scratch[ thread_index ],
+					result.indices, result.distances );
+			};
+
+			run_rows_in_parallel< NbrsResult >(
+				num_tcrs, num_threads, compute_knn,
+				[&]( Size const ii, NbrsResult const & result ) {
+					show_progress( ii );
+					if ( binary ) {
+						bin_indices->write_row( result.indices );
+						bin_distances->write_row( result.distances );
+					} else {
+						write_line( out_indices, result.indices );
+						write_line( out_distances, result.distances );
+					}
+				} );
+
 			cerr << endl;
 			// close the output files
-			out_indices.close();
-			out_distances.close();
+			if ( binary ) {
+				delete bin_indices;
+				delete bin_distances;
+			} else {
+				out_indices.close();
+				out_distances.close();
+			}
 
 		} else { // using threshold definition of nbr-ness
 			// open the outfiles
-			ofstream out_indices(outfile_prefix+"_nbr"+to_string(threshold_int)+"_indices.txt");
-			ofstream out_distances(outfile_prefix+"_nbr"+to_string(threshold_int)+"_distances.txt");
+			string const prefix( outfile_prefix+"_nbr"+to_string(threshold_int) ), suffix( binary ? ".bin" : ".txt" );
+			ofstream out_indices, out_distances;
+			BinaryArrayWriter< int64_t > * bin_indptr(0);
+			BinaryArrayWriter< int32_t > * bin_indices(0);
+			BinaryArrayWriter< float > * bin_distances(0);
+			if ( binary ) { // CSR format
+				bin_indptr = new BinaryArrayWriter< int64_t >(prefix+"_indptr.bin", 1);
+				bin_indices = new BinaryArrayWriter< int32_t >(prefix+"_indices.bin", 1);
+				bin_distances = new BinaryArrayWriter< float >(prefix+"_distances.bin", 1);
+				bin_indptr->write( int64_t(0) );
+				cout << "making " << prefix+"_indptr.bin" << ", ";
+			} else {
+				out_indices.open(prefix+"_indices.txt");
+				out_distances.open(prefix+"_distances.txt");
+			}
 
-			cout << "making " << outfile_prefix+"_nbr"+to_string(threshold_int)+"_indices.txt" << " and " <<
-				outfile_prefix+"_nbr"+to_string(threshold_int)+"_distances.txt" << endl;
+			cout << "making " << prefix+"_indices"+suffix << " and " << prefix+"_distances"+suffix << endl;
+			int64_t nnz(0);
 
 			runtime_assert( threshold_int >= 0 );
 			Size const threshold(threshold_int);
 
-			Sizes knn_indices, knn_distances;
-			knn_indices.reserve(num_tcrs);
-			knn_distances.reserve(num_tcrs);
-
-			for ( Size ii=0; ii< num_tcrs; ++ii ) {
-				if ( ii && ii%100==0 ) cerr << '.';
-				if ( ii && ii%5000==0 ) cerr << ' ' << ii << endl;
-				knn_indices.clear();
-				knn_distances.clear();
-
-				// for ties, shuffle so we don't get biases based on file order
-				DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
-				Size const a(agroups[ii]), b(bgroups[ii]);
-				for ( Size jj=0; jj< num_tcrs; ++jj ) {
-					Size const dist( 0.5 + atcrdist(atcr, tcrs[jj].first) + btcrdist(btcr, tcrs[jj].second) );
-					if ( dist <= threshold && agroups[jj] != a && bgroups[jj] != b ) {
-						knn_indices.push_back(jj);
-						knn_distances.push_back(dist);
+			// skip (alpha cdr3 length, beta cdr3 length) buckets that are guaranteed to be beyond threshold
+			PairedTCRLengthIndex const length_index( tcrs, atcrdist, btcrdist );
+			vector< bools > candidate_buckets_scratch( num_threads );
+
+			auto compute_threshold_nbrs = [&]( Size const ii, NbrsResult & result, Size const thread_index ) {
+				find_threshold_nbrs_row( ii, atcrdist, btcrdist, tcrs, agroups, bgroups, threshold, length_index,
+					candidate_buckets_scratch[ thread_index ], result.indices, result.distances );
+			};
+
+			run_rows_in_parallel< NbrsResult >(
+				num_tcrs, num_threads, compute_threshold_nbrs,
+				[&]( Size const ii, NbrsResult const & result ) {
+					show_progress( ii );
+					if ( binary ) {
+						nnz += result.indices.size();
+						bin_indptr->write( nnz );
+						bin_indices->write_row( result.indices );
+						bin_distances->write_row( result.distances );
+					} else { // note that these lines may be empty!!!
+						write_line( out_indices, result.indices );
+						write_line( out_distances, result.distances );
 					}
-				}
+				} );
 
-				// save to file: note that these lines may be empty!!!
-				for ( Size j=0; j<knn_indices.size(); ++j ) {
-					if (j) {
-						out_indices << ' ';
-						out_distances << ' ';
-					}
-					out_indices << knn_indices[j];
-					out_distances << knn_distances[j];
-				}
-				out_indices << '\n';
-				out_distances << '\n';
-			}
 			cerr << endl;
 			// close the output files
-			out_indices.close();
-			out_distances.close();
+			if ( binary ) {
+				delete bin_indptr;
+				delete bin_indices;
+				delete bin_distances;
+			} else {
+				out_indices.close();
+				out_distances.close();
+			}
 		}
 
 	} catch (TCLAP::ArgException &e)  // catch any exceptions
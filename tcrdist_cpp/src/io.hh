@@ -7,6 +7,7 @@
 #include "types.hh"
 #include "tcrdist.hh"
 #include "misc.hh"
+#include <cstdint>
 
 // #include <random>
 // #include <iomanip>
@@ -159,4 +160,88 @@ read_groups_from_file( string const & filename )
 
 
 
+//////////////////////////////////// BINARY ARRAY OUTPUT
+//
+// raw row-major array data preceded by a 32 byte header of four int64s:
+//    magic, dtype_code, nrows, ncols
+// 1D arrays are written with ncols=1
+//
+// see conga/util.py:read_tcrdist_binary_array for the python reader
+//
+int64_t const BINARY_ARRAY_MAGIC( 0x54534944524354 ); // the bytes "TCRDIST\0" little-endian
+
+template< typename T > int64_t binary_dtype_code();
+template<> int64_t binary_dtype_code< int32_t >() { return 1; }
+template<> int64_t binary_dtype_code< float >() { return 2; }
+template<> int64_t binary_dtype_code< int64_t >() { return 3; }
+
+// writes rows as they come in; nrows in the header is filled in by close()
+template< typename T >
+class BinaryArrayWriter {
+public:
+
+	BinaryArrayWriter( string const & filename, Size const ncols ):
+		out_( filename.c_str(), ios::out | ios::binary ),
+		ncols_( ncols ),
+		num_written_( 0 )
+	{
+		if ( !out_.good() ) {
+			cerr << "unable to open " << filename << endl;
+			exit(1);
+		}
+		write_header();
+	}
+
+	~BinaryArrayWriter() { close(); }
+
+	template< typename U >
+	void
+	write_row( vector< U > const & row )
+	{
+		buffer_.resize( row.size() );
+		for ( Size i=0; i<row.size(); ++i ) buffer_[i] = T( row[i] );
+		write( buffer_ );
+	}
+
+	void
+	write( vector< T > const & values )
+	{
+		out_.write( reinterpret_cast< char const * >( values.data() ), values.size() * sizeof(T) );
+		num_written_ += values.size();
+	}
+
+	void
+	write( T const value )
+	{
+		out_.write( reinterpret_cast< char const * >( &value ), sizeof(T) );
+		++num_written_;
+	}
+
+	void
+	close()
+	{
+		if ( !out_.is_open() ) return;
+		runtime_assert( ncols_ == 0 || num_written_ % ncols_ == 0 );
+		out_.seekp( 0 );
+		write_header();
+		out_.close();
+	}
+
+private:
+
+	void
+	write_header()
+	{
+		int64_t const header[4] = { BINARY_ARRAY_MAGIC, binary_dtype_code< T >(),
+			int64_t( ncols_ ? num_written_ / ncols_ : 0 ), int64_t( ncols_ ) };
+		out_.write( reinterpret_cast< char const * >( header ), sizeof( header ) );
+	}
+
+	ofstream out_;
+	Size ncols_;
+	Size num_written_;
+	vector< T > buffer_;
+};
+
+
 #endif
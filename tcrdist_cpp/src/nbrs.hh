@@ -0,0 +1,172 @@
+// The per-row calculations behind find_neighbors and calc_distributions, shared with the tcrdist
+// shared library (tcrdist_lib.cc)
+//
+// each function computes the results for a single (row) tcr and only depends on the row, so they can be
+// handed to run_rows_in_parallel (see parallel.hh)
+//
+
+#ifndef INCLUDED_nbrs_HH
+#define INCLUDED_nbrs_HH
+
+#include "tcrdist.hh"
+#include <random>
+#include <numeric>
+
+
+// dists[jj] = tcrdist from tcr to column_tcrs[jj]
+// NOTE we round down to an integer here!
+void
+compute_tcrdist_row(
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	PairedTCR const & tcr,
+	vector< PairedTCR > const & column_tcrs,
+	Sizes & dists
+)
+{
+	DistanceTCR_g const &atcr( tcr.first ), &btcr( tcr.second);
+	dists.resize( column_tcrs.size() );
+	for ( Size jj=0; jj< column_tcrs.size(); ++jj ) {
+		dists[jj] = Size( 0.5 + atcrdist(atcr, column_tcrs[jj].first) + btcrdist(btcr, column_tcrs[jj].second) );
+	}
+}
+
+
+// per-thread scratch space for find_knn_row
+struct KnnScratch {
+	Sizes dists, sortdists, shuffled_indices;
+	minstd_rand0 rng;
+};
+
+// the num_nbrs nearest nbrs of tcrs[ii], excluding tcrs in the same agroup or bgroup (which includes ii)
+void
+find_knn_row(
+	Size const ii,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & tcrs,
+	Sizes const & agroups,
+	Sizes const & bgroups,
+	Size const num_nbrs,
+	KnnScratch & sc,
+	Sizes & knn_indices,
+	Sizes & knn_distances
+)
+{
+	Size const BIG_DIST(10000);
+	Size const num_tcrs( tcrs.size() );
+	Sizes & dists( sc.dists ), & sortdists( sc.sortdists ), & shuffled_indices( sc.shuffled_indices );
+
+	// for ties, shuffle so we don't get biases based on file order
+	// the rng is seeded by the row so the results dont depend on the number of threads
+	sc.rng.seed( ii+1 );
+	shuffled_indices.resize( num_tcrs );
+	iota( shuffled_indices.begin(), shuffled_indices.end(), 0 );
+	shuffle(shuffled_indices.begin(), shuffled_indices.end(), sc.rng);
+
+	compute_tcrdist_row( atcrdist, btcrdist, tcrs[ii], tcrs, dists );
+	Size const a(agroups[ii]), b(bgroups[ii]);
+	for ( Size jj=0; jj< num_tcrs; ++jj ) {
+		if ( agroups[jj] == a || bgroups[jj] == b ) dists[jj] = BIG_DIST;
+	}
+	runtime_assert( dists[ii] == BIG_DIST );
+	sortdists = dists;
+	nth_element(sortdists.begin(), sortdists.begin()+num_nbrs-1, sortdists.end());
+	Size const threshold(sortdists[num_nbrs-1]);
+	Size num_at_threshold(0);
+	for ( Size i=0; i<num_nbrs; ++i ) {
+		if ( sortdists[i] == threshold ) ++num_at_threshold;
+	}
+	knn_distances.clear();
+	knn_indices.clear();
+	knn_indices.reserve(num_nbrs);
+	knn_distances.reserve(num_nbrs);
+	for ( Size i : shuffled_indices ) {
+		if ( dists[i] < threshold ) {
+			knn_indices.push_back(i);
+			knn_distances.push_back(dists[i]);
+		} else if ( dists[i] == threshold && num_at_threshold>0 ) {
+			knn_indices.push_back(i);
+			knn_distances.push_back(dists[i]);
+			--num_at_threshold;
+		}
+	}
+	runtime_assert(knn_indices.size() == num_nbrs);
+	runtime_assert(knn_distances.size() == num_nbrs);
+}
+
+
+// all the nbrs of tcrs[ii] within threshold, in increasing index order, excluding tcrs in the same agroup or
+// bgroup. is_candidate_bucket is per-thread scratch space
+void
+find_threshold_nbrs_row(
+	Size const ii,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	vector< PairedTCR > const & tcrs,
+	Sizes const & agroups,
+	Sizes const & bgroups,
+	Size const threshold,
+	PairedTCRLengthIndex const & length_index,
+	bools & is_candidate_bucket,
+	Sizes & nbr_indices,
+	Sizes & nbr_distances
+)
+{
+	nbr_indices.clear();
+	nbr_distances.clear();
+
+	DistanceTCR_g const &atcr( tcrs[ii].first ), &btcr( tcrs[ii].second);
+	Size const a(agroups[ii]), b(bgroups[ii]);
+	// skip (alpha cdr3 length, beta cdr3 length) buckets that are guaranteed to be beyond threshold
+	length_index.find_candidate_buckets( tcrs[ii], threshold, is_candidate_bucket );
+	for ( Size jj=0; jj< tcrs.size(); ++jj ) {
+		if ( !is_candidate_bucket[ length_index.bucket(jj) ] ) continue;
+		Size const dist( 0.5 + atcrdist(atcr, tcrs[jj].first) + btcrdist(btcr, tcrs[jj].second) );
+		if ( dist <= threshold && agroups[jj] != a && bgroups[jj] != b ) {
+			nbr_indices.push_back(jj);
+			nbr_distances.push_back(dist);
+		}
+	}
+}
+
+
+// per-thread scratch space for count_paired_distances_row
+struct CountsScratch {
+	Sizes acounts, bcounts;
+};
+
+// paired_counts[d] = number of (alpha,beta) background chain pairs at paired tcrdist d from tcr, for d<=max_dist
+void
+count_paired_distances_row(
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist,
+	PairedTCR const & tcr,
+	EncodedSingleChains const & achains,
+	EncodedSingleChains const & bchains,
+	Size const max_dist,
+	CountsScratch & sc,
+	Sizes & paired_counts
+)
+{
+	Sizes & acounts( sc.acounts ), & bcounts( sc.bcounts );
+	acounts.resize( max_dist+1 );
+	bcounts.resize( max_dist+1 );
+	fill( acounts.begin(), acounts.end(), 0 );
+	fill( bcounts.begin(), bcounts.end(), 0 );
+	atcrdist.count_single_chain_distances( tcr.first, achains, max_dist, acounts );
+	btcrdist.count_single_chain_distances( tcr.second, bchains, max_dist, bcounts );
+
+	// compute probability distribution for paired distances using convolution
+	paired_counts.resize( max_dist+1 );
+	for ( Size d=0; d<= max_dist; ++d ) {
+		Size count(0);
+		for ( Size adist=0; adist<= d; ++adist ) {
+			count += acounts[adist] * bcounts[d-adist];
+		}
+		paired_counts[d] = count;
+	}
+}
+
+
+#endif
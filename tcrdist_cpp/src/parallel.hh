@@ -0,0 +1,60 @@
+// Simple helper for spreading independent per-row calculations over threads
+//
+
+#ifndef INCLUDED_parallel_HH
+#define INCLUDED_parallel_HH
+
+#include "types.hh"
+#include <thread>
+
+
+// Computes results for rows [0,num_rows) using num_threads threads and hands them to write_row
+// in row order.
+//
+// The rows are processed in rounds of num_threads*rows_per_thread rows; within a round each thread
+// fills its own contiguous slice of the round buffer, then the main thread writes the buffer out in
+// order before starting the next round. So the output is identical for any number of threads, as
+// long as compute_row( row, result, thread_index ) only depends on row (thread_index is there so
+// that callers can hand out per-thread scratch space).
+//
+template< typename RowResult, typename ComputeFn, typename WriteFn >
+void
+run_rows_in_parallel(
+	Size const num_rows,
+	Size const num_threads,
+	ComputeFn compute_row,
+	WriteFn write_row,
+	Size const rows_per_thread = 16
+)
+{
+	runtime_assert( num_threads >= 1 );
+	Size const round_size( num_threads * rows_per_thread );
+	vector< RowResult > buffer( round_size );
+
+	for ( Size round_start=0; round_start < num_rows; round_start += round_size ) {
+		Size const round_stop( min( num_rows, round_start + round_size ) );
+
+		auto compute_slice = [&]( Size const thread_index ) {
+			Size const start( round_start + thread_index * rows_per_thread ),
+				stop( min( round_stop, start + rows_per_thread ) );
+			for ( Size row=start; row < stop; ++row ) {
+				compute_row( row, buffer[ row - round_start ], thread_index );
+			}
+		};
+
+		if ( num_threads == 1 ) {
+			compute_slice( 0 );
+		} else {
+			vector< thread > threads;
+			for ( Size t=0; t<num_threads; ++t ) threads.push_back( thread( compute_slice, t ) );
+			for ( thread & t : threads ) t.join();
+		}
+
+		for ( Size row=round_start; row < round_stop; ++row ) {
+			write_row( row, buffer[ row - round_start ] );
+		}
+	}
+}
+
+
+#endif
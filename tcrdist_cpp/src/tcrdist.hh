@@ -5,6 +5,7 @@
 #define INCLUDED_tcrdist_HH
 
 #include "misc.hh"
+#include <cstdint>
 
 // struct to hold information on a single TCR that is needed to quickly compute TCRdist
 // V-gene level data
@@ -28,6 +29,16 @@ struct DistanceTCR_gs {
 	string cdr3; // from C to 'F'
 };
 
+// a set of single-chain TCRs with their CDR3s encoded as amino acid indices (0-19), grouped by CDR3 length
+// so that the sequences in each length group sit in one contiguous block of memory
+// see TCRdistCalculator::encode_single_chains
+struct EncodedSingleChains {
+	Sizes cdr3_lengths; // the distinct CDR3 lengths, one per group
+	vector< Sizes > v_nums; // v_nums[g][k] is the V gene of the k-th TCR in group g
+	vector< vector< uint8_t > > cdr3s; // cdr3s[g][ k*cdr3_lengths[g] + i ] is position i of the k-th CDR3 in group g
+	vector< Sizes > distinct_v_nums; // the distinct V genes in each group, for lower-bounding distances
+};
+
 // a paired tcr with gene-level (actually allele level) resolution
 // DistanceTCR_g is defined in tcrdist.hh
 typedef std::pair< DistanceTCR_g, DistanceTCR_g > PairedTCR;
@@ -63,6 +74,33 @@ public:
 	Real
 	operator()( DistanceTCR_gs const & t1, DistanceTCR_gs const & t2 ) const;
 
+	// encode TCRs for fast one-vs-many distance calculations with count_single_chain_distances
+	EncodedSingleChains
+	encode_single_chains( vector< DistanceTCR_g > const & tcrs ) const;
+
+	// increments counts[d] for each TCR in bg_tcrs at (rounded) distance d <= max_dist from tcr
+	// counts should have size max_dist+1. Gives the same distances as operator() but goes through the
+	// flat V and AA distance tables and skips CDR3 length groups that are out of range
+	void
+	count_single_chain_distances(
+		DistanceTCR_g const & tcr,
+		EncodedSingleChains const & bg_tcrs,
+		Size const max_dist,
+		Sizes & counts
+	) const;
+
+	// lower bounds on the distance: since all the terms in the distance are non-negative,
+	//   Size( 0.5 + min_v_distance(t1.v_num, v_nums) + cdr3_gap_distance(len(t1.cdr3), len) ) <= Size( 0.5 + dist )
+	// for any t2 with t2.v_num in v_nums and len(t2.cdr3) == len (also for sums of bounds over the two chains)
+	Real
+	min_v_distance( Size const v_num, Sizes const & v_nums ) const;
+
+	Real
+	cdr3_gap_distance( Size const len1, Size const len2 ) const;
+
+	Size
+	num_v_genes() const { return v_genes_.size(); }
+
 	inline
 	Real
 	aa_distance( char const a, char const b ) const;
@@ -71,6 +109,12 @@ public:
 	Real
 	cdr3_distance( string const & a, string const & b ) const;
 
+	Size
+	v_gene_number( string const & v_gene ) const {
+		runtime_assert( v_gene2v_num_.count( v_gene ) );
+		return v_gene2v_num_.find( v_gene )->second;
+	}
+
 	string const &
 	v_gene( Size const v_num ) const {
 		runtime_assert( v_num < v_genes_.size() );
@@ -116,6 +160,11 @@ private:
 	// helpful
 	string amino_acids_;
 
+	// flat versions of V_dist_matrix_ (num_v_genes x num_v_genes) and AA_dist_matrix_ (20x20, indexed by
+	// position in amino_acids_), for count_single_chain_distances
+	Reals flat_V_dist_matrix_;
+	Reals flat_AA_dist_matrix_;
+
 };
 
 
@@ -233,6 +282,20 @@ TCRdistCalculator::TCRdistCalculator(
 		}
 	}
 
+	flat_V_dist_matrix_.resize( num_v_genes * num_v_genes );
+	for ( Size i=0; i< num_v_genes; ++i ) {
+		for ( Size j=0; j< num_v_genes; ++j ) {
+			flat_V_dist_matrix_[ i*num_v_genes + j ] = V_dist_matrix_[i][j];
+		}
+	}
+
+	flat_AA_dist_matrix_.resize( 20*20 );
+	for ( Size i=0; i<20; ++i ) {
+		for ( Size j=0; j<20; ++j ) {
+			flat_AA_dist_matrix_[ i*20 + j ] = aa_distance( amino_acids_[i], amino_acids_[j] );
+		}
+	}
+
 }
 
 // returns true if OK
@@ -428,5 +491,224 @@ TCRdistCalculator::create_distance_tcr_gs(
 }
 
 
+EncodedSingleChains
+TCRdistCalculator::encode_single_chains(
+	vector< DistanceTCR_g > const & tcrs
+) const
+{
+	EncodedSingleChains encoded;
+	map< Size, Size > length2group;
+	for ( DistanceTCR_g const & tcr : tcrs ) {
+		Size const len( tcr.cdr3.size() );
+		if ( !length2group.count( len ) ) {
+			length2group[ len ] = encoded.cdr3_lengths.size();
+			encoded.cdr3_lengths.push_back( len );
+			encoded.v_nums.push_back( Sizes() );
+			encoded.cdr3s.push_back( vector< uint8_t >() );
+		}
+		Size const g( length2group[ len ] );
+		encoded.v_nums[g].push_back( tcr.v_num );
+		if ( encoded.distinct_v_nums.size() <= g ) encoded.distinct_v_nums.resize( g+1 );
+		Sizes & vs( encoded.distinct_v_nums[g] );
+		if ( find( vs.begin(), vs.end(), tcr.v_num ) == vs.end() ) vs.push_back( tcr.v_num );
+		for ( char const aa : tcr.cdr3 ) {
+			Size const aa_ind( amino_acids_.find( aa ) );
+			runtime_assert( aa_ind != string::npos );
+			encoded.cdr3s[g].push_back( uint8_t( aa_ind ) );
+		}
+	}
+	return encoded;
+}
+
+
+void
+TCRdistCalculator::count_single_chain_distances(
+	DistanceTCR_g const & tcr,
+	EncodedSingleChains const & bg_tcrs,
+	Size const max_dist,
+	Sizes & counts
+) const
+{
+	static int const ntrim(3), ctrim(2); // same params as cdr3_distance
+	runtime_assert( counts.size() == max_dist+1 );
+
+	Size const num_v_genes( v_genes_.size() );
+	Real const * const v_dists( &flat_V_dist_matrix_[ tcr.v_num * num_v_genes ] );
+	int const len( tcr.cdr3.size() );
+
+	// for each aligned position: the bg cdr3 position and a row of 20 distances from the fixed tcr aa
+	Sizes bg_positions;
+	Reals profile;
+
+	for ( Size g=0; g< bg_tcrs.cdr3_lengths.size(); ++g ) {
+		int const bg_len( bg_tcrs.cdr3_lengths[g] );
+		int const lenshort( min( len, bg_len ) ), lenlong( max( len, bg_len ) ), lendiff( lenlong-lenshort ),
+			gappos( min( 6, 3 + (lenshort-5)/2 ) ), remainder( lenshort-gappos );
+		runtime_assert( lenshort >= 5 );
+		Real const gap_dist( lendiff * gap_penalty_cdr3_region_ );
+		if ( gap_dist >= max_dist + 0.5 ) continue; // all the other terms are non-negative
+		if ( Size( 0.5 + ( min_v_distance( tcr.v_num, bg_tcrs.distinct_v_nums[g] ) + gap_dist ) ) > max_dist ) {
+			continue;
+		}
+
+		// same alignment (and summation order) as in cdr3_distance
+		bool const tcr_is_short( len <= bg_len );
+		bg_positions.clear();
+		profile.clear();
+		auto add_position = [&]( int const pos, int const bg_pos ) {
+			Size const aa_ind( amino_acids_.find( tcr.cdr3[ pos ] ) );
+			runtime_assert( aa_ind != string::npos );
+			bg_positions.push_back( bg_pos );
+			for ( Size j=0; j<20; ++j ) {
+				// aa_distance is called with the short sequence first
+				profile.push_back( tcr_is_short ? flat_AA_dist_matrix_[ aa_ind*20 + j ] :
+					flat_AA_dist_matrix_[ j*20 + aa_ind ] );
+			}
+		};
+		for ( int i=ntrim; i<gappos; ++i ) {
+			add_position( i, i );
+		}
+		for ( int i=ctrim; i<remainder; ++i ) {
+			add_position( len-1-i, bg_len-1-i );
+		}
+		Size const num_positions( bg_positions.size() );
+
+		Sizes const & v_nums( bg_tcrs.v_nums[g] );
+		uint8_t const * cdr3( &bg_tcrs.cdr3s[g][0] );
+		for ( Size k=0; k< v_nums.size(); ++k, cdr3 += bg_len ) {
+			Real dist( 0 );
+			for ( Size p=0; p< num_positions; ++p ) {
+				dist += profile[ p*20 + cdr3[ bg_positions[p] ] ];
+			}
+			Size const d( 0.5 + ( v_dists[ v_nums[k] ] + ( weight_cdr3_region_ * dist + gap_dist ) ) );
+			if ( d <= max_dist ) ++counts[d];
+		}
+	}
+}
+
+
+Real
+TCRdistCalculator::min_v_distance(
+	Size const v_num,
+	Sizes const & v_nums
+) const
+{
+	Size const num_v_genes( v_genes_.size() );
+	Real const * const v_dists( &flat_V_dist_matrix_[ v_num * num_v_genes ] );
+	Real min_vdist( 1e6 );
+	for ( Size v : v_nums ) {
+		min_vdist = min( min_vdist, v_dists[ v ] );
+	}
+	return min_vdist;
+}
+
+Real
+TCRdistCalculator::cdr3_gap_distance(
+	Size const len1,
+	Size const len2
+) const
+{
+	int const lendiff( len1 < len2 ? len2 - len1 : len1 - len2 );
+	return lendiff * gap_penalty_cdr3_region_;
+}
+
+
+// buckets paired TCRs by (alpha CDR3 length, beta CDR3 length) so that threshold searches can skip whole
+// buckets whose lower bound distance (closest V distances plus the CDR3 gap penalties) is beyond the threshold
+class PairedTCRLengthIndex {
+public:
+
+	PairedTCRLengthIndex(
+		vector< PairedTCR > const & tcrs,
+		TCRdistCalculator const & atcrdist,
+		TCRdistCalculator const & btcrdist
+	);
+
+	// sets is_candidate_bucket[b] to true for the buckets b that could contain TCRs within threshold of tcr, ie
+	// with Size(0.5 + adist + bdist) <= threshold. All the TCRs in the other buckets are beyond threshold.
+	void
+	find_candidate_buckets(
+		PairedTCR const & tcr,
+		Size const threshold,
+		bools & is_candidate_bucket
+	) const;
+
+	// the bucket that tcrs[ii] belongs to
+	Size
+	bucket( Size const ii ) const { return tcr_buckets_[ii]; }
+
+	Size
+	num_buckets() const { return cdr3_lengths_.size(); }
+
+private:
+	TCRdistCalculator const & atcrdist_;
+	TCRdistCalculator const & btcrdist_;
+	vector< SizePair > cdr3_lengths_; // (alpha, beta) cdr3 lengths for each bucket
+	Sizes tcr_buckets_;
+	// min_va_dists_[b][v] = smallest V distance from V gene v to any of the alpha V genes in bucket b
+	vector< Reals > min_va_dists_, min_vb_dists_;
+
+};
+
+
+PairedTCRLengthIndex::PairedTCRLengthIndex(
+	vector< PairedTCR > const & tcrs,
+	TCRdistCalculator const & atcrdist,
+	TCRdistCalculator const & btcrdist
+):
+	atcrdist_( atcrdist ),
+	btcrdist_( btcrdist )
+{
+	map< SizePair, Size > lengths2bucket;
+	vector< Sizes > distinct_va_nums, distinct_vb_nums;
+	for ( Size ii=0; ii< tcrs.size(); ++ii ) {
+		SizePair const lengths( tcrs[ii].first.cdr3.size(), tcrs[ii].second.cdr3.size() );
+		if ( !lengths2bucket.count( lengths ) ) {
+			lengths2bucket[ lengths ] = cdr3_lengths_.size();
+			cdr3_lengths_.push_back( lengths );
+			distinct_va_nums.push_back( Sizes() );
+			distinct_vb_nums.push_back( Sizes() );
+		}
+		Size const b( lengths2bucket[ lengths ] );
+		tcr_buckets_.push_back( b );
+		Sizes & vas( distinct_va_nums[b] ), & vbs( distinct_vb_nums[b] );
+		if ( find( vas.begin(), vas.end(), tcrs[ii].first.v_num ) == vas.end() ) vas.push_back( tcrs[ii].first.v_num );
+		if ( find( vbs.begin(), vbs.end(), tcrs[ii].second.v_num ) == vbs.end() ) vbs.push_back( tcrs[ii].second.v_num );
+	}
+
+	for ( Size r=0; r<2; ++r ) {
+		TCRdistCalculator const & tcrdist( r==0 ? atcrdist : btcrdist );
+		vector< Sizes > const & distinct_v_nums( r==0 ? distinct_va_nums : distinct_vb_nums );
+		vector< Reals > & min_v_dists( r==0 ? min_va_dists_ : min_vb_dists_ );
+		min_v_dists.resize( num_buckets() );
+		for ( Size b=0; b< num_buckets(); ++b ) {
+			min_v_dists[b].resize( tcrdist.num_v_genes() );
+			for ( Size v=0; v< tcrdist.num_v_genes(); ++v ) {
+				min_v_dists[b][v] = tcrdist.min_v_distance( v, distinct_v_nums[b] );
+			}
+		}
+	}
+}
+
+
+void
+PairedTCRLengthIndex::find_candidate_buckets(
+	PairedTCR const & tcr,
+	Size const threshold,
+	bools & is_candidate_bucket
+) const
+{
+	is_candidate_bucket.resize( num_buckets() );
+	Size const alen( tcr.first.cdr3.size() ), blen( tcr.second.cdr3.size() );
+	for ( Size b=0; b< num_buckets(); ++b ) {
+		// same arithmetic as TCRdistCalculator::operator(), with all the cdr3 mismatch terms set to 0
+		Real const abound( min_va_dists_[b][ tcr.first.v_num ] +
+			atcrdist_.cdr3_gap_distance( alen, cdr3_lengths_[b].first ) );
+		Real const bbound( min_vb_dists_[b][ tcr.second.v_num ] +
+			btcrdist_.cdr3_gap_distance( blen, cdr3_lengths_[b].second ) );
+		is_candidate_bucket[b] = ( Size( 0.5 + abound + bbound ) <= threshold );
+	}
+}
+
 
 #endif
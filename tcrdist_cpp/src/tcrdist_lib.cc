@@ -0,0 +1,323 @@
+// Plain C interface to the tcrdist calculations, built as a shared library (bin/libtcrdist.so) and called
+// in-process from python via ctypes (see conga/tcrdist_lib.py), so no temporary files or subprocesses
+//
+// TCRs are passed as encoded arrays, one set per chain:
+//   v_nums: int64 V gene numbers, from tcrdist_v_gene_number
+//   cdr3s, cdr3_offsets: the CDR3s concatenated into one char buffer, the i-th CDR3 is
+//     cdr3s[ cdr3_offsets[i] : cdr3_offsets[i+1] ] (so cdr3_offsets has num_tcrs+1 entries)
+//
+// Functions returning int return 0 on success and nonzero on error (with a message to stderr)
+// The results are identical to the find_neighbors and calc_distributions executables, for any number of
+// threads
+//
+
+#include "types.hh"
+#include "nbrs.hh"
+#include "parallel.hh"
+
+
+struct TCRdistCalculators {
+	TCRdistCalculators( string const & db_filename ):
+		atcrdist( 'A', db_filename ),
+		btcrdist( 'B', db_filename )
+	{}
+
+	TCRdistCalculator const atcrdist, btcrdist;
+};
+
+// threshold nbrs in CSR format
+struct TCRdistCSR {
+	vector< int64_t > indptr;
+	vector< int32_t > indices;
+	vector< float > distances;
+};
+
+
+// returns false (after printing a message) if any of the TCRs are bad
+bool
+decode_single_chain_tcrs(
+	TCRdistCalculator const & tcrdist,
+	int64_t const num_tcrs,
+	int64_t const * v_nums,
+	char const * cdr3s,
+	int64_t const * cdr3_offsets,
+	vector< DistanceTCR_g > & tcrs
+)
+{
+	tcrs.resize( num_tcrs );
+	for ( int64_t i=0; i< num_tcrs; ++i ) {
+		string const cdr3( cdr3s + cdr3_offsets[i], cdr3s + cdr3_offsets[i+1] );
+		if ( v_nums[i] < 0 || Size( v_nums[i] ) >= tcrdist.num_v_genes() ) {
+			cerr << "tcrdist_lib: bad v_num: " << v_nums[i] << endl;
+			return false;
+		}
+		if ( !tcrdist.check_cdr3_ok( cdr3 ) ) {
+			cerr << "tcrdist_lib: bad cdr3: " << cdr3 << endl;
+			return false;
+		}
+		tcrs[i].v_num = v_nums[i];
+		tcrs[i].cdr3 = cdr3;
+	}
+	return true;
+}
+
+bool
+decode_paired_tcrs(
+	TCRdistCalculators const & calcs,
+	int64_t const num_tcrs,
+	int64_t const * va_nums,
+	char const * cdr3as,
+	int64_t const * cdr3a_offsets,
+	int64_t const * vb_nums,
+	char const * cdr3bs,
+	int64_t const * cdr3b_offsets,
+	vector< PairedTCR > & tcrs
+)
+{
+	vector< DistanceTCR_g > atcrs, btcrs;
+	if ( !decode_single_chain_tcrs( calcs.atcrdist, num_tcrs, va_nums, cdr3as, cdr3a_offsets, atcrs ) ||
+		!decode_single_chain_tcrs( calcs.btcrdist, num_tcrs, vb_nums, cdr3bs, cdr3b_offsets, btcrs ) ) {
+		return false;
+	}
+	tcrs.clear();
+	for ( int64_t i=0; i< num_tcrs; ++i ) tcrs.push_back( make_pair( atcrs[i], btcrs[i] ) );
+	return true;
+}
+
+// the default groups are just the tcr indices
+Sizes
+decode_groups( int64_t const num_tcrs, int64_t const * groups )
+{
+	Sizes result( num_tcrs );
+	for ( int64_t i=0; i< num_tcrs; ++i ) result[i] = ( groups ? groups[i] : i );
+	return result;
+}
+
+
+extern "C" {
+
+// returns 0 if the db file can't be read
+void *
+tcrdist_new_calculators( char const * db_filename )
+{
+	ifstream data( db_filename );
+	if ( !data.good() ) {
+		cerr << "tcrdist_lib: cant load the tcrdist database file: " << db_filename << endl;
+		return 0;
+	}
+	data.close();
+	return new TCRdistCalculators( db_filename );
+}
+
+void
+tcrdist_delete_calculators( void * calcs )
+{
+	delete static_cast< TCRdistCalculators * >( calcs );
+}
+
+// returns -1 if v_gene is not in the database
+int64_t
+tcrdist_v_gene_number( void const * calcs_in, char const chain, char const * v_gene )
+{
+	TCRdistCalculators const & calcs( *static_cast< TCRdistCalculators const * >( calcs_in ) );
+	if ( chain != 'A' && chain != 'B' ) return -1;
+	TCRdistCalculator const & tcrdist( chain == 'A' ? calcs.atcrdist : calcs.btcrdist );
+	if ( !tcrdist.check_v_gene_ok( v_gene ) ) return -1;
+	return tcrdist.v_gene_number( v_gene );
+}
+
+// knn_indices and knn_distances have shape (num_tcrs, num_nbrs), row-major
+// agroups and bgroups can be 0, meaning just exclude self
+int
+tcrdist_knn(
+	void const * calcs_in,
+	int64_t const num_tcrs,
+	int64_t const * va_nums, char const * cdr3as, int64_t const * cdr3a_offsets,
+	int64_t const * vb_nums, char const * cdr3bs, int64_t const * cdr3b_offsets,
+	int64_t const * agroups_in,
+	int64_t const * bgroups_in,
+	int64_t const num_nbrs,
+	int64_t const num_threads,
+	int32_t * knn_indices,
+	float * knn_distances
+)
+{
+	TCRdistCalculators const & calcs( *static_cast< TCRdistCalculators const * >( calcs_in ) );
+	vector< PairedTCR > tcrs;
+	if ( !decode_paired_tcrs( calcs, num_tcrs, va_nums, cdr3as, cdr3a_offsets, vb_nums, cdr3bs, cdr3b_offsets,
+			tcrs ) ) return 1;
+	if ( num_nbrs < 1 || num_nbrs >= num_tcrs ) {
+		cerr << "tcrdist_lib: bad num_nbrs: " << num_nbrs << " num_tcrs: " << num_tcrs << endl;
+		return 1;
+	}
+	Sizes const agroups( decode_groups( num_tcrs, agroups_in ) ), bgroups( decode_groups( num_tcrs, bgroups_in ) );
+
+	struct NbrsResult {
+		Sizes indices, distances;
+	};
+	vector< KnnScratch > scratch( max( int64_t(1), num_threads ) );
+
+	run_rows_in_parallel< NbrsResult >(
+		num_tcrs, scratch.size(),
+		[&]( Size const ii, NbrsResult & result, Size const thread_index ) {
+			find_knn_row( ii, calcs.atcrdist, calcs.btcrdist, tcrs, agroups, bgroups, num_nbrs,
+				scratch[ thread_index ], result.indices, result.distances );
+		},
+		[&]( Size const ii, NbrsResult const & result ) {
+			for ( int64_t j=0; j< num_nbrs; ++j ) {
+				knn_indices[ ii*num_nbrs + j ] = result.indices[j];
+				knn_distances[ ii*num_nbrs + j ] = result.distances[j];
+			}
+		} );
+	return 0;
+}
+
+// returns a handle to the nbrs in CSR format (0 on error); get the arrays with tcrdist_csr_nnz and
+// tcrdist_csr_copy and then free with tcrdist_delete_csr
+void *
+tcrdist_threshold_nbrs(
+	void const * calcs_in,
+	int64_t const num_tcrs,
+	int64_t const * va_nums, char const * cdr3as, int64_t const * cdr3a_offsets,
+	int64_t const * vb_nums, char const * cdr3bs, int64_t const * cdr3b_offsets,
+	int64_t const * agroups_in,
+	int64_t const * bgroups_in,
+	int64_t const threshold,
+	int64_t const num_threads
+)
+{
+	TCRdistCalculators const & calcs( *static_cast< TCRdistCalculators const * >( calcs_in ) );
+	vector< PairedTCR > tcrs;
+	if ( !decode_paired_tcrs( calcs, num_tcrs, va_nums, cdr3as, cdr3a_offsets, vb_nums, cdr3bs, cdr3b_offsets,
+			tcrs ) ) return 0;
+	if ( threshold < 0 ) {
+		cerr << "tcrdist_lib: bad threshold: " << threshold << endl;
+		return 0;
+	}
+	Sizes const agroups( decode_groups( num_tcrs, agroups_in ) ), bgroups( decode_groups( num_tcrs, bgroups_in ) );
+
+	PairedTCRLengthIndex const length_index( tcrs, calcs.atcrdist, calcs.btcrdist );
+	vector< bools > candidate_buckets_scratch( max( int64_t(1), num_threads ) );
+
+	struct NbrsResult {
+		Sizes indices, distances;
+	};
+	TCRdistCSR * csr( new TCRdistCSR() );
+	csr->indptr.push_back( 0 );
+
+	run_rows_in_parallel< NbrsResult >(
+		num_tcrs, candidate_buckets_scratch.size(),
+		[&]( Size const ii, NbrsResult & result, Size const thread_index ) {
+			find_threshold_nbrs_row( ii, calcs.atcrdist, calcs.btcrdist, tcrs, agroups, bgroups, threshold,
+				length_index, candidate_buckets_scratch[ thread_index ], result.indices, result.distances );
+		},
+		[&]( Size const, NbrsResult const & result ) {
+			csr->indices.insert( csr->indices.end(), result.indices.begin(), result.indices.end() );
+			csr->distances.insert( csr->distances.end(), result.distances.begin(), result.distances.end() );
+			csr->indptr.push_back( csr->indices.size() );
+		} );
+	return csr;
+}
+
+int64_t
+tcrdist_csr_nnz( void const * csr )
+{
+	return static_cast< TCRdistCSR const * >( csr )->indices.size();
+}
+
+// indptr has num_tcrs+1 entries, indices and distances have nnz entries
+void
+tcrdist_csr_copy( void const * csr_in, int64_t * indptr, int32_t * indices, float * distances )
+{
+	TCRdistCSR const & csr( *static_cast< TCRdistCSR const * >( csr_in ) );
+	copy( csr.indptr.begin(), csr.indptr.end(), indptr );
+	copy( csr.indices.begin(), csr.indices.end(), indices );
+	copy( csr.distances.begin(), csr.distances.end(), distances );
+}
+
+void
+tcrdist_delete_csr( void * csr )
+{
+	delete static_cast< TCRdistCSR * >( csr );
+}
+
+// dists has shape (num_tcrs, num_target_tcrs), row-major
+int
+tcrdist_matrix(
+	void const * calcs_in,
+	int64_t const num_tcrs,
+	int64_t const * va_nums, char const * cdr3as, int64_t const * cdr3a_offsets,
+	int64_t const * vb_nums, char const * cdr3bs, int64_t const * cdr3b_offsets,
+	int64_t const num_target_tcrs,
+	int64_t const * target_va_nums, char const * target_cdr3as, int64_t const * target_cdr3a_offsets,
+	int64_t const * target_vb_nums, char const * target_cdr3bs, int64_t const * target_cdr3b_offsets,
+	int64_t const num_threads,
+	float * dists
+)
+{
+	TCRdistCalculators const & calcs( *static_cast< TCRdistCalculators const * >( calcs_in ) );
+	vector< PairedTCR > tcrs, target_tcrs;
+	if ( !decode_paired_tcrs( calcs, num_tcrs, va_nums, cdr3as, cdr3a_offsets, vb_nums, cdr3bs, cdr3b_offsets,
+			tcrs ) ||
+		!decode_paired_tcrs( calcs, num_target_tcrs, target_va_nums, target_cdr3as, target_cdr3a_offsets,
+			target_vb_nums, target_cdr3bs, target_cdr3b_offsets, target_tcrs ) ) return 1;
+
+	run_rows_in_parallel< Sizes >(
+		num_tcrs, max( int64_t(1), num_threads ),
+		[&]( Size const ii, Sizes & row_dists, Size ) {
+			compute_tcrdist_row( calcs.atcrdist, calcs.btcrdist, tcrs[ii], target_tcrs, row_dists );
+		},
+		[&]( Size const ii, Sizes const & row_dists ) {
+			copy( row_dists.begin(), row_dists.end(), dists + ii*num_target_tcrs );
+		} );
+	return 0;
+}
+
+// counts has shape (num_tcrs, max_dist+1): counts[i,d] is the number of (alpha, beta) background chain
+// pairs at paired tcrdist d from tcr i (not cumulative)
+int
+tcrdist_paired_distributions(
+	void const * calcs_in,
+	int64_t const num_tcrs,
+	int64_t const * va_nums, char const * cdr3as, int64_t const * cdr3a_offsets,
+	int64_t const * vb_nums, char const * cdr3bs, int64_t const * cdr3b_offsets,
+	int64_t const num_achains,
+	int64_t const * achain_v_nums, char const * achain_cdr3s, int64_t const * achain_cdr3_offsets,
+	int64_t const num_bchains,
+	int64_t const * bchain_v_nums, char const * bchain_cdr3s, int64_t const * bchain_cdr3_offsets,
+	int64_t const max_dist,
+	int64_t const num_threads,
+	int64_t * counts
+)
+{
+	TCRdistCalculators const & calcs( *static_cast< TCRdistCalculators const * >( calcs_in ) );
+	vector< PairedTCR > tcrs;
+	vector< DistanceTCR_g > achains, bchains;
+	if ( !decode_paired_tcrs( calcs, num_tcrs, va_nums, cdr3as, cdr3a_offsets, vb_nums, cdr3bs, cdr3b_offsets,
+			tcrs ) ||
+		!decode_single_chain_tcrs( calcs.atcrdist, num_achains, achain_v_nums, achain_cdr3s, achain_cdr3_offsets,
+			achains ) ||
+		!decode_single_chain_tcrs( calcs.btcrdist, num_bchains, bchain_v_nums, bchain_cdr3s, bchain_cdr3_offsets,
+			bchains ) ) return 1;
+	if ( max_dist < 0 ) {
+		cerr << "tcrdist_lib: bad max_dist: " << max_dist << endl;
+		return 1;
+	}
+
+	EncodedSingleChains const encoded_achains( calcs.atcrdist.encode_single_chains( achains ) ),
+		encoded_bchains( calcs.btcrdist.encode_single_chains( bchains ) );
+	vector< CountsScratch > scratch( max( int64_t(1), num_threads ) );
+
+	run_rows_in_parallel< Sizes >(
+		num_tcrs, scratch.size(),
+		[&]( Size const ii, Sizes & paired_counts, Size const thread_index ) {
+			count_paired_distances_row( calcs.atcrdist, calcs.btcrdist, tcrs[ii], encoded_achains, encoded_bchains,
+				max_dist, scratch[ thread_index ], paired_counts );
+		},
+		[&]( Size const ii, Sizes const & paired_counts ) {
+			copy( paired_counts.begin(), paired_counts.end(), counts + ii*(max_dist+1) );
+		} );
+	return 0;
+}
+
+} // extern "C"